@@ -83,6 +83,11 @@ class coco(imdb):
     widths = [ann['width'] for ann in anns]
     return widths
 
+  def image_sizes(self):
+    # the annotations have them, no need for the image metadata index
+    anns = self._COCO.loadImgs(self._image_index)
+    return [(ann['width'], ann['height']) for ann in anns]
+
   def image_path_at(self, i):
     """
     Return the absolute path to image i in the image sequence.
@@ -0,0 +1,77 @@
+# --------------------------------------------------------
+# Persistent index of image sizes
+# --------------------------------------------------------
+"""Width, height and channel count of the dataset images, read from the
+image headers once and kept on disk, so that startup does not open every
+image again. An entry is probed again when the file's mtime or size
+changes.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import os.path as osp
+import pickle
+from multiprocessing.pool import ThreadPool
+import PIL.Image
+
+from model.utils.config import cfg
+
+
+class ImageMetaIndex(object):
+  """path -> (mtime, file size, width, height, channels)"""
+
+  def __init__(self, index_file, num_threads=16):
+    self.index_file = index_file
+    self.num_threads = num_threads
+    self._entries = {}
+    if osp.exists(index_file):
+      with open(index_file, 'rb') as fid:
+        self._entries = pickle.load(fid)
+
+  def _probe(self, path):
+    st = os.stat(path)
+    entry = self._entries.get(path)
+    if entry is not None and entry[0] == st.st_mtime and entry[1] == st.st_size:
+      return entry, False
+    # only reads the header, the pixels are not decoded
+    im = PIL.Image.open(path)
+    entry = (st.st_mtime, st.st_size, im.size[0], im.size[1], len(im.getbands()))
+    im.close()
+    return entry, True
+
+  def lookup(self, paths):
+    """(width, height, channels) of every path, probing the new and the
+    changed files in parallel."""
+    paths = [osp.abspath(path) for path in paths]
+    pool = ThreadPool(self.num_threads)
+    try:
+      results = pool.map(self._probe, paths)
+    finally:
+      pool.close()
+    changed = False
+    for path, (entry, probed) in zip(paths, results):
+      if probed:
+        self._entries[path] = entry
+        changed = True
+    if changed:
+      self.save()
+    return [entry[2:] for entry, _ in results]
+
+  def save(self):
+    index_dir = osp.dirname(self.index_file)
+    if index_dir and not osp.exists(index_dir):
+      os.makedirs(index_dir)
+    # write aside and rename, concurrent runs never read a truncated index
+    tmp_file = '%s.%d.tmp' % (self.index_file, os.getpid())
+    with open(tmp_file, 'wb') as fid:
+      pickle.dump(self._entries, fid, pickle.HIGHEST_PROTOCOL)
+    os.rename(tmp_file, self.index_file)
+
+
+def image_sizes(paths):
+  """(width, height) of every image in paths."""
+  # not under data/cache, whose files are removed at every start
+  index = ImageMetaIndex(osp.join(cfg.DATA_DIR, 'image_meta', 'index.pkl'))
+  return [meta[:2] for meta in index.lookup(paths)]
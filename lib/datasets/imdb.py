@@ -10,11 +10,11 @@ from __future__ import print_function
 
 import os
 import os.path as osp
-import PIL
 from model.utils.cython_bbox import bbox_overlaps
 import numpy as np
 import scipy.sparse
 from model.utils.config import cfg
+from .image_meta import image_sizes
 import pdb
 
 ROOT_DIR = osp.join(osp.dirname(__file__), '..', '..')
@@ -115,9 +115,12 @@ class imdb(object):
     """
     raise NotImplementedError
 
+  def image_sizes(self):
+    """(width, height) of every image, from the image metadata index."""
+    return image_sizes([self.image_path_at(i) for i in range(self.num_images)])
+
   def _get_widths(self):
-    return [PIL.Image.open(self.image_path_at(i)).size[0]
-            for i in range(self.num_images)]
+    return [size[0] for size in self.image_sizes()]
 
   def append_flipped_images(self):
     num_images = self.num_images
@@ -7,14 +7,14 @@ import os.path
 import sys
 import torch.utils.data as data
 import cv2
-import torch
 import random
+import hashlib
+import pickle
+from multiprocessing.pool import ThreadPool
 import numpy as np
-if sys.version_info[0] == 2:
-    import xml.etree.cElementTree as ET
-else:
-    import xml.etree.ElementTree as ET
 from model.utils.config import cfg
+from datasets.voc_annotations import load_annotation_index
+from datasets.support_bank import SupportBank
 import collections
 
 class MetaDataset(data.Dataset):
@@ -27,9 +27,11 @@ class MetaDataset(data.Dataset):
         img_size(int) : the PRN network input size
         shot(int): the number of instances
         shuffle(bool)
+        seed(int): shuffle with this seed instead of the global random state,
+            the chosen shots are then cached and reused by the next runs
     """
 
-    def __init__(self, root, image_sets, metaclass, img_size, shots=1, shuffle=False, phase=1):
+    def __init__(self, root, image_sets, metaclass, img_size, shots=1, shuffle=False, phase=1, seed=None):
         self.root = root
         self.image_set = image_sets
         self.img_size = img_size
@@ -40,7 +42,8 @@ class MetaDataset(data.Dataset):
         self.shuffle=shuffle
         self._annopath = os.path.join('%s', 'Annotations', '%s.xml')
         self._imgpath = os.path.join('%s', 'JPEGImages', '%s.jpg')
-        self.shot_path  = open(os.path.join(self.root, 'VOC2007', 'ImageSets/Main/shots.txt'), 'w')  # the default saved path
+        self.seed = seed
+        self.shot_path = os.path.join(self.root, 'VOC2007', 'ImageSets/Main/shots.txt')  # the default saved path
         self.ids = list()
         for (year, name) in image_sets:
             self._year = year
@@ -48,84 +51,164 @@ class MetaDataset(data.Dataset):
             for line in open(os.path.join(rootpath, 'ImageSets', 'Main', name + '.txt')):
                 self.ids.append((rootpath, line.strip()))
 
-        class_to_idx = dict(zip(self.metaclass, range(len(self.metaclass))))  # class to index mapping
-
-        self.prndata = []
-        self.prncls = []
-        prn_image, prn_mask = self.get_prndata()
-        for i in range(shots):
-            cls = []
-            data = []
-            for n, key in enumerate(list(prn_image.keys())):
-                img = torch.from_numpy(np.array(prn_image[key][i]))
-                img = img.unsqueeze(0)
-                mask = torch.from_numpy(np.array(prn_mask[key][i]))
-                mask = mask.unsqueeze(0)
-                mask = mask.unsqueeze(3)
-                imgmask = torch.cat([img, mask], dim=3)
-                data.append(imgmask.permute(0, 3, 1, 2).contiguous())
-                cls.append(class_to_idx[key])
-            self.prncls.append(cls)
-            self.prndata.append(torch.cat(data,dim=0))
+        self.bank = self.get_support_bank()
+        self.set_episodes(shots)
 
     def __getitem__(self, index):
-        return  self.prndata[index],self.prncls[index]
+        return self.bank.samples(self.episodes[index]), self.prncls[index]
+
+    def set_episodes(self, num_episodes, rng=None):
+        '''
+        Episode i takes the i-th shot of every class, or a random one with rng, a
+        numpy RandomState. The bank is not rebuilt.
+        '''
+        classes = self.bank.classes()
+        class_shots = [self.bank.shots_of(label) for label in classes]
+        self.episodes = []
+        for i in range(num_episodes):
+            if rng is None:
+                self.episodes.append(np.array([shots[i] for shots in class_shots]))
+            else:
+                self.episodes.append(np.array([rng.choice(shots) for shots in class_shots]))
+        self.prncls = [classes] * num_episodes
 
-    def get_prndata(self):
+    def get_support_bank(self):
         '''
-        :return: the construct prn input data
+        :return: the SupportBank of the chosen shots
+        '''
+        shots = self.select_shots()
+        with open(self.shot_path, 'w') as f:
+            for img_id, _, _ in shots:
+                f.write(str(img_id[1]) + '\n')
+
+        bank_root = None
+        if self.shots_key is not None:
+            # the crops of the same shots from the same image files
+            stamps = self._stamps(shots, self._imgpath)
+            key = hashlib.sha1(repr((shots, stamps, self.img_size)).encode('utf-8')).hexdigest()
+            bank_root = os.path.join(self.root, 'annotations_cache', 'support_%s' % key)
+            if os.path.exists(bank_root):
+                print('Loaded the support bank from {:s}'.format(bank_root))
+                return SupportBank.load(bank_root)
+
+        # only the chosen images are decoded, cv2 releases the GIL
+        pool = ThreadPool(16)
+        try:
+            crops = pool.map(self._load_shot, shots)
+        finally:
+            pool.close()
+        class_to_idx = dict(zip(self.metaclass, range(len(self.metaclass))))  # class to index mapping
+        bank = SupportBank(np.stack([img for img, _ in crops]), np.stack([mask for _, mask in crops]),
+                           np.array([class_to_idx[name] for _, name, _ in shots], dtype=np.int32))
+        if bank_root is not None and not bank.save(bank_root):
+            # a concurrent run with the same shots saved it first
+            print('Loaded the support bank from {:s}'.format(bank_root))
+            return SupportBank.load(bank_root)
+        return bank
+
+    def select_shots(self):
+        '''
+        :return: the (img_id, class name, box) of every shot, in the order they are taken
         '''
         if self.shuffle:
-            random.shuffle(self.ids)
-        prn_image = collections.defaultdict(list)
-        prn_mask = collections.defaultdict(list)
-        classes = collections.defaultdict(int)
-        for cls in self.metaclass:
-            classes[cls] = 0
-        for img_id in self.ids:
-            # print(self._annopath)
-            print(img_id)
-            target = ET.parse(self._annopath % img_id).getroot()
-            img = cv2.imread(self._imgpath % img_id, cv2.IMREAD_COLOR)
-            img = img[:, :, ::-1]
-            img = img.astype(np.float32, copy=False)
-            img -= cfg.PIXEL_MEANS
-            height, width, _ = img.shape
-            mask = np.zeros((self.img_size, self.img_size), dtype=np.float32)
-            h, w, _ = img.shape
-            y_ration = float(h) / self.img_size
-            x_ration = float(w) / self.img_size
-            img_resize = cv2.resize(img, (self.img_size, self.img_size), interpolation=cv2.INTER_LINEAR)
-            for obj in target.iter('object'):
-                difficult = int(obj.find('difficult').text) == 1
-                # if difficult:
-                #     continue
-                name = obj.find('name').text.strip()
+            if self.seed is None:
+                random.shuffle(self.ids)
+            else:
+                random.Random(self.seed).shuffle(self.ids)
+        # the shots only depend on the image order, which a seed makes repeatable
+        cacheable = self.seed is not None or not self.shuffle
+        cache_dir = os.path.join(self.root, 'annotations_cache')
+        key = hashlib.sha1(repr((self.ids, list(self.metaclass), self.shots)).encode('utf-8')).hexdigest()
+        self.shots_key = key if cacheable else None
+        cache_file = os.path.join(cache_dir, 'shots_%s.pkl' % key)
+        if cacheable and os.path.exists(cache_file):
+            with open(cache_file, 'rb') as fid:
+                shots, stamps = pickle.load(fid)
+            if stamps == self._stamps(shots, self._annopath):
+                print('Loaded {:d} shots from {:s}'.format(len(shots), cache_file))
+                return shots
+
+        # parsed once and shared with the roidb and the evaluation
+        annotations = load_annotation_index([self._annopath % img_id for img_id in self.ids], cache_dir)
+        classes = dict((cls, 0) for cls in self.metaclass)
+        shots = []
+        for n_img, img_id in enumerate(self.ids):
+            objs = annotations.objects(n_img)
+            for name, box in zip(annotations.object_names(n_img), annotations.boxes[objs]):
+                name = name.strip()
                 if name not in self.metaclass:
                     continue
                 if classes[name] >= self.shots:
                     break
                 classes[name] += 1
-                bbox = obj.find('bndbox')
-                pts = ['xmin', 'ymin', 'xmax', 'ymax']
-                bndbox = []
-                for i, pt in enumerate(pts):
-                    cur_pt = int(float(bbox.find(pt).text)) - 1
-                    if i % 2 == 0:
-                        cur_pt = int(cur_pt / x_ration)
-                        bndbox.append(cur_pt)
-                    elif i % 2 == 1:
-                        cur_pt = int(cur_pt / y_ration)
-                        bndbox.append(cur_pt)
-                mask[bndbox[1]:bndbox[3], bndbox[0]:bndbox[2]] = 1
-                prn_image[name].append(img_resize)
-                prn_mask[name].append(mask)
-                self.shot_path.write(str(img_id[1])+'\n')
+                shots.append((img_id, name, box.tolist()))
                 break
-            if len(classes)>0 and min(classes.values()) == self.shots:
+            if len(classes) > 0 and min(classes.values()) == self.shots:
                 break
-        self.shot_path.close()
-        return prn_image, prn_mask
+
+        if cacheable:
+            # write aside and rename, concurrent runs never read a truncated file
+            tmp_file = '%s.%d.tmp' % (cache_file, os.getpid())
+            with open(tmp_file, 'wb') as fid:
+                pickle.dump((shots, self._stamps(shots, self._annopath)), fid, pickle.HIGHEST_PROTOCOL)
+            os.rename(tmp_file, cache_file)
+        return shots
+
+    def _stamps(self, shots, path):
+        # an edited file of a chosen image invalidates what was derived from it
+        stamps = []
+        for img_id, _, _ in shots:
+            st = os.stat(path % img_id)
+            stamps.append((st.st_mtime, st.st_size))
+        return stamps
+
+    def _load_shot(self, shot):
+        img_id, _, box = shot
+        img = cv2.imread(self._imgpath % img_id, cv2.IMREAD_COLOR)
+        mask = np.zeros((self.img_size, self.img_size), dtype=np.uint8)
+        h, w, _ = img.shape
+        y_ration = float(h) / self.img_size
+        x_ration = float(w) / self.img_size
+        # resized as uint8, the pixel means are subtracted when an episode is read
+        img_resize = cv2.resize(img, (self.img_size, self.img_size), interpolation=cv2.INTER_LINEAR)
+        img_resize = img_resize[:, :, ::-1]
+        bndbox = []
+        for i, pt in enumerate(box):
+            cur_pt = int(pt) - 1
+            if i % 2 == 0:
+                cur_pt = int(cur_pt / x_ration)
+                bndbox.append(cur_pt)
+            elif i % 2 == 1:
+                cur_pt = int(cur_pt / y_ration)
+                bndbox.append(cur_pt)
+        mask[bndbox[1]:bndbox[3], bndbox[0]:bndbox[2]] = 1
+        return img_resize, np.packbits(mask)
 
     def __len__(self):
-        return len(self.prndata)
+        return len(self.episodes)
+
+
+def sample_episode_classes(prncls, present, max_classes):
+    '''
+    Rows of a support set for one class subsampled training step: the rows of
+    all classes in present, and random other rows up to max_classes in total.
+    :param prncls: the class index of every row of the support set
+    :param present: the class indexes of the detection batch
+    :return: the chosen rows in support set order, and a weight for each, so
+        that the weighted sum of a per row loss is an unbiased estimate of its
+        mean over all rows
+    '''
+    forced = set(i for i, cls in enumerate(prncls) if cls in present)
+    others = [i for i, cls in enumerate(prncls) if cls not in present]
+    num_random = min(max(max_classes - len(forced), 0), len(others))
+    chosen = set(np.random.choice(others, num_random, replace=False)) if num_random > 0 else set()
+    rows, weights = [], []
+    for i in range(len(prncls)):
+        if i in chosen:
+            # each other row is drawn with probability num_random / len(others)
+            rows.append(i)
+            weights.append(float(len(others)) / num_random / len(prncls))
+        elif i in forced:
+            rows.append(i)
+            weights.append(1. / len(prncls))
+    return rows, weights
@@ -24,6 +24,7 @@ from .imdb import imdb
 from .imdb import ROOT_DIR
 from . import ds_utils
 from .voc_eval import voc_eval
+from .voc_annotations import load_annotation_index
 import  random
 # TODO: make fast_rcnn irrelevant
 # >>>> obsolete, because it depends on sth outside of this project
@@ -117,23 +118,23 @@ class pascal_voc(imdb):
         """
         Return the database of ground-truth regions of interest.
 
-        This function loads/saves from/to a cache file to speed up future calls.
+        The annotations come from the shared annotation index, which only
+        parses the xml files that are new or changed.
         """
-        cache_file = os.path.join(self.cache_path, self.name + '_gt_roidb.pkl')
-        if os.path.exists(cache_file):
-            with open(cache_file, 'rb') as fid:
-                roidb = pickle.load(fid)
-            print('{} gt roidb loaded from {}'.format(self.name, cache_file))
-            return roidb
-
-        gt_roidb = [self._load_pascal_annotation(index)
-                    for index in self.image_index]
-        with open(cache_file, 'wb') as fid:
-            pickle.dump(gt_roidb, fid, pickle.HIGHEST_PROTOCOL)
-        print('wrote gt roidb to {}'.format(cache_file))
+        annotations = self.annotation_index()
+        gt_roidb = [self._load_pascal_annotation(annotations, i)
+                    for i in xrange(len(self.image_index))]
 
         return gt_roidb
 
+    def annotation_index(self):
+        """
+        datasets.voc_annotations.AnnotationIndex of the images of this set.
+        """
+        filenames = [os.path.join(self._data_path, 'Annotations', index + '.xml')
+                     for index in self.image_index]
+        return load_annotation_index(filenames, os.path.join(self._devkit_path, 'annotations_cache'))
+
     def selective_search_roidb(self):
         """
         Return the database of selective search regions of interest.
@@ -200,46 +201,31 @@ class pascal_voc(imdb):
 
         return self.create_roidb_from_box_list(box_list, gt_roidb)
 
-    def _load_pascal_annotation(self, index):
+    def _load_pascal_annotation(self, annotations, i):
         """
-        Load image and bounding boxes info from XML file in the PASCAL VOC
-        format.
+        Load the bounding boxes of the i-th image from the parsed PASCAL VOC
+        annotations.
         """
-        filename = os.path.join(self._data_path, 'Annotations', index + '.xml')
-        tree = ET.parse(filename)
-        objs = tree.findall('object')
-        # if not self.config['use_diff']:
-        #     # Exclude the samples labeled as difficult
-        #     non_diff_objs = [
-        #         obj for obj in objs if int(obj.find('difficult').text) == 0]
-        #     # if len(non_diff_objs) != len(objs):
-        #     #     print 'Removed {} difficult objects'.format(
-        #     #         len(objs) - len(non_diff_objs))
-        #     objs = non_diff_objs
-        num_objs = len(objs)
+        objs = annotations.objects(i)
+        names = annotations.object_names(i)
+        num_objs = len(names)
 
         boxes = np.zeros((num_objs, 4), dtype=np.uint16)
         gt_classes = np.zeros((num_objs), dtype=np.int32)
         overlaps = np.zeros((num_objs, self.num_classes), dtype=np.float32)
         # "Seg" area for pascal is just the box area
         seg_areas = np.zeros((num_objs), dtype=np.float32)
-        ishards = np.zeros((num_objs), dtype=np.int32)
+        # Make pixel indexes 0-based
+        obj_boxes = annotations.boxes[objs] - 1
+        ishards = annotations.difficult[objs].astype(np.int32)
 
         # Load object bounding boxes into a data frame.
-        for ix, obj in enumerate(objs):
-            bbox = obj.find('bndbox')
-            # Make pixel indexes 0-based
-            x1 = float(bbox.find('xmin').text) - 1
-            y1 = float(bbox.find('ymin').text) - 1
-            x2 = float(bbox.find('xmax').text) - 1
-            y2 = float(bbox.find('ymax').text) - 1
-
-            diffc = obj.find('difficult')
-            difficult = 0 if diffc == None else int(diffc.text)
-            ishards[ix] = difficult
-            if obj.find('name').text.lower().strip() not in self._classes:
+        for ix, name in enumerate(names):
+            name = name.lower().strip()
+            if name not in self._classes:
                 continue
-            cls = self._class_to_ind[obj.find('name').text.lower().strip()]
+            x1, y1, x2, y2 = obj_boxes[ix]
+            cls = self._class_to_ind[name]
             boxes[ix, :] = [x1, y1, x2, y2]
             gt_classes[ix] = cls
             overlaps[ix, cls] = 1.0
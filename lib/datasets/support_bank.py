@@ -0,0 +1,81 @@
+"""Compact bank of the support crops of MetaDataset.
+
+A support sample used to be kept as a float32 (4, S, S) array, the image
+less the pixel means and the box mask, for every shot and class: 800 KB
+at S = 224, tripled shots in phase 2 included. SupportBank keeps the
+resized RGB crop as uint8 and the mask packed to one bit per pixel, 155 KB
+a shot, and builds the float samples of an episode when it is read. A bank
+saved with save() is memory mapped by load(), so that the processes that
+read it share the pages.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import shutil
+import numpy as np
+import torch
+
+from model.utils.config import cfg
+
+
+class SupportBank(object):
+  """
+  Per shot, in the order the shots were chosen:
+    images (K, S, S, 3) uint8 RGB
+    masks (K, ceil(S * S / 8)) uint8, the box mask, np.packbits of the S x S mask
+    labels (K,) int32, the index of the class of the shot in metaclass
+  """
+  _COLUMNS = ('images', 'masks', 'labels')
+
+  def __init__(self, images, masks, labels):
+    self.images = images
+    self.masks = masks
+    self.labels = labels
+    self.img_size = images.shape[1]
+
+  @classmethod
+  def load(cls, root):
+    return cls(*[np.load(os.path.join(root, name + '.npy'), mmap_mode='r') for name in cls._COLUMNS])
+
+  def save(self, root):
+    """Returns False if a concurrent run saved a bank to root first."""
+    # write aside and rename, concurrent runs never read a partial bank
+    tmp_root = '%s.%d.tmp' % (root, os.getpid())
+    if os.path.exists(tmp_root):
+      shutil.rmtree(tmp_root)
+    os.makedirs(tmp_root)
+    for name in self._COLUMNS:
+      np.save(os.path.join(tmp_root, name + '.npy'), getattr(self, name))
+    try:
+      os.rename(tmp_root, root)
+    except OSError:
+      shutil.rmtree(tmp_root)
+      if not os.path.exists(root):
+        raise
+      return False
+    return True
+
+  def __len__(self):
+    return len(self.labels)
+
+  def classes(self):
+    """The labels of the bank, in the order they first appear."""
+    _, first = np.unique(self.labels, return_index=True)
+    return [int(self.labels[i]) for i in np.sort(first)]
+
+  def shots_of(self, label):
+    """The shots of class label, in the order they were chosen."""
+    return np.where(self.labels == label)[0]
+
+  def samples(self, shots):
+    """(len(shots), 4, S, S) float tensor of the given shots: the image less
+    cfg.PIXEL_MEANS, and the box mask."""
+    shots = np.asarray(shots)
+    size = self.img_size
+    data = np.empty((len(shots), size, size, 4), dtype=np.float32)
+    np.subtract(self.images[shots], cfg.PIXEL_MEANS, out=data[:, :, :, :3])
+    masks = np.unpackbits(self.masks[shots], axis=1)[:, :size * size]
+    data[:, :, :, 3] = masks.reshape(-1, size, size)
+    return torch.from_numpy(data).permute(0, 3, 1, 2).contiguous()
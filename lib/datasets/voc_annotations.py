@@ -0,0 +1,123 @@
+# --------------------------------------------------------
+# Parsed PASCAL VOC annotations, shared by the roidb, the evaluation
+# and the meta dataset
+# --------------------------------------------------------
+"""The objects of a set of VOC xml files as flat arrays.
+
+Every xml file is parsed once, in a thread pool, and its objects are kept
+in a cache file next to the other annotation caches. A file is parsed again
+when its mtime or size changes. pascal_voc, voc_eval and MetaDataset all
+read their annotations through load_annotation_index.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import os.path as osp
+import pickle
+import xml.etree.ElementTree as ET
+from multiprocessing.pool import ThreadPool
+import numpy as np
+
+
+class AnnotationIndex(object):
+  """
+  The objects of all files, in file order and, within a file, in xml order:
+    names: the distinct object names, as written in the files
+    name_ids (N,) int32, into names
+    boxes (N, 4) float64, xmin ymin xmax ymax as written (1-based)
+    difficult, truncated (N,) uint8, 0 when missing
+  offsets (I + 1,): the objects of file i are [offsets[i], offsets[i + 1])
+  """
+
+  def __init__(self, records):
+    names = {}
+    name_ids, boxes, difficult, truncated = [], [], [], []
+    offsets = [0]
+    for record in records:
+      obj_names, obj_boxes, obj_difficult, obj_truncated = record
+      name_ids.extend(names.setdefault(name, len(names)) for name in obj_names)
+      boxes.append(obj_boxes)
+      difficult.append(obj_difficult)
+      truncated.append(obj_truncated)
+      offsets.append(offsets[-1] + len(obj_names))
+    self.names = sorted(names, key=names.get)
+    self.name_ids = np.array(name_ids, dtype=np.int32)
+    self.boxes = np.concatenate(boxes).reshape(-1, 4) if boxes else np.zeros((0, 4))
+    self.difficult = np.concatenate(difficult) if difficult else np.zeros(0, dtype=np.uint8)
+    self.truncated = np.concatenate(truncated) if truncated else np.zeros(0, dtype=np.uint8)
+    self.offsets = np.array(offsets, dtype=np.int64)
+
+  def __len__(self):
+    return len(self.offsets) - 1
+
+  def objects(self, i):
+    """The slice of the objects of file i."""
+    return slice(int(self.offsets[i]), int(self.offsets[i + 1]))
+
+  def object_names(self, i):
+    return [self.names[k] for k in self.name_ids[self.objects(i)]]
+
+
+def _int_or_zero(obj, tag):
+  node = obj.find(tag)
+  return 0 if node is None else int(node.text)
+
+
+def parse_annotation(filename):
+  """(names, boxes, difficult, truncated) of the objects of an xml file."""
+  tree = ET.parse(filename)
+  names, boxes, difficult, truncated = [], [], [], []
+  for obj in tree.findall('object'):
+    names.append(obj.find('name').text)
+    bbox = obj.find('bndbox')
+    boxes.append([float(bbox.find(pt).text) for pt in ('xmin', 'ymin', 'xmax', 'ymax')])
+    difficult.append(_int_or_zero(obj, 'difficult'))
+    truncated.append(_int_or_zero(obj, 'truncated'))
+  return (names, np.array(boxes, dtype=np.float64).reshape(-1, 4),
+          np.array(difficult, dtype=np.uint8), np.array(truncated, dtype=np.uint8))
+
+
+def load_annotation_index(filenames, cache_dir, num_threads=16):
+  """AnnotationIndex of the xml files filenames, parsing only the ones that
+  are new or changed since they were cached in cache_dir."""
+  if not osp.isdir(cache_dir):
+    os.makedirs(cache_dir)
+  cache_file = osp.join(cache_dir, 'annotation_index.pkl')
+  # absolute path -> (mtime, size, record)
+  cache = {}
+  if osp.exists(cache_file):
+    with open(cache_file, 'rb') as fid:
+      try:
+        cache = pickle.load(fid)
+      except Exception:
+        # written by another python version or damaged, parse again
+        cache = {}
+
+  filenames = [osp.abspath(filename) for filename in filenames]
+
+  def load(filename):
+    st = os.stat(filename)
+    entry = cache.get(filename)
+    if entry is not None and entry[0] == st.st_mtime and entry[1] == st.st_size:
+      return entry, False
+    return (st.st_mtime, st.st_size, parse_annotation(filename)), True
+
+  pool = ThreadPool(num_threads)
+  try:
+    entries = pool.map(load, filenames)
+  finally:
+    pool.close()
+
+  parsed = [filename for filename, (_, new) in zip(filenames, entries) if new]
+  if parsed:
+    print('Parsed {:d} of {:d} annotation files'.format(len(parsed), len(filenames)))
+    for filename, (entry, _) in zip(filenames, entries):
+      cache[filename] = entry
+    # write aside and rename, concurrent runs never read a truncated cache
+    tmp_file = '%s.%d.tmp' % (cache_file, os.getpid())
+    with open(tmp_file, 'wb') as fid:
+      pickle.dump(cache, fid, pickle.HIGHEST_PROTOCOL)
+    os.rename(tmp_file, cache_file)
+  return AnnotationIndex([entry[2] for entry, _ in entries])
@@ -11,6 +11,7 @@ import xml.etree.ElementTree as ET
 import os
 import pickle
 import numpy as np
+from .voc_annotations import load_annotation_index
 
 def parse_rec(filename):
   """ Parse a PASCAL VOC xml file """
@@ -96,49 +97,25 @@ def voc_eval(detpath,
   # assumes detections are in detpath.format(classname)
   # assumes annotations are in annopath.format(imagename)
   # assumes imagesetfile is a text file with each line an image name
-  # cachedir caches the annotations in a pickle file
-
-  # first load gt
-  if not os.path.isdir(cachedir):
-    os.mkdir(cachedir)
-  cachefile = os.path.join(cachedir, 'annots.pkl')
+  # cachedir caches the parsed annotations, see voc_annotations
 
   # read list of images
   with open(imagesetfile, 'r') as f:
     lines = f.readlines()
   imagenames = [x.strip() for x in lines]
 
-  if not os.path.isfile(cachefile):
-    # load annotations
-    recs = {}
-    for i, imagename in enumerate(imagenames):
-      recs[imagename] = parse_rec(annopath.format(imagename))
-      if i % 100 == 0:
-        print('Reading annotation for {:d}/{:d}'.format(
-          i + 1, len(imagenames)))
-    # save
-    print('Saving cached annotations to {:s}'.format(cachefile))
-    with open(cachefile, 'wb') as f:
-      pickle.dump(recs, f)
-  else:
-    # load
-    with open(cachefile, 'rb') as f:
-      try:
-        recs = pickle.load(f)
-      except:
-        recs = pickle.load(f, encoding='bytes')
+  # first load gt, parsed once and shared with the roidb
+  annotations = load_annotation_index([annopath.format(imagename) for imagename in imagenames], cachedir)
 
   # extract gt objects for this class
   class_recs = {}
   npos = 0
-  for imagename in imagenames:
-    R = [obj for obj in recs[imagename] if obj['name'] == classname]
-    #obj = recs[imagename]
-    #if obj[0] == classname :
-      #R = obj
-    bbox = np.array([x['bbox'] for x in R])
-    difficult = np.array([x['difficult'] for x in R]).astype(np.bool)
-    det = [False] * len(R)
+  for i, imagename in enumerate(imagenames):
+    objs = annotations.objects(i)
+    keep = np.array([name == classname for name in annotations.object_names(i)], dtype=np.bool_)
+    bbox = annotations.boxes[objs][keep]
+    difficult = annotations.difficult[objs][keep].astype(np.bool_)
+    det = [False] * len(bbox)
     npos = npos + sum(~difficult)
     class_recs[imagename] = {'bbox': bbox,
                              'difficult': difficult,
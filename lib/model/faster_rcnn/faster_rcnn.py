@@ -46,8 +46,13 @@ class _fasterRCNN(nn.Module):
         self.grid_size = cfg.POOLING_SIZE * 2 if cfg.CROP_RESIZE_WITH_MAX_POOL else cfg.POOLING_SIZE
         self.RCNN_roi_crop = _RoICrop()
 
+        # fc1 with the mean class attentions folded in, see compile_meta_test_head
+        self.meta_test_weight = None
+        self.meta_test_bias = None
+
     def forward(self, im_data_list, im_info_list, gt_boxes_list, num_boxes_list,normal_data_list=None, normal_info_list=None,average_shot=None,
-                mean_class_attentions=None,normal_mean_class_attentions=None,phase2=None):
+                mean_class_attentions=None,normal_mean_class_attentions=None,phase2=None,meta_weights=None,
+                normal_attentions=None):
         # return attentions for testing
         if average_shot:
             prn_data = im_data_list[0]  # len(metaclass)*4*224*224
@@ -64,9 +69,8 @@ class _fasterRCNN(nn.Module):
             attentions = self.prn_network(prn_data)
             attentions1 = self.sigmoid(attentions)
             prn_cls = im_info_list[0]  # len(metaclass)
-            normal_prn_data = normal_data_list[0]
-            normal_attentions = self.normal_prn_network(normal_prn_data)
-            normal_prn_cls = normal_info_list[0]
+            # the defect-free attentions are computed when the novel classes need them, unless given
+            normal_prn_data = normal_data_list[0] if normal_attentions is None else None
 
         im_data = im_data_list[-1]
         im_info = im_info_list[-1]
@@ -80,7 +84,7 @@ class _fasterRCNN(nn.Module):
 
         # feed image data to base model to obtain base feature map
         # print(im_data)  #4(bach_size=4)x3x600x600
-        base_feat = self.RCNN_base(self.rcnn_conv1(im_data))
+        base_feat = self._im_to_base_feat(im_data)
         #print(base_feat)  #4x1024x38x38
 
         # feed base feature map tp RPN to obtain rois
@@ -124,80 +128,66 @@ class _fasterRCNN(nn.Module):
 
         # meta training phase
         if self.meta_train:
-            rcnn_loss_cls = []
-            rcnn_loss_bbox = []
             # pooled feature maps need to operate channel-wise multiplication with the corresponding class's attentions of every roi of image
-            for b in range(batch_size):
-                zero = Variable(torch.FloatTensor([0]).cuda())
-                proposal_labels = rois_label[b * 128:(b + 1) * 128].data.cpu().numpy()[0]
-                unique_labels = list(np.unique(proposal_labels)) # the unique rois labels of the input image
-                #attentions.size(0)=config.BASECLASSES
-                #for i in range(attentions.size(0)):  # attentions len(attentions)*2048,每次循环表示一个类
-                for i in range(attentions.size(0)):
-                    if prn_cls[i].numpy()[0] + 1 not in unique_labels:
-                        rcnn_loss_cls.append(zero)
-                        rcnn_loss_bbox.append(zero)
-                        continue
-                    # print("ROI FEATURE:")
-                    # print(pooled_feat[b * cfg.TRAIN.BATCH_SIZE:(b + 1) * cfg.TRAIN.BATCH_SIZE, :].shape)
-                    channel_wise_feat1 = pooled_feat[b * cfg.TRAIN.BATCH_SIZE:(b + 1) * cfg.TRAIN.BATCH_SIZE, :] * (attentions1[i])
-                    # print("Vn class:")
-                    # print(attentions1.shape)
-                    # print("Fn class:")
-                    # print(channel_wise_feat1.shape)
-                    # if phase2:
-                    if attentions.size(0) > cfg.TRAIN.NUM_BASE:
-                        if i < cfg.TRAIN.NUM_BASE:
-                            channel_wise_feat = torch.cat((channel_wise_feat1, channel_wise_feat1), dim=1)
-                        else:
-                            # 因为要反向传播计算loss,所以必须要defect_image和normal_image在同一个dataloader里面才可以操作.
-                            # channel_wise_feat2 = pooled_feat[b * cfg.TRAIN.BATCH_SIZE:(b + 1) * cfg.TRAIN.BATCH_SIZE,
-                            #                      :] * (attentions1[i] - 0.05 * self.sigmoid(normal_attentions[0])) #最原始的代码
-
-                            # channel_wise_feat2 = pooled_feat[b * cfg.TRAIN.BATCH_SIZE:(b + 1) * cfg.TRAIN.BATCH_SIZE,
-                            #                      :] * (attentions[i] - 0.05 * normal_attentions[0])  #去掉原先的sigmoid之后
-
-                            channel_wise_feat2 = pooled_feat[b * cfg.TRAIN.BATCH_SIZE:(b + 1) * cfg.TRAIN.BATCH_SIZE,
-                                                 :] * (self.sigmoid(attentions[i] - 0.05*normal_attentions[0]))
-
-                            # print("Fnd:")
-                            # print(channel_wise_feat2.shape)
-
-                            channel_wise_feat = torch.cat((channel_wise_feat1, channel_wise_feat2), dim=1)
-                            # print("Fn1:")
-                            # print(channel_wise_feat.shape)
-
-                        channel_wise_feat_all = self.fc1(channel_wise_feat)
-                        # print("Fn:")
-                        # print(channel_wise_feat_all.shape)
-                    else:
-                        channel_wise_feat_all = channel_wise_feat1
-
-                    # print(channel_wise_feat_all)
-                    # 上一行代码的pooled_feat的作用是分出一张图对应的特征，即从(b*128)*2048的矩阵中提取出128×2048的矩阵
-                    bbox_pred = self.RCNN_bbox_pred(channel_wise_feat_all)  # 128 * 4
-                    if self.training and not self.class_agnostic:
-                        # select the corresponding columns according to roi labels
-                        bbox_pred_view = bbox_pred.view(bbox_pred.size(0), int(bbox_pred.size(1) / 4), 4)
-                        bbox_pred_select = torch.gather(bbox_pred_view, 1,rois_label[b * cfg.TRAIN.BATCH_SIZE:(b + 1) * cfg.TRAIN.BATCH_SIZE].view(
-                                                            rois_label[b * cfg.TRAIN.BATCH_SIZE:(b + 1) * cfg.TRAIN.BATCH_SIZE].size(0), 1, 1).expand(
-                                                            rois_label[b * cfg.TRAIN.BATCH_SIZE:(b + 1) * cfg.TRAIN.BATCH_SIZE].size(0), 1,4))
-                        bbox_pred = bbox_pred_select.squeeze(1)
-                    # compute object classification probability
-                    cls_score = self.RCNN_cls_score(channel_wise_feat_all)  # 128 * (20+1)，VOC数据集有20类
-
-
-                    if self.training:
-                        # classification loss
-                        #与ground truth计算损失
-                        RCNN_loss_cls = F.cross_entropy(cls_score, rois_label[b * 128:(b + 1) * 128])
-                        rcnn_loss_cls.append(RCNN_loss_cls)
-                        # bounding box regression L1 loss
-                        RCNN_loss_bbox = _smooth_l1_loss(bbox_pred, rois_target[b * 128:(b + 1) * 128],
-                                                         rois_inside_ws[b * 128:(b + 1) * 128],
-                                                         rois_outside_ws[b * 128:(b + 1) * 128])
-
-                        rcnn_loss_bbox.append(RCNN_loss_bbox)
+            # All (image, class) pairs go through the head together. As in the
+            # former per-class loop, a class takes part for an image only if it is
+            # the label of the image's first roi, the other pairs have zero loss.
+            num_rois = cfg.TRAIN.BATCH_SIZE
+            num_meta_cls = attentions.size(0)
+            meta_cls = torch.cat(prn_cls, 0).type_as(rois_label.data) + 1
+            first_labels = rois_label.data.view(batch_size, num_rois)[:, 0]
+            present = first_labels.view(-1, 1) == meta_cls.view(1, -1)
+
+            # one loss per (image, class), in the order of the former lists
+            rcnn_loss_cls = Variable(pooled_feat.data.new(batch_size * num_meta_cls).zero_())
+            rcnn_loss_bbox = Variable(pooled_feat.data.new(batch_size * num_meta_cls).zero_())
+            pairs = torch.nonzero(present)
+            if pairs.numel() > 0:
+                img_inds = Variable(pairs[:, 0])
+                cls_inds = Variable(pairs[:, 1])
+                # pairs x 128 x 2048
+                roi_feat = pooled_feat.view(batch_size, num_rois, -1).index_select(0, img_inds)
+                channel_wise_feat1 = roi_feat * attentions1.index_select(0, cls_inds).unsqueeze(1)
+                # a class subsampled support set can hold base classes only, phase2 tells the phases apart
+                two_branch = phase2 if phase2 is not None else num_meta_cls > cfg.TRAIN.NUM_BASE
+                if two_branch:
+                    # base classes see their attentions twice, novel classes also the defect-free ones
+                    if normal_attentions is None:
+                        normal_attentions = self.normal_prn_network(normal_prn_data)
+                    novel = Variable((meta_cls > cfg.TRAIN.NUM_BASE).type_as(attentions.data).view(-1, 1))
+                    attentions2 = attentions1 * (1 - novel) + \
+                                  self.sigmoid(attentions - 0.05 * normal_attentions[0]) * novel
+                    channel_wise_feat2 = roi_feat * attentions2.index_select(0, cls_inds).unsqueeze(1)
+                    channel_wise_feat = torch.cat((channel_wise_feat1, channel_wise_feat2), dim=2)
+                    channel_wise_feat_all = self.fc1(channel_wise_feat.view(-1, channel_wise_feat.size(2)))
+                else:
+                    channel_wise_feat_all = channel_wise_feat1.view(-1, channel_wise_feat1.size(2))
+
+                pair_labels = rois_label.view(batch_size, num_rois).index_select(0, img_inds).view(-1)
+                pair_inds = pairs[:, 0] * num_meta_cls + pairs[:, 1]
+                bbox_pred = self.RCNN_bbox_pred(channel_wise_feat_all)  # (pairs*128) * 4
+                if self.training and not self.class_agnostic:
+                    # select the corresponding columns according to roi labels
+                    bbox_pred_view = bbox_pred.view(bbox_pred.size(0), int(bbox_pred.size(1) / 4), 4)
+                    bbox_pred_select = torch.gather(bbox_pred_view, 1, pair_labels.view(pair_labels.size(0), 1, 1).expand(
+                                                        pair_labels.size(0), 1, 4))
+                    bbox_pred = bbox_pred_select.squeeze(1)
+                # compute object classification probability
+                cls_score = self.RCNN_cls_score(channel_wise_feat_all)  # (pairs*128) * (n_classes)
+
+                if self.training:
+                    # classification loss, cross entropy of every pair
+                    RCNN_loss_cls = -F.log_softmax(cls_score, dim=1).gather(1, pair_labels.view(-1, 1))
+                    RCNN_loss_cls = RCNN_loss_cls.view(-1, num_rois).mean(1)
+                    # bounding box regression L1 loss
+                    def pair_rows(x):
+                        return x.view(batch_size, num_rois, -1).index_select(0, img_inds).view(-1, x.size(1))
+                    RCNN_loss_bbox = _smooth_l1_loss(bbox_pred, pair_rows(rois_target), pair_rows(rois_inside_ws),
+                                                     pair_rows(rois_outside_ws), reduce=False)
+                    RCNN_loss_bbox = RCNN_loss_bbox.view(-1, num_rois).mean(1)
+
+                    rcnn_loss_cls = rcnn_loss_cls.index_add(0, Variable(pair_inds), RCNN_loss_cls)
+                    rcnn_loss_bbox = rcnn_loss_bbox.index_add(0, Variable(pair_inds), RCNN_loss_bbox)
             # meta attentions loss
             #这里的torch.cat(prn_cls,dim=0)只是把四个base类的类别id拼接成一个向量
             #F.cross_entropy(input,target),这里的input为4×10的矩阵，这里的target是4个base class的类别index
@@ -209,12 +199,37 @@ class _fasterRCNN(nn.Module):
                 # print(attentions_score.shape)#[10, 11]
                 # print("prn_cls:")
                 # print(prn_cls)#当前训练类别的index(例如:0~9)
-                meta_loss = F.cross_entropy(attentions_score, Variable(torch.cat(prn_cls,dim=0).cuda()))
+                meta_target = Variable(torch.cat(prn_cls,dim=0).cuda())
+                if meta_weights is None:
+                    meta_loss = F.cross_entropy(attentions_score, meta_target)
+                else:
+                    # a class subsampled support set, the weights make up for the classes left out
+                    meta_loss = -(F.log_softmax(attentions_score, dim=1).gather(1, meta_target.view(-1, 1)).view(-1)
+                                  * meta_weights).sum()
             else:
                 meta_loss = 0
             return rois, rpn_loss_cls, rpn_loss_bbox, rcnn_loss_cls, rcnn_loss_bbox, rois_label, 0, 0, meta_loss
 
         #第三阶段，测试阶段
+        elif self.meta_test and self.meta_test_weight is not None and not self.training:
+            # all classes at once through the compiled head
+            num_meta_cls = self.meta_test_weight.size(0) // self.fc1.out_features
+            channel_wise_feat_all = F.linear(pooled_feat, Variable(self.meta_test_weight), Variable(self.meta_test_bias))
+            # (b*128)*(n*2048) -> (n*b*128)*2048, class major
+            channel_wise_feat_all = channel_wise_feat_all.view(-1, num_meta_cls, self.fc1.out_features) \
+                .transpose(0, 1).contiguous().view(-1, self.fc1.out_features)
+
+            bbox_pred = self.RCNN_bbox_pred(channel_wise_feat_all)
+            cls_score = self.RCNN_cls_score(channel_wise_feat_all)
+            cls_prob = F.softmax(cls_score, dim=1)
+
+            cls_prob = cls_prob.view(num_meta_cls, batch_size, rois.size(1), -1)
+            bbox_pred = bbox_pred.view(num_meta_cls, batch_size, rois.size(1), -1)
+            cls_prob_list = [cls_prob[i] for i in range(num_meta_cls)]
+            bbox_pred_list = [bbox_pred[i] for i in range(num_meta_cls)]
+
+            return rois, rpn_loss_cls, rpn_loss_bbox, 0, 0, rois_label, cls_prob_list, bbox_pred_list, 0
+
         elif self.meta_test:
             cls_prob_list = []
             bbox_pred_list = []
@@ -290,6 +305,34 @@ class _fasterRCNN(nn.Module):
 
         return rois, rpn_loss_cls, rpn_loss_bbox, RCNN_loss_cls, RCNN_loss_bbox, rois_label, cls_prob, bbox_pred, 0
 
+    def compile_meta_test_head(self, mean_class_attentions, normal_mean_class_attentions):
+        """Fold the mean class attentions used for meta testing into fc1.
+
+        For class c fc1 sees [f * s1, f * s2], with s1 = sigmoid(a_c) and s2 = s1
+        for base classes or sigmoid(a_c - 0.05 * a_normal) for novel classes, so
+        it is a linear layer of f with the weight W[:, :2048] * s1 + W[:, 2048:] * s2.
+        The weights of all classes are stacked and the meta_test forward then
+        runs them as a single matmul. Call again whenever fc1 or the attentions
+        change.
+        """
+        def _tensor(x):
+            return x.data if isinstance(x, Variable) else x
+
+        weight = self.fc1.weight.data
+        dim = weight.size(1) // 2
+        normal_attentions = _tensor(normal_mean_class_attentions[0]).view(1, -1).type_as(weight)
+        weights = []
+        for i in range(len(mean_class_attentions)):
+            attentions = _tensor(mean_class_attentions[i]).view(1, -1).type_as(weight)
+            if i < cfg.TRAIN.NUM_BASE:
+                # both halves of the input are the same
+                weights.append((weight[:, :dim] + weight[:, dim:]) * torch.sigmoid(attentions))
+            else:
+                weights.append(weight[:, :dim] * torch.sigmoid(attentions) +
+                               weight[:, dim:] * torch.sigmoid(attentions - 0.05 * normal_attentions))
+        self.meta_test_weight = torch.cat(weights, 0)
+        self.meta_test_bias = self.fc1.bias.data.repeat(len(weights))
+
     def _init_weights(self):
         def normal_init(m, mean, stddev, truncated=False):
             """
@@ -0,0 +1,51 @@
+"""Running mean of the defect-free attentions.
+
+In the second phase every training step ran normal_prn_network, the meta
+conv, RCNN_base and layer4, forward and backward on one defect-free image,
+for a single 2048-d vector that only shifts the attentions of the novel
+classes. NormalAttentionBank runs it every refresh steps instead, on the
+last batch defect-free images of the stream, and keeps an exponential
+moving average of the results for the steps in between. The gradients
+reach normal_prn_network on the refresh steps only.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import torch
+from torch.autograd import Variable
+
+
+class NormalAttentionBank(object):
+    def __init__(self, refresh, momentum=0.9, batch=1):
+        self.refresh = refresh
+        self.momentum = momentum
+        # the latest defect-free images, a refresh runs on all of them
+        self.images = collections.deque(maxlen=batch)
+        self.value = None
+        self.steps = 0
+        self.refreshes = 0
+
+    def __call__(self, model, normal_image, cuda=True):
+        """(1, 2048) defect-free attentions for a training step, normal_image
+        is the (3, H, W) image of the step. On a refresh step they are the
+        fresh attentions of the images, with their graph, otherwise the
+        running mean."""
+        self.images.append(normal_image)
+        refresh = self.value is None or self.steps % self.refresh == 0
+        self.steps += 1
+        if not refresh:
+            return Variable(self.value)
+
+        self.refreshes += 1
+        normal_data = torch.stack(list(self.images), 0)
+        if cuda:
+            normal_data = normal_data.cuda()
+        attentions = model.normal_prn_network(Variable(normal_data)).mean(0, keepdim=True)
+        if self.value is None:
+            self.value = attentions.data.clone()
+        else:
+            self.value.mul_(self.momentum).add_(attentions.data * (1 - self.momentum))
+        return attentions
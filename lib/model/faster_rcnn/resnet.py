@@ -336,6 +336,30 @@ class resnet(_fasterRCNN):
       self.RCNN_base.apply(set_bn_eval)
       self.RCNN_top.apply(set_bn_eval)
 
+  def _fixed_base_modules(self):
+    # conv1, bn1 and the first cfg.RESNET.FIXED_BLOCKS blocks
+    return [self.rcnn_conv1] + list(self.RCNN_base)[:3 + min(cfg.RESNET.FIXED_BLOCKS, 3)]
+
+  def _fixed_base_feat(self, im_data):
+    # the fixed modules never need gradients for the image branch, run them volatile
+    base_feat = Variable(im_data.data, volatile=True)
+    for m in self._fixed_base_modules():
+      base_feat = m(base_feat)
+    return base_feat
+
+  def _im_to_base_feat(self, im_data):
+    # im_data with other than 3 channels already holds the output of the
+    # fixed modules, served from the roibatchLoader feature cache
+    if im_data.size(1) == 3:
+      base_feat = self._fixed_base_feat(im_data)
+    else:
+      base_feat = im_data
+    # hand over to the trainable blocks as a fresh leaf
+    base_feat = Variable(base_feat.data, volatile=im_data.volatile)
+    for m in list(self.RCNN_base)[len(self._fixed_base_modules()) - 1:]:
+      base_feat = m(base_feat)
+    return base_feat
+
   def _head_to_tail(self, pool5):
 
     fc71 = self.RCNN_top(pool5)
@@ -361,10 +385,12 @@ class resnet(_fasterRCNN):
   def normal_prn_network(self,normal_data):
     '''
     the Predictor-head Remodeling Network (PRN)
-    :param normal_data:
+    :param normal_data: one image, or a batch of them
     :return attention vectors:
     '''
-    meta_feat = self.normal_meta_conv4(normal_data.unsqueeze(0))
+    if normal_data.dim() == 3:
+      normal_data = normal_data.unsqueeze(0)
+    meta_feat = self.normal_meta_conv4(normal_data)
     base_feat = self.RCNN_base(meta_feat)
     maxpool_feat = self.max_pooled(base_feat)
     feature = self._head_to_tail(maxpool_feat)
@@ -34,6 +34,104 @@ def nms_cpu(dets, thresh):
     return torch.IntTensor(keep)
 
 
+def _suppression_mask(boxes, areas, labels, rows, col_start, col_end, thresh, buffers):
+    """Bitmask of the boxes in [col_start, col_end) suppressed by each of the
+    given rows, same layout as the mask built by nms_kernel in nms_kernel.cu
+    but with 8 boxes per byte. With labels, only boxes of the same label
+    suppress each other.
+    """
+    x1, y1, x2, y2 = boxes
+    cols = slice(col_start, col_end)
+    shape = (rows.shape[0], col_end - col_start)
+    w, h, union, suppress = [buf[:shape[0], :shape[1]] for buf in buffers]
+
+    np.minimum(x2[rows, None], x2[None, cols], out=w)
+    w -= np.maximum(x1[rows, None], x1[None, cols])
+    w += 1
+    np.maximum(w, 0.0, out=w)
+    np.minimum(y2[rows, None], y2[None, cols], out=h)
+    h -= np.maximum(y1[rows, None], y1[None, cols])
+    h += 1
+    np.maximum(h, 0.0, out=h)
+    # w now holds the intersection
+    w *= h
+    np.add(areas[rows, None], areas[None, cols], out=union)
+    union -= w
+    np.divide(w, union, out=w)
+    np.greater(w, thresh, out=suppress)
+    # labels are sorted, a block within a single label needs no comparison
+    if labels is not None and labels[min(rows[0], col_start)] != labels[max(rows[-1], col_end - 1)]:
+        suppress &= labels[rows, None] == labels[None, cols]
+
+    # a box never suppresses itself or the boxes ranked above it
+    diag = min(shape[1], rows[-1] - col_start + 1)
+    if diag > 0:
+        suppress[:, :diag] &= np.arange(col_start, col_start + diag)[None, :] > rows[:, None]
+    return np.packbits(suppress, axis=1)
+
+
+def nms_cpu_bitmask(dets, thresh, tile_size=128, labels=None):
+    """NMS over tiles of tile_size boxes in score order, with the overlaps
+    packed into bitmasks.
+
+    The keep set of a tile is resolved in one pass over its diagonal block
+    of the IoU matrix, only the boxes it keeps then have their overlaps with
+    the later boxes computed, and their masks are merged at once. Boxes
+    already suppressed by earlier tiles are skipped. Gives the same keep
+    list as nms_cpu.
+
+    If labels (one integer per box) are given, boxes are only suppressed by
+    boxes with the same label, as if nms_cpu ran once per label. Boxes are
+    then grouped by label so a tile never looks past its last label.
+    """
+    assert tile_size % 8 == 0, 'tiles have to start on a byte of the mask'
+    dets = dets.cpu().numpy()
+    scores = dets[:, 4]
+    order = scores.argsort()[::-1]
+    num_boxes = order.shape[0]
+    if labels is not None:
+        labels = labels.cpu().numpy()
+        order = order[np.argsort(labels[order], kind='mergesort')]
+        labels = labels[order]
+        label_end = np.searchsorted(labels, labels, side='right')
+    boxes = [np.ascontiguousarray(dets[order, k]) for k in range(4)]
+    areas = (boxes[2] - boxes[0] + 1) * (boxes[3] - boxes[1] + 1)
+
+    # scratch buffers, reused by every tile
+    buffers = [np.empty((tile_size, num_boxes), dtype=dets.dtype) for _ in range(3)]
+    buffers.append(np.empty((tile_size, num_boxes), dtype=np.bool_))
+
+    removed = np.zeros((num_boxes + 7) // 8, dtype=np.uint8)
+    keep = []
+    for start in range(0, num_boxes, tile_size):
+        end = min(start + tile_size, num_boxes)
+        tile_bytes = slice(start // 8, (end + 7) // 8)
+        rows = np.arange(start, end)
+        rows = rows[np.unpackbits(removed[tile_bytes])[:end - start] == 0]
+        if rows.shape[0] == 0:
+            continue
+
+        diag_mask = _suppression_mask(boxes, areas, labels, rows, start, end, thresh, buffers)
+        tile_removed = removed[tile_bytes]
+        tile_keep = []
+        for i, mask_row in zip(rows, diag_mask):
+            offset = i - start
+            if not tile_removed[offset >> 3] & (128 >> (offset & 7)):
+                tile_keep.append(i)
+                tile_removed |= mask_row
+        keep.extend(tile_keep)
+
+        col_end = num_boxes if labels is None else label_end[tile_keep[-1]]
+        if end < col_end:
+            mask = _suppression_mask(boxes, areas, labels, np.array(tile_keep), end, col_end, thresh, buffers)
+            mask = np.bitwise_or.reduce(mask, axis=0)
+            removed[end // 8:end // 8 + mask.shape[0]] |= mask
+
+    keep = order[keep]
+    if labels is not None:
+        # back to score order over all labels
+        keep = keep[np.argsort(-scores[keep], kind='mergesort')]
+    return torch.from_numpy(keep.astype(np.int32))
 
 
 def nms_cpu_np(dets, thresh):
@@ -67,7 +165,7 @@ def nms_cpu_np(dets, thresh):
 
 
 
-def soft_nms_cpu(dets, threshold=0.001, Nt=0.3, method=1):
+def soft_nms_cpu(dets, threshold=0.001, Nt=0.3, method=1, sigma=0.5):
     boxes = dets.cpu().numpy()
     N = dets.shape[0]
     pos = 0
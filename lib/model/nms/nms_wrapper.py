@@ -6,16 +6,124 @@
 # --------------------------------------------------------
 import torch
 from model.utils.config import cfg
-if torch.cuda.is_available():
+try:
     from model.nms.nms_gpu import nms_gpu
-from model.nms.nms_cpu import nms_cpu
+except ImportError:
+    # the CUDA extension is not built, only the CPU engine is available
+    nms_gpu = None
+from model.nms.nms_cpu import nms_cpu_bitmask
+from model.nms.soft_nms import soft_nms
 
-def nms(dets, thresh, force_cpu=False):
-    """Dispatch to either CPU or GPU NMS implementations."""
+def nms(dets, thresh, force_cpu=False, labels=None):
+    """Dispatch to either CPU or GPU NMS implementations.
+
+    With labels, boxes only suppress boxes with the same label. The CUDA
+    kernel has no notion of labels, so there the boxes of each label are
+    shifted by the label times the coordinate range and never overlap.
+    """
     if dets.shape[0] == 0:
         return []
     # ---numpy version---
     # original: return gpu_nms(dets, thresh, device_id=cfg.GPU_ID)
     # ---pytorch version---
 
-    return nms_gpu(dets, thresh) if force_cpu == False else nms_cpu(dets, thresh)
+    if force_cpu or not dets.is_cuda or nms_gpu is None:
+        keep = nms_cpu_bitmask(dets, thresh, labels=labels)
+        return keep.cuda(dets.get_device()) if dets.is_cuda else keep
+    if labels is not None:
+        boxes = dets[:, :4]
+        offsets = labels.type_as(dets) * (boxes.max() - boxes.min() + 1)
+        dets = torch.cat((boxes + offsets.unsqueeze(1), dets[:, 4:5]), 1)
+    return nms_gpu(dets, thresh)
+
+def nms_by_image(dets, thresh, image_inds, num_images):
+    """NMS of the boxes of several images, a box only suppresses boxes of
+    its own image. dets are grouped image by image and sorted by score
+    within each image. Returns the kept indices in index order.
+
+    The CPU bitmask engine takes all images in one labelled call. The CUDA
+    kernel builds a mask quadratic in the number of boxes it is given and
+    scans it on the host, so there the images still go one call each.
+    """
+    if dets.shape[0] == 0:
+        return []
+    if not dets.is_cuda or nms_gpu is None:
+        keep = nms(dets, thresh, labels=image_inds)
+    else:
+        keep = []
+        for i in range(num_images):
+            inds_i = torch.nonzero(image_inds == i).view(-1)
+            if inds_i.numel() == 0:
+                continue
+            keep_i = nms_gpu(dets[inds_i].contiguous(), thresh)
+            if keep_i.numel() > 0:
+                keep.append(inds_i[keep_i.long().view(-1)])
+        if len(keep) == 0:
+            return []
+        keep = torch.cat(keep, 0)
+    keep, _ = torch.sort(keep.long().view(-1))
+    return keep
+
+def multiclass_nms(pred_boxes, scores, score_thresh, nms_thresh, max_per_image=0, class_agnostic=False,
+                   mode='nms'):
+    """Per-class NMS of all classes of one image with a single nms call,
+    labelled by class, which keeps the same boxes as running it class by
+    class. The top max_per_image detections over all classes are then
+    selected the same way test.py did, ties at the cut are kept.
+
+    With mode 'soft_nms', soft_nms with the cfg.TEST.SOFT_NMS_* settings is
+    used instead, stopping after max_per_image boxes, and the returned
+    scores are the decayed ones.
+
+    pred_boxes is num_rois x 4 (class agnostic) or num_rois x 4 * num_classes,
+    scores is num_rois x num_classes with the background in column 0.
+    Returns a list of num_classes detection tensors (x1, y1, x2, y2, score),
+    sorted by score, None for the background and classes without detections.
+    """
+    num_classes = scores.size(1)
+    cls_dets = [None for _ in range(num_classes)]
+
+    inds = torch.nonzero(scores[:, 1:] > score_thresh)
+    if inds.numel() == 0:
+        return cls_dets
+    roi_inds = inds[:, 0]
+    cls_inds = inds[:, 1] + 1
+
+    cls_scores = scores.contiguous().view(-1)[roi_inds * num_classes + cls_inds]
+    if class_agnostic:
+        cls_boxes = pred_boxes.contiguous().view(-1, 4)[roi_inds]
+    else:
+        cls_boxes = pred_boxes.contiguous().view(-1, 4)[roi_inds * num_classes + cls_inds]
+
+    # the CUDA kernel expects boxes sorted by score
+    _, order = torch.sort(cls_scores, 0, True)
+    cls_scores = cls_scores[order]
+    cls_boxes = cls_boxes[order]
+    cls_inds = cls_inds[order]
+
+    dets = torch.cat((cls_boxes, cls_scores.unsqueeze(1)), 1)
+    if mode == 'soft_nms':
+        keep, cls_scores = soft_nms(dets, nms_thresh, method=cfg.TEST.SOFT_NMS_METHOD,
+                                    sigma=cfg.TEST.SOFT_NMS_SIGMA, min_score=cfg.TEST.SOFT_NMS_MIN_SCORE,
+                                    max_keep=max_per_image, labels=cls_inds)
+        if keep.numel() == 0:
+            return cls_dets
+    else:
+        keep = nms(dets, nms_thresh, labels=cls_inds).long().view(-1)
+        cls_scores = cls_scores[keep]
+    # keep is in score order
+
+    # Limit to max_per_image detections *over all classes*
+    if max_per_image > 0 and keep.numel() > max_per_image:
+        image_thresh = cls_scores[max_per_image - 1]
+        top = torch.nonzero(cls_scores >= image_thresh).view(-1)
+        keep = keep[top]
+        cls_scores = cls_scores[top]
+
+    dets = torch.cat((cls_boxes[keep], cls_scores.unsqueeze(1)), 1)
+    cls_inds = cls_inds[keep]
+    for j in range(1, num_classes):
+        inds = torch.nonzero(cls_inds == j).view(-1)
+        if inds.numel() > 0:
+            cls_dets[j] = dets[inds]
+    return cls_dets
@@ -0,0 +1,69 @@
+from __future__ import absolute_import
+
+import torch
+
+
+def soft_nms(dets, thresh, method='linear', sigma=0.5, min_score=0.001, max_keep=0, labels=None):
+    """Soft-NMS (Bodla et al. 2017) on tensors, on the device of dets.
+
+    Repeatedly takes the highest scoring box left and decays the scores of
+    the boxes overlapping it, by (1 - IoU) above thresh for 'linear' or by
+    exp(-IoU^2 / sigma) for 'gaussian'. Boxes whose score drops below
+    min_score are discarded. Every step is one pass of tensor ops over all
+    boxes instead of a python loop over them.
+
+    The picked scores never increase, so the first max_keep picks are the
+    top max_keep boxes after decay and the loop stops there (0 keeps all).
+    With labels, boxes only decay boxes with the same label.
+
+    Returns the indices of the kept boxes in dets, in decreasing order of
+    their decayed scores, and these scores.
+    """
+    assert method in ('linear', 'gaussian'), 'unknown soft-NMS method {}'.format(method)
+    num_boxes = dets.size(0)
+    if max_keep <= 0 or max_keep > num_boxes:
+        max_keep = num_boxes
+
+    x1 = dets[:, 0]
+    y1 = dets[:, 1]
+    x2 = dets[:, 2]
+    y2 = dets[:, 3]
+    areas = (x2 - x1 + 1) * (y2 - y1 + 1)
+    # picked and discarded boxes are set to -1
+    scores = dets[:, 4].clone()
+    scores.masked_fill_(scores < min_score, -1)
+
+    keep = []
+    keep_scores = []
+    while len(keep) < max_keep:
+        max_score, i = torch.max(scores, 0)
+        max_score, i = float(max_score), int(i)
+        if max_score < 0:
+            break
+        keep.append(i)
+        keep_scores.append(max_score)
+        scores[i] = -1
+
+        bx1, by1, bx2, by2 = [float(v) for v in dets[i, :4]]
+        w = (x2.clamp(max=bx2) - x1.clamp(min=bx1) + 1).clamp(min=0)
+        h = (y2.clamp(max=by2) - y1.clamp(min=by1) + 1).clamp(min=0)
+        inter = w * h
+        ovr = inter / (float(areas[i]) + areas - inter)
+        if labels is not None:
+            ovr.masked_fill_(labels != int(labels[i]), 0)
+
+        if method == 'linear':
+            weight = 1 - ovr
+            weight.masked_fill_(ovr <= thresh, 1)
+        else:
+            weight = torch.exp(ovr * ovr / -sigma)
+        # -1 stays negative
+        scores.mul_(weight)
+        scores.masked_fill_(scores < min_score, -1)
+
+    keep = torch.LongTensor(keep)
+    keep_scores = torch.FloatTensor(keep_scores)
+    if dets.is_cuda:
+        keep = keep.cuda(dets.get_device())
+        keep_scores = keep_scores.cuda(dets.get_device())
+    return keep, keep_scores.type_as(dets)
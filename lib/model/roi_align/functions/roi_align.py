@@ -1,6 +1,93 @@
 import torch
 from torch.autograd import Function
-from .._ext import roi_align
+try:
+    from .._ext import roi_align
+except ImportError:
+    # lib/make.sh has not been run, fall back to the pure tensor version below
+    roi_align = None
+
+
+def _roi_align_sample_points(rois, data_height, data_width,
+                             aligned_height, aligned_width, spatial_scale):
+    """Bilinear sampling points of every bin of every roi.
+
+    Follows ROIAlignForward in src/roi_align_kernel.cu. Returns the four
+    corner indices into a (batch * height * width) flattened feature map and
+    their interpolation weights, both of size (num_rois * aligned_height *
+    aligned_width, 4). Points falling outside the feature map get zero weight.
+    """
+    num_rois = rois.size(0)
+    batch_inds = rois[:, 0].long()
+    roi_start_w = rois[:, 1] * spatial_scale
+    roi_start_h = rois[:, 2] * spatial_scale
+    roi_end_w = rois[:, 3] * spatial_scale
+    roi_end_h = rois[:, 4] * spatial_scale
+
+    # Force malformed ROIs to be 1x1
+    roi_width = (roi_end_w - roi_start_w + 1.).clamp(min=0)
+    roi_height = (roi_end_h - roi_start_h + 1.).clamp(min=0)
+    bin_size_h = roi_height / (aligned_height - 1.)
+    bin_size_w = roi_width / (aligned_width - 1.)
+
+    ph = torch.arange(0, aligned_height).type_as(rois)
+    pw = torch.arange(0, aligned_width).type_as(rois)
+    # num_rois x aligned_height x aligned_width
+    h = (ph.view(1, -1) * bin_size_h.view(-1, 1) + roi_start_h.view(-1, 1)) \
+        .view(num_rois, aligned_height, 1).expand(num_rois, aligned_height, aligned_width)
+    w = (pw.view(1, -1) * bin_size_w.view(-1, 1) + roi_start_w.view(-1, 1)) \
+        .view(num_rois, 1, aligned_width).expand(num_rois, aligned_height, aligned_width)
+
+    hstart = torch.floor(h).clamp(max=data_height - 2)
+    wstart = torch.floor(w).clamp(max=data_width - 2)
+    h_ratio = h - hstart
+    w_ratio = w - wstart
+
+    inside = ((h >= 0) & (h < data_height) & (w >= 0) & (w < data_width)).type_as(rois)
+
+    hstart = hstart.long().clamp(min=0)
+    wstart = wstart.long().clamp(min=0)
+    img_start = (batch_inds * data_height * data_width).view(-1, 1, 1)
+    upleft = img_start + hstart * data_width + wstart
+    indices = torch.stack([upleft, upleft + 1,
+                           upleft + data_width, upleft + data_width + 1], 3)
+    weights = torch.stack([(1. - h_ratio) * (1. - w_ratio),
+                           (1. - h_ratio) * w_ratio,
+                           h_ratio * (1. - w_ratio),
+                           h_ratio * w_ratio], 3) * inside.unsqueeze(3)
+
+    return indices.view(-1, 4), weights.view(-1, 4)
+
+
+def roi_align_forward_pytorch(aligned_height, aligned_width, spatial_scale, features, rois):
+    """RoIAlign forward as batched tensor ops over all rois and bins."""
+    batch_size, num_channels, data_height, data_width = features.size()
+    num_rois = rois.size(0)
+
+    indices, weights = _roi_align_sample_points(rois, data_height, data_width,
+                                                aligned_height, aligned_width, spatial_scale)
+    # channels last, so that every sampling point gathers one contiguous row
+    flat = features.permute(0, 2, 3, 1).contiguous().view(-1, num_channels)
+    output = torch.index_select(flat, 0, indices[:, 0]).mul_(weights[:, 0:1])
+    for k in range(1, 4):
+        output.add_(torch.index_select(flat, 0, indices[:, k]).mul_(weights[:, k:k + 1]))
+
+    output = output.view(num_rois, aligned_height, aligned_width, num_channels)
+    return output.permute(0, 3, 1, 2).contiguous()
+
+
+def roi_align_backward_pytorch(aligned_height, aligned_width, spatial_scale, grad_output, rois, feature_size):
+    """RoIAlign backward, scatters grad_output through the bilinear weights."""
+    batch_size, num_channels, data_height, data_width = feature_size
+
+    indices, weights = _roi_align_sample_points(rois, data_height, data_width,
+                                                aligned_height, aligned_width, spatial_scale)
+    grad = grad_output.permute(0, 2, 3, 1).contiguous().view(-1, num_channels)
+    grad_input = grad_output.new(batch_size * data_height * data_width, num_channels).zero_()
+    for k in range(4):
+        grad_input.index_add_(0, indices[:, k], grad * weights[:, k:k + 1])
+
+    grad_input = grad_input.view(batch_size, data_height, data_width, num_channels)
+    return grad_input.permute(0, 3, 1, 2).contiguous()
 
 
 # TODO use save_for_backward instead
@@ -19,19 +106,26 @@ class RoIAlignFunction(Function):
         batch_size, num_channels, data_height, data_width = features.size()
         num_rois = rois.size(0)
 
+        if not features.is_cuda or roi_align is None:
+            return roi_align_forward_pytorch(self.aligned_height, self.aligned_width,
+                                             self.spatial_scale, features, rois)
+
         output = features.new(num_rois, num_channels, self.aligned_height, self.aligned_width).zero_()
-        if features.is_cuda:
-            roi_align.roi_align_forward_cuda(self.aligned_height,
-                                             self.aligned_width,
-                                             self.spatial_scale, features,
-                                             rois, output)
-        else:
-            raise NotImplementedError
+        roi_align.roi_align_forward_cuda(self.aligned_height,
+                                         self.aligned_width,
+                                         self.spatial_scale, features,
+                                         rois, output)
 
         return output
 
     def backward(self, grad_output):
-        assert(self.feature_size is not None and grad_output.is_cuda)
+        assert(self.feature_size is not None)
+
+        if not grad_output.is_cuda or roi_align is None:
+            grad_input = roi_align_backward_pytorch(self.aligned_height, self.aligned_width,
+                                                    self.spatial_scale, grad_output.contiguous(),
+                                                    self.rois, self.feature_size)
+            return grad_input, None
 
         batch_size, num_channels, data_height, data_width = self.feature_size
 
@@ -1,7 +1,11 @@
 # functions/add.py
 import torch
 from torch.autograd import Function
-from .._ext import roi_crop
+try:
+    from .._ext import roi_crop
+except ImportError:
+    # only needed for POOLING_MODE == 'crop', which requires lib/make.sh
+    roi_crop = None
 import pdb
 
 class RoICropFunction(Function):
@@ -1,8 +1,119 @@
 import torch
 from torch.autograd import Function
-from .._ext import roi_pooling
+try:
+    from .._ext import roi_pooling
+except ImportError:
+    # lib/make.sh has not been run, fall back to the pure tensor version below
+    roi_pooling = None
 import pdb
 
+
+def _round(x):
+    """C round(), halfway cases away from zero."""
+    return torch.sign(x) * torch.floor(torch.abs(x) + 0.5)
+
+
+def roi_pool_forward_pytorch(pooled_height, pooled_width, spatial_scale, features, rois):
+    """RoI max pooling as batched tensor ops, follows ROIPoolForward in
+    src/roi_pooling_kernel.cu.
+
+    Instead of looping over rois, every bin of every roi is visited at the
+    same window offset in one step, so the python loop only runs over the
+    largest bin size. Returns the pooled output and the argmax as flat
+    indices into features, -1 for empty bins.
+    """
+    batch_size, num_channels, data_height, data_width = features.size()
+    num_rois = rois.size(0)
+
+    batch_inds = rois[:, 0].long()
+    roi_start_w = _round(rois[:, 1] * spatial_scale)
+    roi_start_h = _round(rois[:, 2] * spatial_scale)
+    roi_end_w = _round(rois[:, 3] * spatial_scale)
+    roi_end_h = _round(rois[:, 4] * spatial_scale)
+
+    # Force malformed ROIs to be 1x1
+    roi_width = (roi_end_w - roi_start_w + 1).clamp(min=1)
+    roi_height = (roi_end_h - roi_start_h + 1).clamp(min=1)
+    bin_size_h = roi_height / pooled_height
+    bin_size_w = roi_width / pooled_width
+
+    ph = torch.arange(0, pooled_height).type_as(rois).view(1, -1)
+    pw = torch.arange(0, pooled_width).type_as(rois).view(1, -1)
+    # num_rois x pooled_height, num_rois x pooled_width
+    hstart = (torch.floor(ph * bin_size_h.view(-1, 1)) + roi_start_h.view(-1, 1)).clamp(0, data_height).long()
+    hend = (torch.ceil((ph + 1) * bin_size_h.view(-1, 1)) + roi_start_h.view(-1, 1)).clamp(0, data_height).long()
+    wstart = (torch.floor(pw * bin_size_w.view(-1, 1)) + roi_start_w.view(-1, 1)).clamp(0, data_width).long()
+    wend = (torch.ceil((pw + 1) * bin_size_w.view(-1, 1)) + roi_start_w.view(-1, 1)).clamp(0, data_width).long()
+
+    max_bin_h = int((hend - hstart).max()) if num_rois > 0 else 0
+    max_bin_w = int((wend - wstart).max()) if num_rois > 0 else 0
+
+    num_bins = num_rois * pooled_height * pooled_width
+    img_start = (batch_inds * data_height * data_width).view(-1, 1, 1)
+    # the extra -inf row at the end is what invalid window positions read
+    sentinel = batch_size * data_height * data_width
+    flat = torch.cat([features.permute(0, 2, 3, 1).contiguous().view(-1, num_channels),
+                      features.new(1, num_channels).fill_(-float('inf'))], 0)
+    output = features.new(num_bins, num_channels).fill_(-float('inf'))
+    # window offset of the max, 1-based so that 0 marks an empty bin. Offsets
+    # only grow along the loop, so a plain max keeps the latest update.
+    if max_bin_h * max_bin_w < 256:
+        offset = torch.ByteTensor(num_bins, num_channels).zero_()
+    else:
+        offset = torch.IntTensor(num_bins, num_channels).zero_()
+    if features.is_cuda:
+        offset = offset.cuda(features.get_device())
+
+    for dh in range(max_bin_h):
+        h = hstart + dh
+        valid_h = h < hend
+        for dw in range(max_bin_w):
+            w = wstart + dw
+            valid_w = w < wend
+            # num_rois x pooled_height x pooled_width
+            valid = (valid_h.view(num_rois, pooled_height, 1).expand(num_rois, pooled_height, pooled_width) &
+                     valid_w.view(num_rois, 1, pooled_width).expand(num_rois, pooled_height, pooled_width))
+            index = img_start + h.view(num_rois, pooled_height, 1) * data_width + w.view(num_rois, 1, pooled_width)
+            index = index.masked_fill_(valid == 0, sentinel)
+            values = torch.index_select(flat, 0, index.view(-1))
+            # strict comparison keeps the first max in row-major order, as the kernel does
+            update = (values > output).type_as(offset).mul_(dh * max_bin_w + dw + 1)
+            torch.max(offset, update, out=offset)
+            torch.max(output, values, out=output)
+
+    # Define an empty pooling region to be zero
+    empty = offset == 0
+    output.masked_fill_(empty, 0)
+
+    # window offset to the flat (n, c, h, w) index used by the CUDA kernel
+    offset = (offset.long() - 1).clamp(min=0)
+    bin_hstart = hstart.view(num_rois, pooled_height, 1).expand(num_rois, pooled_height, pooled_width)
+    bin_wstart = wstart.view(num_rois, 1, pooled_width).expand(num_rois, pooled_height, pooled_width)
+    bin_start = (img_start * num_channels + bin_hstart * data_width + bin_wstart).contiguous().view(-1, 1)
+    channel_start = torch.arange(0, num_channels).type_as(bin_start).view(1, -1) * data_height * data_width
+    offset_w = offset % max(max_bin_w, 1)
+    offset_h = ((offset - offset_w) / max(max_bin_w, 1)).long()
+    argmax = bin_start + channel_start + offset_h * data_width + offset_w
+    argmax.masked_fill_(empty, -1)
+
+    output = output.view(num_rois, pooled_height, pooled_width, num_channels).permute(0, 3, 1, 2).contiguous()
+    argmax = argmax.view(num_rois, pooled_height, pooled_width, num_channels).permute(0, 3, 1, 2).contiguous()
+    return output, argmax.int()
+
+
+def roi_pool_backward_pytorch(grad_output, argmax, feature_size):
+    """RoI max pooling backward, scatters grad_output through the argmax."""
+    batch_size, num_channels, data_height, data_width = feature_size
+    grad_input = grad_output.new(batch_size * num_channels * data_height * data_width).zero_()
+
+    argmax = argmax.contiguous().view(-1)
+    pooled = argmax >= 0
+    if pooled.any():
+        grad_input.index_add_(0, argmax[pooled].long(), grad_output.contiguous().view(-1)[pooled])
+
+    return grad_input.view(batch_size, num_channels, data_height, data_width)
+
+
 class RoIPoolFunction(Function):
     def __init__(ctx, pooled_height, pooled_width, spatial_scale):
         ctx.pooled_width = pooled_width
@@ -10,25 +121,28 @@ class RoIPoolFunction(Function):
         ctx.spatial_scale = spatial_scale
         ctx.feature_size = None
 
-    def forward(ctx, features, rois): 
-        ctx.feature_size = features.size()           
+    def forward(ctx, features, rois):
+        ctx.feature_size = features.size()
         batch_size, num_channels, data_height, data_width = ctx.feature_size
         num_rois = rois.size(0)
+        ctx.rois = rois
+        if not features.is_cuda or roi_pooling is None:
+            output, ctx.argmax = roi_pool_forward_pytorch(ctx.pooled_height, ctx.pooled_width,
+                                                          ctx.spatial_scale, features, rois)
+            return output
+
         output = features.new(num_rois, num_channels, ctx.pooled_height, ctx.pooled_width).zero_()
         ctx.argmax = features.new(num_rois, num_channels, ctx.pooled_height, ctx.pooled_width).zero_().int()
-        ctx.rois = rois
-        if not features.is_cuda:
-            _features = features.permute(0, 2, 3, 1)
-            roi_pooling.roi_pooling_forward(ctx.pooled_height, ctx.pooled_width, ctx.spatial_scale,
-                                            _features, rois, output)
-        else:
-            roi_pooling.roi_pooling_forward_cuda(ctx.pooled_height, ctx.pooled_width, ctx.spatial_scale,
-                                                 features, rois, output, ctx.argmax)
+        roi_pooling.roi_pooling_forward_cuda(ctx.pooled_height, ctx.pooled_width, ctx.spatial_scale,
+                                             features, rois, output, ctx.argmax)
 
         return output
 
     def backward(ctx, grad_output):
-        assert(ctx.feature_size is not None and grad_output.is_cuda)
+        assert(ctx.feature_size is not None)
+        if not grad_output.is_cuda or roi_pooling is None:
+            return roi_pool_backward_pytorch(grad_output, ctx.argmax, ctx.feature_size), None
+
         batch_size, num_channels, data_height, data_width = ctx.feature_size
         grad_input = grad_output.new(batch_size, num_channels, data_height, data_width).zero_()
 
@@ -0,0 +1,58 @@
+from __future__ import absolute_import
+# --------------------------------------------------------
+# Anchors of every position of a feature map, cached per map shape
+# --------------------------------------------------------
+
+import torch
+import numpy as np
+from collections import OrderedDict
+
+from .generate_anchors import generate_anchors
+
+
+class AnchorGrid(object):
+    """
+    Shifts the A base anchors to all K positions of a feature map. The
+    (K*A, 4) result only depends on the map size, the stride and where it
+    lives, so it is built once per (feat_height, feat_width, feat_stride,
+    device, type) and kept in a small LRU cache. One grid is shared by the
+    proposal and the anchor target layer of an RPN.
+
+    The returned tensor is shared between calls and must not be modified in
+    place.
+    """
+
+    def __init__(self, scales, ratios, max_grids=8):
+        self._base_anchors = torch.from_numpy(generate_anchors(scales=np.array(scales),
+            ratios=np.array(ratios))).float()
+        self.num_anchors = self._base_anchors.size(0)
+        self.max_grids = max_grids
+        self._grids = OrderedDict()
+
+    def __call__(self, feat_height, feat_width, feat_stride, like):
+        """Anchors (K*A, 4) of a feat_height x feat_width map, same type and
+        device as the tensor like."""
+        device = like.get_device() if like.is_cuda else -1
+        key = (feat_height, feat_width, feat_stride, device, like.type())
+
+        anchors = self._grids.pop(key, None)
+        if anchors is None:
+            anchors = self._make_grid(feat_height, feat_width, feat_stride).type_as(like)
+            if len(self._grids) >= self.max_grids:
+                # drop the least recently used
+                self._grids.popitem(last=False)
+        self._grids[key] = anchors
+        return anchors
+
+    def _make_grid(self, feat_height, feat_width, feat_stride):
+        shift_x = torch.arange(0, feat_width).float() * feat_stride
+        shift_y = torch.arange(0, feat_height).float() * feat_stride
+        # row-major over (y, x), as np.meshgrid(shift_x, shift_y) ravels
+        shift_x = shift_x.view(1, -1).expand(feat_height, feat_width).contiguous().view(-1)
+        shift_y = shift_y.view(-1, 1).expand(feat_height, feat_width).contiguous().view(-1)
+        shifts = torch.stack((shift_x, shift_y, shift_x, shift_y), 1)
+
+        A = self.num_anchors
+        K = shifts.size(0)
+        anchors = self._base_anchors.view(1, A, 4) + shifts.view(K, 1, 4)
+        return anchors.view(K * A, 4).contiguous()
@@ -15,7 +15,7 @@ import numpy as np
 import numpy.random as npr
 
 from model.utils.config import cfg
-from .generate_anchors import generate_anchors
+from .anchor_grid import AnchorGrid
 from .bbox_transform import clip_boxes, bbox_overlaps_batch, bbox_transform_batch
 
 import pdb
@@ -33,18 +33,22 @@ class _AnchorTargetLayer(nn.Module):
         Assign anchors to ground-truth targets. Produces anchor classification
         labels and bounding-box regression targets.
     """
-    def __init__(self, feat_stride, scales, ratios):
+    def __init__(self, feat_stride, scales, ratios, anchor_grid=None):
         super(_AnchorTargetLayer, self).__init__()
 
         self._feat_stride = feat_stride
         self._scales = scales
-        anchor_scales = scales
-        self._anchors = torch.from_numpy(generate_anchors(scales=np.array(anchor_scales), ratios=np.array(ratios))).float()
-        self._num_anchors = self._anchors.size(0)
+        if anchor_grid is None:
+            anchor_grid = AnchorGrid(scales, ratios)
+        self._anchor_grid = anchor_grid
+        self._num_anchors = anchor_grid.num_anchors
 
         # allow boxes to sit over the edge by a small amount
         self._allowed_border = 0  # default is 0
 
+        # outputs per feature map shape, see _output_buffers
+        self._output_cache = {}
+
     def forward(self, input):
         # Algorithm:
         #
@@ -64,21 +68,11 @@ class _AnchorTargetLayer(nn.Module):
         batch_size = gt_boxes.size(0)
 
         feat_height, feat_width = rpn_cls_score.size(2), rpn_cls_score.size(3)
-        shift_x = np.arange(0, feat_width) * self._feat_stride
-        shift_y = np.arange(0, feat_height) * self._feat_stride
-        shift_x, shift_y = np.meshgrid(shift_x, shift_y)
-        shifts = torch.from_numpy(np.vstack((shift_x.ravel(), shift_y.ravel(),
-                                  shift_x.ravel(), shift_y.ravel())).transpose())
-        shifts = shifts.contiguous().type_as(rpn_cls_score).float()
+        # shared with the proposal layer, not to be modified in place
+        all_anchors = self._anchor_grid(feat_height, feat_width, self._feat_stride, gt_boxes)
 
         A = self._num_anchors
-        K = shifts.size(0)
-
-        self._anchors = self._anchors.type_as(gt_boxes) # move to specific gpu.
-        all_anchors = self._anchors.view(1, A, 4) + shifts.view(K, 1, 4)
-        all_anchors = all_anchors.view(K * A, 4)
-
-        total_anchors = int(K * A)
+        total_anchors = all_anchors.size(0)
 
         keep = ((all_anchors[:, 0] >= -self._allowed_border) &
                 (all_anchors[:, 1] >= -self._allowed_border) &
@@ -95,53 +89,39 @@ class _AnchorTargetLayer(nn.Module):
         bbox_inside_weights = gt_boxes.new(batch_size, inds_inside.size(0)).zero_()
         bbox_outside_weights = gt_boxes.new(batch_size, inds_inside.size(0)).zero_()
 
-        overlaps = bbox_overlaps_batch(anchors, gt_boxes)
+        overlaps = bbox_overlaps_batch(anchors, gt_boxes, num_boxes)
 
         max_overlaps, argmax_overlaps = torch.max(overlaps, 2)
-        gt_max_overlaps, _ = torch.max(overlaps, 1)
+        # the padded gt columns past the largest num_boxes never match below
+        gt_overlaps = overlaps[:, :, :max(int(num_boxes.max()), 1)]
+        gt_max_overlaps, _ = torch.max(gt_overlaps, 1)
 
         if not cfg.TRAIN.RPN_CLOBBER_POSITIVES:
-            labels[max_overlaps < cfg.TRAIN.RPN_NEGATIVE_OVERLAP] = 0
+            labels.masked_fill_(max_overlaps < cfg.TRAIN.RPN_NEGATIVE_OVERLAP, 0)
 
         gt_max_overlaps[gt_max_overlaps==0] = 1e-5
-        keep = torch.sum(overlaps.eq(gt_max_overlaps.view(batch_size,1,-1).expand_as(overlaps)), 2)
+        keep = torch.sum(gt_overlaps.eq(gt_max_overlaps.view(batch_size,1,-1).expand_as(gt_overlaps)), 2)
 
         if torch.sum(keep) > 0:
-            labels[keep>0] = 1
+            labels.masked_fill_(keep > 0, 1)
 
         # fg label: above threshold IOU
-        labels[max_overlaps >= cfg.TRAIN.RPN_POSITIVE_OVERLAP] = 1
+        labels.masked_fill_(max_overlaps >= cfg.TRAIN.RPN_POSITIVE_OVERLAP, 1)
 
         if cfg.TRAIN.RPN_CLOBBER_POSITIVES:
-            labels[max_overlaps < cfg.TRAIN.RPN_NEGATIVE_OVERLAP] = 0
+            labels.masked_fill_(max_overlaps < cfg.TRAIN.RPN_NEGATIVE_OVERLAP, 0)
 
         num_fg = int(cfg.TRAIN.RPN_FG_FRACTION * cfg.TRAIN.RPN_BATCHSIZE)
 
-        sum_fg = torch.sum((labels == 1).int(), 1)
-        sum_bg = torch.sum((labels == 0).int(), 1)
-
-        for i in range(batch_size):
-            # subsample positive labels if we have too many
-            if sum_fg[i] > num_fg:
-                fg_inds = torch.nonzero(labels[i] == 1).view(-1)
-                # torch.randperm seems has a bug on multi-gpu setting that cause the segfault.
-                # See https://github.com/pytorch/pytorch/issues/1868 for more details.
-                # use numpy instead.
-                #rand_num = torch.randperm(fg_inds.size(0)).type_as(gt_boxes).long()
-                rand_num = torch.from_numpy(np.random.permutation(fg_inds.size(0))).type_as(gt_boxes).long()
-                disable_inds = fg_inds[rand_num[:fg_inds.size(0)-num_fg]]
-                labels[i][disable_inds] = -1
-
-            num_bg = cfg.TRAIN.RPN_BATCHSIZE - sum_fg[i]
+        sum_fg = torch.sum((labels == 1).long(), 1)
 
-            # subsample negative labels if we have too many
-            if sum_bg[i] > num_bg:
-                bg_inds = torch.nonzero(labels[i] == 0).view(-1)
-                #rand_num = torch.randperm(bg_inds.size(0)).type_as(gt_boxes).long()
+        # subsample positive labels if we have too many
+        labels = self._subsample(labels, 1, sum_fg.new(batch_size).fill_(num_fg))
 
-                rand_num = torch.from_numpy(np.random.permutation(bg_inds.size(0))).type_as(gt_boxes).long()
-                disable_inds = bg_inds[rand_num[:bg_inds.size(0)-num_bg]]
-                labels[i][disable_inds] = -1
+        # subsample negative labels if we have too many, counting the
+        # positives from before their subsampling
+        num_bg = cfg.TRAIN.RPN_BATCHSIZE - sum_fg
+        labels = self._subsample(labels, 0, num_bg)
 
         offset = torch.arange(0, batch_size)*gt_boxes.size(1)
 
@@ -149,48 +129,73 @@ class _AnchorTargetLayer(nn.Module):
         bbox_targets = _compute_targets_batch(anchors, gt_boxes.view(-1,5)[argmax_overlaps.view(-1), :].view(batch_size, -1, 5))
 
         # use a single value instead of 4 values for easy index.
-        bbox_inside_weights[labels==1] = cfg.TRAIN.RPN_BBOX_INSIDE_WEIGHTS[0]
+        bbox_inside_weights.masked_fill_(labels == 1, cfg.TRAIN.RPN_BBOX_INSIDE_WEIGHTS[0])
 
         if cfg.TRAIN.RPN_POSITIVE_WEIGHT < 0:
-            num_examples = torch.sum(labels[i] >= 0)
+            # the examples of the last image set the weights of all of them
+            num_examples = torch.sum(labels[batch_size - 1] >= 0)
             positive_weights = 1.0 / num_examples
             negative_weights = 1.0 / num_examples
         else:
             assert ((cfg.TRAIN.RPN_POSITIVE_WEIGHT > 0) &
                     (cfg.TRAIN.RPN_POSITIVE_WEIGHT < 1))
 
-        bbox_outside_weights[labels == 1] = positive_weights
-        bbox_outside_weights[labels == 0] = negative_weights
-
-        labels = _unmap(labels, total_anchors, inds_inside, batch_size, fill=-1)
-        bbox_targets = _unmap(bbox_targets, total_anchors, inds_inside, batch_size, fill=0)
-        bbox_inside_weights = _unmap(bbox_inside_weights, total_anchors, inds_inside, batch_size, fill=0)
-        bbox_outside_weights = _unmap(bbox_outside_weights, total_anchors, inds_inside, batch_size, fill=0)
-
-        outputs = []
-
-        labels = labels.view(batch_size, height, width, A).permute(0,3,1,2).contiguous()
-        labels = labels.view(batch_size, 1, A * height, width)
-        outputs.append(labels)
-
-        bbox_targets = bbox_targets.view(batch_size, height, width, A*4).permute(0,3,1,2).contiguous()
-        outputs.append(bbox_targets)
-
-        anchors_count = bbox_inside_weights.size(1)
-        bbox_inside_weights = bbox_inside_weights.view(batch_size,anchors_count,1).expand(batch_size, anchors_count, 4)
-
-        bbox_inside_weights = bbox_inside_weights.contiguous().view(batch_size, height, width, 4*A)\
-                            .permute(0,3,1,2).contiguous()
-
-        outputs.append(bbox_inside_weights)
-
-        bbox_outside_weights = bbox_outside_weights.view(batch_size,anchors_count,1).expand(batch_size, anchors_count, 4)
-        bbox_outside_weights = bbox_outside_weights.contiguous().view(batch_size, height, width, 4*A)\
-                            .permute(0,3,1,2).contiguous()
-        outputs.append(bbox_outside_weights)
+        bbox_outside_weights.masked_fill_(labels == 1, positive_weights)
+        bbox_outside_weights.masked_fill_(labels == 0, negative_weights)
+
+        # scatter the inside anchors, (K*A) ordered, straight into the
+        # (b, A, H, W) and (b, 4*A, H, W) outputs
+        labels_out, bbox_targets_out, bbox_inside_weights_out, bbox_outside_weights_out = \
+            self._output_buffers(batch_size, height, width, gt_boxes)
+        anchor_inds = inds_inside % A
+        position_inds = ((inds_inside - anchor_inds) / A).long()
+        inds = anchor_inds * (height * width) + position_inds
+        inds4 = ((anchor_inds * 4).view(-1, 1) + torch.arange(0, 4).type_as(inds).view(1, -1)) * (height * width) \
+                + position_inds.view(-1, 1)
+        inds4 = inds4.view(-1)
+
+        labels_out.fill_(-1).view(batch_size, -1).index_copy_(1, inds, labels)
+        bbox_targets_out.zero_().view(batch_size, -1).index_copy_(1, inds4, bbox_targets.view(batch_size, -1))
+        bbox_inside_weights = bbox_inside_weights.view(batch_size, -1, 1).expand(batch_size, inds.size(0), 4)
+        bbox_inside_weights_out.zero_().view(batch_size, -1).index_copy_(1, inds4, bbox_inside_weights.contiguous().view(batch_size, -1))
+        bbox_outside_weights = bbox_outside_weights.view(batch_size, -1, 1).expand(batch_size, inds.size(0), 4)
+        bbox_outside_weights_out.zero_().view(batch_size, -1).index_copy_(1, inds4, bbox_outside_weights.contiguous().view(batch_size, -1))
+
+        outputs = [labels_out, bbox_targets_out, bbox_inside_weights_out, bbox_outside_weights_out]
 
         return outputs
 
+    def _subsample(self, labels, label, num_keep):
+        """Keeps num_keep[i] random anchors of the given label in image i,
+        the largest of uniform random keys, and sets the others to -1."""
+        batch_size, num_anchors = labels.size()
+        max_keep = min(int(num_keep.max()), num_anchors)
+        is_label = labels == label
+        if max_keep <= 0:
+            return labels.masked_fill_(is_label, -1)
+
+        keys = labels.new(batch_size, num_anchors).uniform_()
+        keys.masked_fill_(is_label == 0, -1)
+        _, top = torch.topk(keys, max_keep, 1)
+        rank = torch.arange(0, max_keep).type_as(num_keep).view(1, -1)
+        keep = labels.new(batch_size, num_anchors).zero_()
+        keep.scatter_(1, top, (rank < num_keep.view(-1, 1)).type_as(keep))
+        return labels.masked_fill_(is_label & (keep == 0), -1)
+
+    def _output_buffers(self, batch_size, height, width, like):
+        """The four output tensors, allocated once per feature map shape and
+        reused by the following calls with that shape."""
+        key = (batch_size, height, width, like.get_device() if like.is_cuda else -1, like.type())
+        if key not in self._output_cache:
+            if len(self._output_cache) >= 4:
+                self._output_cache.clear()
+            A = self._num_anchors
+            self._output_cache[key] = (like.new(batch_size, 1, A * height, width),
+                                  like.new(batch_size, 4 * A, height, width),
+                                  like.new(batch_size, 4 * A, height, width),
+                                  like.new(batch_size, 4 * A, height, width))
+        return self._output_cache[key]
+
     def backward(self, top, propagate_down, bottom):
         """This layer does not propagate gradients."""
         pass
@@ -199,19 +204,6 @@ class _AnchorTargetLayer(nn.Module):
         """Reshaping happens during the call to forward."""
         pass
 
-def _unmap(data, count, inds, batch_size, fill=0):
-    """ Unmap a subset of item (data) back to the original set of items (of
-    size count) """
-
-    if data.dim() == 2:
-        ret = torch.Tensor(batch_size, count).fill_(fill).type_as(data)
-        ret[:, inds] = data
-    else:
-        ret = torch.Tensor(batch_size, count, data.size(2)).fill_(fill).type_as(data)
-        ret[:, inds,:] = data
-    return ret
-
-
 def _compute_targets_batch(ex_rois, gt_rois):
     """Compute bounding-box regression targets for an image."""
 
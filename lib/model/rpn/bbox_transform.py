@@ -165,93 +165,66 @@ def bbox_overlaps(anchors, gt_boxes):
 
     return overlaps
 
-def bbox_overlaps_batch(anchors, gt_boxes):
+def bbox_overlaps_batch(anchors, gt_boxes, num_boxes=None, chunk_size=4096):
     """
-    anchors: (N, 4) ndarray of float
-    gt_boxes: (b, K, 5) ndarray of float
+    anchors: (N, 4) or (b, N, 4) or (b, N, 5) rois tensor of float
+    gt_boxes: (b, K, 5) tensor of float
+    num_boxes: (b,) number of real gt boxes of each image, gt_boxes is
+        zero padded after them
 
-    overlaps: (N, K) ndarray of overlap between boxes and query_boxes
+    overlaps: (b, N, K) tensor of overlap between boxes and query_boxes,
+    0 for zero area gt boxes and -1 for zero area anchors
+
+    The overlaps are computed chunk_size anchors at a time, so only the
+    output has the full (b, N, K) size. With num_boxes, the columns past the
+    largest of them hold padding and are filled without computing them.
     """
     batch_size = gt_boxes.size(0)
-
+    K = gt_boxes.size(1)
 
     if anchors.dim() == 2:
-
         N = anchors.size(0)
-        K = gt_boxes.size(1)
-
-        anchors = anchors.view(1, N, 4).expand(batch_size, N, 4).contiguous()
-        gt_boxes = gt_boxes[:,:,:4].contiguous()
-
-
-        gt_boxes_x = (gt_boxes[:,:,2] - gt_boxes[:,:,0] + 1)
-        gt_boxes_y = (gt_boxes[:,:,3] - gt_boxes[:,:,1] + 1)
-        gt_boxes_area = (gt_boxes_x * gt_boxes_y).view(batch_size, 1, K)
-
-        anchors_boxes_x = (anchors[:,:,2] - anchors[:,:,0] + 1)
-        anchors_boxes_y = (anchors[:,:,3] - anchors[:,:,1] + 1)
-        anchors_area = (anchors_boxes_x * anchors_boxes_y).view(batch_size, N, 1)
-
-        gt_area_zero = (gt_boxes_x == 1) & (gt_boxes_y == 1)
-        anchors_area_zero = (anchors_boxes_x == 1) & (anchors_boxes_y == 1)
-
-        boxes = anchors.view(batch_size, N, 1, 4).expand(batch_size, N, K, 4)
-        query_boxes = gt_boxes.view(batch_size, 1, K, 4).expand(batch_size, N, K, 4)
-
-        iw = (torch.min(boxes[:,:,:,2], query_boxes[:,:,:,2]) -
-            torch.max(boxes[:,:,:,0], query_boxes[:,:,:,0]) + 1)
-        iw[iw < 0] = 0
-
-        ih = (torch.min(boxes[:,:,:,3], query_boxes[:,:,:,3]) -
-            torch.max(boxes[:,:,:,1], query_boxes[:,:,:,1]) + 1)
-        ih[ih < 0] = 0
-        ua = anchors_area + gt_boxes_area - (iw * ih)
-        overlaps = iw * ih / ua
-
-        # mask the overlap here.
-        overlaps.masked_fill_(gt_area_zero.view(batch_size, 1, K).expand(batch_size, N, K), 0)
-        overlaps.masked_fill_(anchors_area_zero.view(batch_size, N, 1).expand(batch_size, N, K), -1)
-
+        anchors = anchors.view(1, N, 4).expand(batch_size, N, 4)
     elif anchors.dim() == 3:
         N = anchors.size(1)
-        K = gt_boxes.size(1)
-
-        if anchors.size(2) == 4:
-            anchors = anchors[:,:,:4].contiguous()
-        else:
-            anchors = anchors[:,:,1:5].contiguous()
-
-        gt_boxes = gt_boxes[:,:,:4].contiguous()
-
-        gt_boxes_x = (gt_boxes[:,:,2] - gt_boxes[:,:,0] + 1)
-        gt_boxes_y = (gt_boxes[:,:,3] - gt_boxes[:,:,1] + 1)
-        gt_boxes_area = (gt_boxes_x * gt_boxes_y).view(batch_size, 1, K)
-
-        anchors_boxes_x = (anchors[:,:,2] - anchors[:,:,0] + 1)
-        anchors_boxes_y = (anchors[:,:,3] - anchors[:,:,1] + 1)
-        anchors_area = (anchors_boxes_x * anchors_boxes_y).view(batch_size, N, 1)
-
-        gt_area_zero = (gt_boxes_x == 1) & (gt_boxes_y == 1)
-        anchors_area_zero = (anchors_boxes_x == 1) & (anchors_boxes_y == 1)
-
-        boxes = anchors.view(batch_size, N, 1, 4).expand(batch_size, N, K, 4)
-        query_boxes = gt_boxes.view(batch_size, 1, K, 4).expand(batch_size, N, K, 4)
-
-        iw = (torch.min(boxes[:,:,:,2], query_boxes[:,:,:,2]) -
-            torch.max(boxes[:,:,:,0], query_boxes[:,:,:,0]) + 1)
-        iw[iw < 0] = 0
-
-        ih = (torch.min(boxes[:,:,:,3], query_boxes[:,:,:,3]) -
-            torch.max(boxes[:,:,:,1], query_boxes[:,:,:,1]) + 1)
-        ih[ih < 0] = 0
-        ua = anchors_area + gt_boxes_area - (iw * ih)
+        if anchors.size(2) != 4:
+            anchors = anchors[:,:,1:5]
+    else:
+        raise ValueError('anchors input dimension is not correct.')
 
-        overlaps = iw * ih / ua
+    # padded gt boxes are all zero, their overlaps are those of a zero area box
+    num_gt = K if num_boxes is None else min(int(num_boxes.max()), K)
+    gt_boxes = gt_boxes[:,:num_gt,:4].contiguous()
+
+    gt_boxes_x = (gt_boxes[:,:,2] - gt_boxes[:,:,0] + 1)
+    gt_boxes_y = (gt_boxes[:,:,3] - gt_boxes[:,:,1] + 1)
+    gt_boxes_area = (gt_boxes_x * gt_boxes_y).view(batch_size, 1, num_gt)
+    gt_area_zero = (gt_boxes_x == 1) & (gt_boxes_y == 1)
+
+    anchors_boxes_x = (anchors[:,:,2] - anchors[:,:,0] + 1)
+    anchors_boxes_y = (anchors[:,:,3] - anchors[:,:,1] + 1)
+    anchors_area = (anchors_boxes_x * anchors_boxes_y).view(batch_size, N, 1)
+    anchors_area_zero = (anchors_boxes_x == 1) & (anchors_boxes_y == 1)
+
+    overlaps = gt_boxes.new(batch_size, N, K).zero_()
+    if num_gt > 0:
+        query_boxes = [gt_boxes[:,:,k].contiguous().view(batch_size, 1, num_gt) for k in range(4)]
+        for start in range(0, N, chunk_size):
+            end = min(start + chunk_size, N)
+            boxes = [anchors[:,start:end,k].contiguous().view(batch_size, end - start, 1) for k in range(4)]
+
+            iw = torch.min(boxes[2], query_boxes[2])
+            iw.sub_(torch.max(boxes[0], query_boxes[0])).add_(1).clamp_(min=0)
+            ih = torch.min(boxes[3], query_boxes[3])
+            ih.sub_(torch.max(boxes[1], query_boxes[1])).add_(1).clamp_(min=0)
+            # iw now holds the intersection
+            iw.mul_(ih)
+            ua = anchors_area[:,start:end] + gt_boxes_area
+            ua.sub_(iw)
+            overlaps[:,start:end,:num_gt] = iw.div_(ua)
 
         # mask the overlap here.
-        overlaps.masked_fill_(gt_area_zero.view(batch_size, 1, K).expand(batch_size, N, K), 0)
-        overlaps.masked_fill_(anchors_area_zero.view(batch_size, N, 1).expand(batch_size, N, K), -1)
-    else:
-        raise ValueError('anchors input dimension is not correct.')
+        overlaps[:,:,:num_gt].masked_fill_(gt_area_zero.view(batch_size, 1, num_gt).expand(batch_size, N, num_gt), 0)
+    overlaps.masked_fill_(anchors_area_zero.view(batch_size, N, 1).expand(batch_size, N, K), -1)
 
     return overlaps
@@ -15,9 +15,9 @@ import numpy as np
 import math
 import yaml
 from model.utils.config import cfg
-from .generate_anchors import generate_anchors
+from .anchor_grid import AnchorGrid
 from .bbox_transform import bbox_transform_inv, clip_boxes, clip_boxes_batch
-from model.nms.nms_wrapper import nms
+from model.nms.nms_wrapper import nms_by_image, soft_nms
 
 import pdb
 
@@ -29,13 +29,14 @@ class _ProposalLayer(nn.Module):
     transformations to a set of regular boxes (called "anchors").
     """
 
-    def __init__(self, feat_stride, scales, ratios):
+    def __init__(self, feat_stride, scales, ratios, anchor_grid=None):
         super(_ProposalLayer, self).__init__()
 
         self._feat_stride = feat_stride
-        self._anchors = torch.from_numpy(generate_anchors(scales=np.array(scales), 
-            ratios=np.array(ratios))).float()
-        self._num_anchors = self._anchors.size(0)
+        if anchor_grid is None:
+            anchor_grid = AnchorGrid(scales, ratios)
+        self._anchor_grid = anchor_grid
+        self._num_anchors = anchor_grid.num_anchors
 
         # rois blob: holds R regions of interest, each is a 5-tuple
         # (n, x1, y1, x2, y2) specifying an image batch index n and a
@@ -77,20 +78,8 @@ class _ProposalLayer(nn.Module):
         batch_size = bbox_deltas.size(0)
 
         feat_height, feat_width = scores.size(2), scores.size(3)
-        shift_x = np.arange(0, feat_width) * self._feat_stride
-        shift_y = np.arange(0, feat_height) * self._feat_stride
-        shift_x, shift_y = np.meshgrid(shift_x, shift_y)
-        shifts = torch.from_numpy(np.vstack((shift_x.ravel(), shift_y.ravel(),
-                                  shift_x.ravel(), shift_y.ravel())).transpose())
-        shifts = shifts.contiguous().type_as(scores).float()
-
-        A = self._num_anchors
-        K = shifts.size(0)
-
-        self._anchors = self._anchors.type_as(scores)
-        # anchors = self._anchors.view(1, A, 4) + shifts.view(1, K, 4).permute(1, 0, 2).contiguous()
-        anchors = self._anchors.view(1, A, 4) + shifts.view(K, 1, 4)
-        anchors = anchors.view(1, K * A, 4).expand(batch_size, K * A, 4)
+        anchors = self._anchor_grid(feat_height, feat_width, self._feat_stride, scores)
+        anchors = anchors.view(1, -1, 4).expand(batch_size, anchors.size(0), 4)
 
         # Transpose and reshape predicted bbox transformations to get them
         # into the same order as the anchors:
@@ -109,54 +98,72 @@ class _ProposalLayer(nn.Module):
         proposals = clip_boxes(proposals, im_info, batch_size)
         # proposals = clip_boxes_batch(proposals, im_info, batch_size)
 
-        # assign the score to 0 if it's non keep.
-        # keep = self._filter_boxes(proposals, min_size * im_info[:, 2])
-
-        # trim keep index to make it euqal over batch
-        # keep_idx = torch.cat(tuple(keep_idx), 0)
-
-        # scores_keep = scores.view(-1)[keep_idx].view(batch_size, trim_size)
-        # proposals_keep = proposals.view(-1, 4)[keep_idx, :].contiguous().view(batch_size, trim_size, 4)
-        
-        # _, order = torch.sort(scores_keep, 1, True)
-        
-        scores_keep = scores
-        proposals_keep = proposals
-        _, order = torch.sort(scores_keep, 1, True)
-
+        # 3. remove predicted boxes with either height or width < threshold
+        # (NOTE: convert min_size to input image scale stored in im_info[2])
+        # filtered boxes get a score below any probability and are dropped
+        # after the top-k
+        keep = self._filter_boxes(proposals, min_size * im_info[:, 2])
+        scores = scores.masked_fill(keep == 0, -1)
+
+        # 4. sort all (proposal, score) pairs by score from highest to lowest
+        # 5. take top pre_nms_topN (e.g. 6000)
+        num_anchors = scores.size(1)
+        if pre_nms_topN > 0 and pre_nms_topN < num_anchors:
+            scores_keep, order = torch.topk(scores, pre_nms_topN, 1)
+        else:
+            scores_keep, order = torch.sort(scores, 1, True)
+        num_keep = order.size(1)
+        order = order + (torch.arange(0, batch_size) * num_anchors).type_as(order).view(-1, 1)
+        proposals_keep = proposals.view(-1, 4)[order.view(-1)]
+        scores_keep = scores_keep.contiguous().view(-1)
+
+        # the candidates of all images, image by image and by decreasing
+        # score within each image
+        candidates = torch.nonzero(scores_keep >= 0).view(-1)
         output = scores.new(batch_size, post_nms_topN, 5).zero_()
-        for i in range(batch_size):
-            # # 3. remove predicted boxes with either height or width < threshold
-            # # (NOTE: convert min_size to input image scale stored in im_info[2])
-            proposals_single = proposals_keep[i]
-            scores_single = scores_keep[i]
-
-            # # 4. sort all (proposal, score) pairs by score from highest to lowest
-            # # 5. take top pre_nms_topN (e.g. 6000)
-            order_single = order[i]
-
-            if pre_nms_topN > 0 and pre_nms_topN < scores_keep.numel():
-                order_single = order_single[:pre_nms_topN]
-
-            proposals_single = proposals_single[order_single, :]
-            scores_single = scores_single[order_single].view(-1,1)
-
-            # 6. apply nms (e.g. threshold = 0.7)
-            # 7. take after_nms_topN (e.g. 300)
-            # 8. return the top proposals (-> RoIs top)
-
-            keep_idx_i = nms(torch.cat((proposals_single, scores_single), 1), nms_thresh)
-            keep_idx_i = keep_idx_i.long().view(-1)
-
-            if post_nms_topN > 0:
-                keep_idx_i = keep_idx_i[:post_nms_topN]
-            proposals_single = proposals_single[keep_idx_i, :]
-            scores_single = scores_single[keep_idx_i, :]
-
-            # padding 0 at the end.
-            num_proposal = proposals_single.size(0)
-            output[i,:,0] = i
-            output[i,:num_proposal,1:] = proposals_single
+        output[:, :, 0] = torch.arange(0, batch_size).type_as(output).view(-1, 1)
+        if candidates.numel() == 0:
+            return output
+        proposals_keep = proposals_keep[candidates]
+        scores_keep = scores_keep[candidates].view(-1, 1)
+        image_inds = ((candidates - candidates % num_keep) / num_keep).long()
+
+        # 6. apply nms (e.g. threshold = 0.7)
+        # 7. take after_nms_topN (e.g. 300)
+        # 8. return the top proposals (-> RoIs top)
+        dets = torch.cat((proposals_keep, scores_keep), 1)
+        if cfg_key == 'TEST' and cfg.TEST.MODE == 'soft_nms':
+            # max_keep is per image, so soft-NMS still runs image by image
+            keep_idx = []
+            for i in range(batch_size):
+                inds_i = torch.nonzero(image_inds == i).view(-1)
+                if inds_i.numel() == 0:
+                    continue
+                keep_idx_i, _ = soft_nms(dets[inds_i], nms_thresh,
+                                         method=cfg.TEST.SOFT_NMS_METHOD, sigma=cfg.TEST.SOFT_NMS_SIGMA,
+                                         min_score=cfg.TEST.SOFT_NMS_MIN_SCORE, max_keep=post_nms_topN)
+                if keep_idx_i.numel() > 0:
+                    keep_idx.append(inds_i[keep_idx_i])
+            if len(keep_idx) == 0:
+                return output
+            keep_idx = torch.cat(keep_idx, 0)
+        else:
+            # index order is image by image and score order within each one
+            keep_idx = nms_by_image(dets, nms_thresh, image_inds, batch_size)
+            if len(keep_idx) == 0:
+                return output
+
+        # rank of every kept box within its image
+        keep_image = image_inds[keep_idx]
+        num_per_image = (keep_image.view(-1, 1) == torch.arange(0, batch_size).type_as(keep_image).view(1, -1)).long().sum(0)
+        image_start = torch.cumsum(num_per_image, 0) - num_per_image
+        rank = torch.arange(0, keep_idx.numel()).type_as(keep_image) - image_start[keep_image]
+        top = torch.nonzero(rank < post_nms_topN).view(-1)
+
+        # padding 0 at the end.
+        output_boxes = scores.new(batch_size * post_nms_topN, 4).zero_()
+        output_boxes.index_copy_(0, keep_image[top] * post_nms_topN + rank[top], proposals_keep[keep_idx[top]])
+        output[:, :, 1:] = output_boxes.view(batch_size, post_nms_topN, 4)
 
         return output
 
@@ -48,7 +48,7 @@ class _ProposalTargetLayer(nn.Module):
         fg_rois_per_image = 1 if fg_rois_per_image == 0 else fg_rois_per_image
 
         labels, rois, bbox_targets, bbox_inside_weights = self._sample_rois_pytorch(
-            all_rois, gt_boxes, fg_rois_per_image,
+            all_rois, gt_boxes, num_boxes, fg_rois_per_image,
             rois_per_image, self._num_classes)
 
         bbox_outside_weights = (bbox_inside_weights > 0).float()
@@ -80,19 +80,28 @@ class _ProposalTargetLayer(nn.Module):
         bbox_targets = bbox_target_data.new(batch_size, rois_per_image, 4).zero_()
         bbox_inside_weights = bbox_target_data.new(bbox_targets.size()).zero_()
 
-        for b in range(batch_size):
-            # assert clss[b].sum() > 0
-            if clss[b].sum() == 0:
-                continue
-            inds = torch.nonzero(clss[b] > 0).view(-1)
-            for i in range(inds.numel()):
-                ind = inds[i]
-                bbox_targets[b, ind, :] = bbox_target_data[b, ind, :]
-                bbox_inside_weights[b, ind, :] = self.BBOX_INSIDE_WEIGHTS
+        # only the foreground rois have targets
+        fg = (clss > 0).view(batch_size, rois_per_image, 1).expand(batch_size, rois_per_image, 4)
+        bbox_targets[fg] = bbox_target_data[fg]
+        bbox_inside_weights[fg] = self.BBOX_INSIDE_WEIGHTS.view(1, 1, 4).expand_as(bbox_inside_weights)[fg]
 
         return bbox_targets, bbox_inside_weights
 
 
+    def _sample_with_replacement(self, mask, num_rois, num_samples):
+        """Indices of num_samples rois drawn uniformly with replacement from
+        the rois in mask, b x num_samples."""
+        batch_size, num_proposal = mask.size()
+        # the rois in mask first, in index order
+        index = torch.arange(0, num_proposal).type_as(num_rois).view(1, -1)
+        _, order = torch.sort(index + (mask == 0).long() * num_proposal, 1)
+
+        rand_num = mask.float().new(batch_size, num_samples).uniform_()
+        rand_num = torch.floor(rand_num * num_rois.view(-1, 1).type_as(rand_num)).long()
+        # uniform_ may return 1.0, and empty masks still need a valid index
+        rand_num = torch.min(rand_num, (num_rois - 1).clamp(min=0).view(-1, 1).expand_as(rand_num))
+        return torch.gather(order, 1, rand_num)
+
     def _compute_targets_pytorch(self, ex_rois, gt_rois):
         """Compute bounding-box regression targets for an image."""
 
@@ -113,13 +122,13 @@ class _ProposalTargetLayer(nn.Module):
         return targets
 
 
-    def _sample_rois_pytorch(self, all_rois, gt_boxes, fg_rois_per_image, rois_per_image, num_classes):
+    def _sample_rois_pytorch(self, all_rois, gt_boxes, num_boxes, fg_rois_per_image, rois_per_image, num_classes):
         """Generate a random sample of RoIs comprising foreground and background
         examples.
         """
         # overlaps: (rois x gt_boxes)
 
-        overlaps = bbox_overlaps_batch(all_rois, gt_boxes)
+        overlaps = bbox_overlaps_batch(all_rois, gt_boxes, num_boxes)
 
         max_overlaps, gt_assignment = torch.max(overlaps, 2)
 
@@ -132,76 +141,52 @@ class _ProposalTargetLayer(nn.Module):
 
         labels = gt_boxes[:,:,4].contiguous().view(-1).index((offset.view(-1),)).view(batch_size, -1)
         
-        labels_batch = labels.new(batch_size, rois_per_image).zero_()
-        rois_batch  = all_rois.new(batch_size, rois_per_image, 5).zero_()
-        gt_rois_batch = all_rois.new(batch_size, rois_per_image, 5).zero_()
         # Guard against the case when an image has fewer than max_fg_rois_per_image
         # foreground RoIs
-        for i in range(batch_size):
-
-            fg_inds = torch.nonzero(max_overlaps[i] >= cfg.TRAIN.FG_THRESH).view(-1)
-            fg_num_rois = fg_inds.numel()
-
-            # Select background RoIs as those within [BG_THRESH_LO, BG_THRESH_HI)
-            bg_inds = torch.nonzero((max_overlaps[i] < cfg.TRAIN.BG_THRESH_HI) &
-                                    (max_overlaps[i] >= cfg.TRAIN.BG_THRESH_LO)).view(-1)
-            bg_num_rois = bg_inds.numel()
-
-            if fg_num_rois > 0 and bg_num_rois > 0:
-                # sampling fg
-                fg_rois_per_this_image = min(fg_rois_per_image, fg_num_rois)
-
-                # torch.randperm seems has a bug on multi-gpu setting that cause the segfault.
-                # See https://github.com/pytorch/pytorch/issues/1868 for more details.
-                # use numpy instead.
-                #rand_num = torch.randperm(fg_num_rois).long().cuda()
-                rand_num = torch.from_numpy(np.random.permutation(fg_num_rois)).type_as(gt_boxes).long()
-                fg_inds = fg_inds[rand_num[:fg_rois_per_this_image]]
-
-                # sampling bg
-                bg_rois_per_this_image = rois_per_image - fg_rois_per_this_image
-
-                # Seems torch.rand has a bug, it will generate very large number and make an error.
-                # We use numpy rand instead.
-                #rand_num = (torch.rand(bg_rois_per_this_image) * bg_num_rois).long().cuda()
-                rand_num = np.floor(np.random.rand(bg_rois_per_this_image) * bg_num_rois)
-                rand_num = torch.from_numpy(rand_num).type_as(gt_boxes).long()
-                bg_inds = bg_inds[rand_num]
-
-            elif fg_num_rois > 0 and bg_num_rois == 0:
-                # sampling fg
-                #rand_num = torch.floor(torch.rand(rois_per_image) * fg_num_rois).long().cuda()
-                rand_num = np.floor(np.random.rand(rois_per_image) * fg_num_rois)
-                rand_num = torch.from_numpy(rand_num).type_as(gt_boxes).long()
-                fg_inds = fg_inds[rand_num]
-                fg_rois_per_this_image = rois_per_image
-                bg_rois_per_this_image = 0
-            elif bg_num_rois > 0 and fg_num_rois == 0:
-                # sampling bg
-                #rand_num = torch.floor(torch.rand(rois_per_image) * bg_num_rois).long().cuda()
-                rand_num = np.floor(np.random.rand(rois_per_image) * bg_num_rois)
-                rand_num = torch.from_numpy(rand_num).type_as(gt_boxes).long()
-
-                bg_inds = bg_inds[rand_num]
-                bg_rois_per_this_image = rois_per_image
-                fg_rois_per_this_image = 0
-            else:
-                raise ValueError("bg_num_rois = 0 and fg_num_rois = 0, this should not happen!")
-
-            # The indices that we're selecting (both fg and bg)
-            keep_inds = torch.cat([fg_inds, bg_inds], 0)
-
-            # Select sampled values from various arrays:
-            labels_batch[i].copy_(labels[i][keep_inds])
-
-            # Clamp labels for the background RoIs to 0
-            if fg_rois_per_this_image < rois_per_image:
-                labels_batch[i][fg_rois_per_this_image:] = 0
-
-            rois_batch[i] = all_rois[i][keep_inds]
-            rois_batch[i,:,0] = i
-
-            gt_rois_batch[i] = gt_boxes[i][gt_assignment[i][keep_inds]]
+        fg_mask = max_overlaps >= cfg.TRAIN.FG_THRESH
+        # Select background RoIs as those within [BG_THRESH_LO, BG_THRESH_HI)
+        bg_mask = (max_overlaps < cfg.TRAIN.BG_THRESH_HI) & (max_overlaps >= cfg.TRAIN.BG_THRESH_LO)
+        fg_num_rois = torch.sum(fg_mask.long(), 1)
+        bg_num_rois = torch.sum(bg_mask.long(), 1)
+        if torch.sum(((fg_num_rois == 0) & (bg_num_rois == 0)).long()) > 0:
+            raise ValueError("bg_num_rois = 0 and fg_num_rois = 0, this should not happen!")
+        has_fg_bg = ((fg_num_rois > 0) & (bg_num_rois > 0)).long()
+        fg_only = ((fg_num_rois > 0) & (bg_num_rois == 0)).long()
+
+        # with both fg and bg, up to fg_rois_per_image fg rois are sampled
+        # without replacement, the largest of uniform random keys, and the
+        # rest of the rois are bg rois sampled with replacement. An image
+        # without bg or without fg rois samples all of them with replacement
+        # from the other kind.
+        fg_rois_per_this_image = has_fg_bg * fg_num_rois.clamp(max=fg_rois_per_image) + fg_only * rois_per_image
+
+        keys = max_overlaps.new(batch_size, num_proposal).uniform_()
+        keys.masked_fill_(fg_mask == 0, -1)
+        _, fg_perm = torch.topk(keys, min(fg_rois_per_image, num_proposal), 1)
+
+        fg_repl = self._sample_with_replacement(fg_mask, fg_num_rois, rois_per_image)
+        bg_repl = self._sample_with_replacement(bg_mask, bg_num_rois, rois_per_image)
+
+        fg_inds = fg_repl.clone()
+        fg_inds[:, :fg_perm.size(1)] = fg_perm * has_fg_bg.view(-1, 1) + fg_repl[:, :fg_perm.size(1)] * (1 - has_fg_bg).view(-1, 1)
+        position = torch.arange(0, rois_per_image).type_as(fg_inds).view(1, -1)
+        is_fg = (position < fg_rois_per_this_image.view(-1, 1)).long()
+
+        # The indices that we're selecting (both fg and bg)
+        keep_inds = fg_inds * is_fg + bg_repl * (1 - is_fg)
+
+        # Select sampled values from various arrays:
+        labels_batch = torch.gather(labels, 1, keep_inds)
+        # Clamp labels for the background RoIs to 0
+        labels_batch.masked_fill_(is_fg == 0, 0)
+
+        rois_batch = torch.gather(all_rois, 1, keep_inds.view(batch_size, rois_per_image, 1).expand(
+            batch_size, rois_per_image, all_rois.size(2)))
+        rois_batch[:,:,0] = torch.arange(0, batch_size).type_as(rois_batch).view(-1, 1)
+
+        gt_inds = torch.gather(gt_assignment, 1, keep_inds)
+        gt_rois_batch = torch.gather(gt_boxes, 1, gt_inds.view(batch_size, rois_per_image, 1).expand(
+            batch_size, rois_per_image, gt_boxes.size(2)))
 
         bbox_target_data = self._compute_targets_pytorch(
                 rois_batch[:,:,1:5], gt_rois_batch[:,:,:4])
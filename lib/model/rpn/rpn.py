@@ -7,6 +7,7 @@ from torch.autograd import Variable
 from model.utils.config import cfg
 from .proposal_layer import _ProposalLayer
 from .anchor_target_layer import _AnchorTargetLayer
+from .anchor_grid import AnchorGrid
 from model.utils.net_utils import _smooth_l1_loss
 
 import numpy as np
@@ -35,11 +36,16 @@ class _RPN(nn.Module):
         self.nc_bbox_out = len(self.anchor_scales) * len(self.anchor_ratios) * 4 # 4(coords) * 9 (anchors)
         self.RPN_bbox_pred = nn.Conv2d(512, self.nc_bbox_out, 1, 1, 0)
 
+        # anchors of the feature map, built once per map size for both layers below
+        self.anchor_grid = AnchorGrid(self.anchor_scales, self.anchor_ratios)
+
         # define proposal layer
-        self.RPN_proposal = _ProposalLayer(self.feat_stride, self.anchor_scales, self.anchor_ratios)
+        self.RPN_proposal = _ProposalLayer(self.feat_stride, self.anchor_scales, self.anchor_ratios,
+                                           self.anchor_grid)
 
         # define anchor target layer
-        self.RPN_anchor_target = _AnchorTargetLayer(self.feat_stride, self.anchor_scales, self.anchor_ratios)
+        self.RPN_anchor_target = _AnchorTargetLayer(self.feat_stride, self.anchor_scales, self.anchor_ratios,
+                                                    self.anchor_grid)
 
         self.rpn_loss_cls = 0
         self.rpn_loss_box = 0
@@ -131,11 +137,16 @@ class _RPN_out_pred_label(nn.Module):
         self.nc_bbox_out = len(self.anchor_scales) * len(self.anchor_ratios) * 4 # 4(coords) * 9 (anchors)
         self.RPN_bbox_pred = nn.Conv2d(512, self.nc_bbox_out, 1, 1, 0)
 
+        # anchors of the feature map, built once per map size for both layers below
+        self.anchor_grid = AnchorGrid(self.anchor_scales, self.anchor_ratios)
+
         # define proposal layer
-        self.RPN_proposal = _ProposalLayer(self.feat_stride, self.anchor_scales, self.anchor_ratios)
+        self.RPN_proposal = _ProposalLayer(self.feat_stride, self.anchor_scales, self.anchor_ratios,
+                                           self.anchor_grid)
 
         # define anchor target layer
-        self.RPN_anchor_target = _AnchorTargetLayer(self.feat_stride, self.anchor_scales, self.anchor_ratios)
+        self.RPN_anchor_target = _AnchorTargetLayer(self.feat_stride, self.anchor_scales, self.anchor_ratios,
+                                                    self.anchor_grid)
 
         self.rpn_loss_cls = 0
         self.rpn_loss_box = 0
@@ -17,10 +17,12 @@ except NameError:
     xrange = range  # Python 3
 
 
-def im_list_to_blob(ims):
+def im_list_to_blob(ims, pixel_means=None):
     """Convert a list of images into a network input.
 
     Assumes images are already prepared (means subtracted, BGR order, ...).
+    With pixel_means, the images are resized uint8 ones and the means are
+    subtracted while they are written into the float blob.
     """
     max_shape = np.array([im.shape for im in ims]).max(axis=0)
     num_images = len(ims)
@@ -28,16 +30,16 @@ def im_list_to_blob(ims):
                     dtype=np.float32)
     for i in xrange(num_images):
         im = ims[i]
-        blob[i, 0:im.shape[0], 0:im.shape[1], :] = im
+        if pixel_means is None:
+            blob[i, 0:im.shape[0], 0:im.shape[1], :] = im
+        else:
+            np.subtract(im, pixel_means, out=blob[i, 0:im.shape[0], 0:im.shape[1], :])
 
     return blob
 
-def prep_im_for_blob(im, pixel_means, target_size, max_size):
-    """Mean subtract and scale an image for use in a blob."""
-
-    im = im.astype(np.float32, copy=False)
-    im -= pixel_means
-    # im = im[:, :, ::-1]
+def resize_im_for_blob(im, target_size, max_size):
+    """Scale an image so that its shortest side is target_size. A uint8
+    image stays uint8, so that the resize touches a quarter of the bytes."""
     im_shape = im.shape
     im_size_min = np.min(im_shape[0:2])
     im_size_max = np.max(im_shape[0:2])
@@ -50,3 +52,12 @@ def prep_im_for_blob(im, pixel_means, target_size, max_size):
                     interpolation=cv2.INTER_LINEAR)
 
     return im, im_scale
+
+def prep_im_for_blob(im, pixel_means, target_size, max_size):
+    """Mean subtract and scale an image for use in a blob."""
+
+    im, im_scale = resize_im_for_blob(im, target_size, max_size)
+    im = np.subtract(im, pixel_means, dtype=np.float32)
+    # im = im[:, :, ::-1]
+
+    return im, im_scale
@@ -213,8 +213,19 @@ __C.TEST.RPN_MIN_SIZE = 16
 
 # Testing mode, default to be 'nms', 'top' is slower but better
 # See report for details
+# 'soft_nms' decays the scores of overlapping boxes instead of removing
+# them, for both the RPN proposals and the final detections
 __C.TEST.MODE = 'nms'
 
+# Only useful when TEST.MODE is 'soft_nms', 'linear' or 'gaussian' score decay
+__C.TEST.SOFT_NMS_METHOD = 'linear'
+
+# Sigma of the gaussian decay
+__C.TEST.SOFT_NMS_SIGMA = 0.5
+
+# Boxes whose decayed score falls below this are discarded
+__C.TEST.SOFT_NMS_MIN_SCORE = 0.001
+
 # Only useful when TEST.MODE is 'top', specifies the number of top proposals to select
 __C.TEST.RPN_TOP_N = 5000
 
@@ -282,6 +293,13 @@ __C.ROOT_DATA = '/'
 #__C.DATA_DIR = osp.abspath(osp.join(__C.ROOT_DIR, 'data'))
 __C.DATA_DIR = './data'
 
+# Directory of the on-disk cache of decoded and resized images, empty to
+# disable. Not under data/cache, which is cleared on every start
+__C.IMAGE_CACHE_DIR = ''
+
+# Size limit of the image cache in GB, the least recently used images go first
+__C.IMAGE_CACHE_GB = 10.
+
 # Name (or path to) the matlab executable
 __C.MATLAB = 'matlab'
 
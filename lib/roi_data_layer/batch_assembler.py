@@ -0,0 +1,68 @@
+"""Collate function that writes the training images straight into reused
+shared memory batches.
+
+With roibatchLoader.assemble_batches set, a training item is the unpadded
+(H, W, 3) image and the size it is padded to. BatchAssembler copies each
+image, transposed, into its slot of a (B, 3, H, W) tensor that lives in
+shared memory, so that it reaches the main process without another copy,
+and zeroes only the padding. The batch tensors of a shape are taken from a
+ring of ring_size buffers per worker: a batch is overwritten ring_size
+batches of the same worker later, so the consumer must be done with it by
+then. ring_size() sizes the ring from the loader and the consumer.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+from collections import OrderedDict
+import numpy as np
+import torch
+from torch.utils.data.dataloader import default_collate
+
+
+def ring_size(num_workers, prefetch=0):
+  """Number of batches of one worker that can be alive at once. The
+  DataLoader keeps 2 * num_workers batches in flight over all its workers,
+  and one worker can be running all of them. On top of these, a consumer
+  that queues prefetch batches holds one more while it blocks on the full
+  queue, and one is in use."""
+  return prefetch + 2 * num_workers + 2
+
+
+class BatchAssembler(object):
+  def __init__(self, ring_size=4, max_shapes=2):
+    self.ring_size = ring_size
+    self.max_shapes = max_shapes
+    # (B, 3, H, W) -> [buffers, next slot], least recently used first. A
+    # dropped ring is freed once the main process lets go of its batches
+    self._rings = OrderedDict()
+
+  def _buffer(self, shape):
+    ring = self._rings.pop(shape, None)
+    if ring is None:
+      ring = [[], 0]
+      if len(self._rings) >= self.max_shapes:
+        self._rings.popitem(last=False)
+    self._rings[shape] = ring
+
+    buffers, slot = ring
+    if slot == len(buffers):
+      buffers.append(torch.FloatTensor(*shape).share_memory_())
+    ring[1] = (slot + 1) % self.ring_size
+    return buffers[slot]
+
+  def __call__(self, batch):
+    if not isinstance(batch[0][0], np.ndarray):
+      # cached features, or a dataset that pads its items itself
+      return default_collate(batch)
+
+    padded_height, padded_width = batch[0][1]
+    data = self._buffer((len(batch), 3, padded_height, padded_width))
+    for i, sample in enumerate(batch):
+      im = torch.from_numpy(sample[0])
+      height, width = im.size(0), im.size(1)
+      data[i, :, :height, :width].copy_(im.permute(2, 0, 1))
+      data[i, :, height:, :].zero_()
+      data[i, :, :height, width:].zero_()
+    return [data] + default_collate([sample[2:] for sample in batch])
@@ -0,0 +1,113 @@
+"""Batch sampler that groups the training images by their scaled shape.
+
+The roibatchLoader pads or crops all images of a batch to one aspect ratio,
+and a batch that spans ratios below and above 1 is cropped to squares.
+Serving contiguous blocks of the ratio sorted images, as the sampler of
+train.py does, mixes shapes at every block boundary. BucketBatchSampler
+puts the images that have the same (height, width) once scaled into
+buckets and draws batches from within a bucket, so that these batches need
+next to no padding. Only the remainders of the buckets are batched with
+their neighbours in ratio order.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+from torch.utils.data.sampler import Sampler
+
+from model.utils.config import cfg
+from roi_data_layer.columnar_roidb import ColumnarRoidb
+
+
+class BucketBatchSampler(Sampler):
+  def __init__(self, dataset, batch_size):
+    self.batch_size = batch_size
+    ratio_list = np.asarray(dataset.ratio_list)
+    scale = cfg.TRAIN.SCALES[0]
+
+    # the size of every item once scaled, before padding or cropping
+    roidb = dataset._roidb
+    if isinstance(roidb, ColumnarRoidb):
+      widths, heights = roidb.entry_sizes()
+    else:
+      widths = np.array([r['width'] for r in roidb])
+      heights = np.array([r['height'] for r in roidb])
+    widths = widths[dataset.ratio_index].astype(np.float64)
+    heights = heights[dataset.ratio_index].astype(np.float64)
+    im_scales = scale / np.minimum(widths, heights)
+    self._heights = np.round(heights * im_scales)
+    self._widths = np.round(widths * im_scales)
+
+    # items with the same scaled shape after the ratio clipping; the cropped
+    # ones are kept apart, the feature cache serves whole batches or none
+    long_side = np.round(scale * np.maximum(ratio_list, 1. / ratio_list)).astype(np.int64)
+    keys = np.stack((ratio_list < 1, long_side, dataset.need_crop), 1)
+    _, bucket_ids = np.unique(keys, axis=0, return_inverse=True)
+    bucket_ids = bucket_ids.reshape(-1)
+
+    # whole batches come from the buckets, the remainder of each bucket is
+    # drawn once and batched in ratio order
+    self.buckets = []
+    leftover = []
+    for bucket_id in np.unique(bucket_ids):
+      items = np.random.permutation(np.where(bucket_ids == bucket_id)[0])
+      num_full = len(items) - len(items) % batch_size
+      if num_full > 0:
+        self.buckets.append(items[:num_full])
+      leftover.append(items[num_full:])
+    leftover = np.sort(np.concatenate(leftover))
+    self.mixed_batches = [leftover[i:i + batch_size] for i in range(0, len(leftover), batch_size)]
+
+    dataset.set_batches(self.buckets + self.mixed_batches)
+    self._ratio_list_batch = dataset.ratio_list_batch.numpy()
+    self._need_crop = dataset.need_crop
+    self.num_batches = sum(len(b) for b in self.buckets) // batch_size + len(self.mixed_batches)
+    # pixel_stats of every pass drawn so far. A pass is drawn when the one
+    # before it starts, so the stats of a pass are known before the loader,
+    # possibly in another thread, iterates it
+    self.pass_stats = []
+    self._next_batches = self._draw()
+
+  def _draw(self):
+    batches = list(self.mixed_batches)
+    for items in self.buckets:
+      items = np.random.permutation(items)
+      batches.extend(items[i:i + self.batch_size] for i in range(0, len(items), self.batch_size))
+    batches = [batches[i] for i in np.random.permutation(len(batches))]
+    self.pass_stats.append(self.pixel_stats(batches))
+    return batches
+
+  def __iter__(self):
+    batches = self._next_batches
+    self._next_batches = self._draw()
+    return iter([batch.tolist() for batch in batches])
+
+  def __len__(self):
+    return self.num_batches
+
+  def pixel_stats(self, batches):
+    """Fraction of the batch pixels that are padding and of the scaled
+    image pixels that are cropped away, as roibatchLoader.__getitem__ pads
+    and crops."""
+    padded, cropped, total, image = 0., 0., 0., 0.
+    for batch in batches:
+      h, w = self._heights[batch], self._widths[batch]
+      target_ratio = float(self._ratio_list_batch[batch[0]])
+      need_crop = self._need_crop[batch]
+      if target_ratio < 1:
+        out_h, out_w = np.ceil(w / target_ratio), w
+        kept = np.where(need_crop, np.minimum(h, np.floor(w / target_ratio)), h) * w
+      elif target_ratio > 1:
+        out_h, out_w = h, np.ceil(h * target_ratio)
+        kept = h * np.where(need_crop, np.minimum(w, out_w), w)
+      else:
+        out_h = out_w = np.minimum(h, w)
+        kept = out_h * out_w
+      padded += (out_h * out_w - kept).sum()
+      total += (out_h * out_w).sum()
+      cropped += (h * w - kept).sum()
+      image += (h * w).sum()
+    return {'padded': padded / max(total, 1.), 'cropped': cropped / max(image, 1.)}
+
@@ -0,0 +1,184 @@
+"""Columnar, memory mapped roidb.
+
+The list of dicts roidb holds a python dict, a sparse matrix and a few
+small arrays per image, plus a second full copy of every entry for the
+horizontally flipped images, and each DataLoader worker gets its own copy
+of all of it. ColumnarRoidb keeps the ground truth of all images in flat
+arrays indexed by per image offsets, saved as .npy files that are memory
+mapped and shared with the workers, and flips the boxes of an entry when it is read.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import hashlib
+import shutil
+import numpy as np
+import scipy.sparse
+
+
+class ColumnarRoidb(object):
+  """
+  Per object, over all images:
+    boxes (N, 4) uint16, never flipped
+    gt_classes (N,) int32, max_classes (N,) int64, max_overlaps (N,) float32
+    overlap_data, overlap_indices, overlap_indptr: the rows of all
+      gt_overlaps as one (N, num_classes) csr matrix
+  Per image:
+    obj_offsets (I + 1,), the objects of image i are [obj_offsets[i], obj_offsets[i + 1])
+    widths, heights (I,) int32, images (I,) paths, img_ids (I,)
+  Per entry, in memory:
+    entry_image, the image of every entry, entry_flipped, and need_crop,
+    set by rank_roidb_ratio. Entries are all the unflipped images
+    followed by all the flipped ones.
+
+  roidb[i] is the dict the list roidb had at i.
+  """
+  _COLUMNS = ('boxes', 'gt_classes', 'max_classes', 'max_overlaps', 'overlap_data', 'overlap_indices',
+              'overlap_indptr', 'obj_offsets', 'widths', 'heights', 'images', 'img_ids')
+
+  def __init__(self, root, entry_image, entry_flipped, need_crop=None):
+    self.root = root
+    self.entry_image = entry_image
+    self.entry_flipped = entry_flipped
+    if need_crop is None:
+      need_crop = np.zeros(len(entry_image), dtype=np.uint8)
+    self.need_crop = need_crop
+    self._open()
+
+  def _open(self):
+    for name in self._COLUMNS:
+      setattr(self, name, np.load(os.path.join(self.root, name + '.npy'), mmap_mode='r'))
+    self.num_classes = int(np.load(os.path.join(self.root, 'num_classes.npy')))
+
+  def __getstate__(self):
+    # a pickled roidb, e.g. sent to spawned workers, maps the files again
+    # rather than carrying copies of them. Forked workers inherit the maps
+    return {'root': self.root, 'entry_image': self.entry_image,
+            'entry_flipped': self.entry_flipped, 'need_crop': self.need_crop}
+
+  def __setstate__(self, state):
+    self.__dict__.update(state)
+    self._open()
+
+  @classmethod
+  def build(cls, root, roidb, num_classes, flipped=False):
+    """Writes the prepared list roidb under root, in a subdirectory named by
+    the hash of its columns. With flipped, every image also gets a flipped
+    entry."""
+    if not os.path.exists(root):
+      os.makedirs(root)
+    num_objs = np.array([len(r['gt_classes']) for r in roidb], dtype=np.int64)
+    obj_offsets = np.zeros(len(roidb) + 1, dtype=np.int64)
+    np.cumsum(num_objs, out=obj_offsets[1:])
+
+    def cat(key, dtype, shape=(0,)):
+      if obj_offsets[-1] == 0:
+        return np.zeros(shape, dtype=dtype)
+      return np.concatenate([np.asarray(r[key], dtype=dtype) for r in roidb])
+
+    overlaps = scipy.sparse.vstack([scipy.sparse.csr_matrix(r['gt_overlaps'], shape=(n, num_classes))
+                                    for r, n in zip(roidb, num_objs)], format='csr')
+    columns = {
+      'boxes': cat('boxes', np.uint16, (0, 4)).reshape(-1, 4),
+      'gt_classes': cat('gt_classes', np.int32),
+      'max_classes': cat('max_classes', np.int64),
+      'max_overlaps': cat('max_overlaps', np.float32),
+      'overlap_data': overlaps.data.astype(np.float32),
+      'overlap_indices': overlaps.indices.astype(np.int32),
+      'overlap_indptr': overlaps.indptr.astype(np.int64),
+      'obj_offsets': obj_offsets,
+      'widths': np.array([r['width'] for r in roidb], dtype=np.int32),
+      'heights': np.array([r['height'] for r in roidb], dtype=np.int32),
+      'images': np.array([r['image'] for r in roidb]),
+      'img_ids': np.array([r['img_id'] for r in roidb]),
+      'num_classes': np.array(num_classes),
+    }
+    if flipped:
+      # the flipped boxes of all images, checked once here
+      widths = np.repeat(columns['widths'], num_objs)
+      assert (columns['boxes'][:, 0] <= columns['boxes'][:, 2]).all()
+      assert (columns['boxes'][:, 2] < widths).all()
+    # other runs may have the columns of this imdb mapped, with other
+    # classes or splits: the columns go to a directory named by their
+    # contents, written aside and renamed into place, never over a file
+    digest = hashlib.sha1()
+    for name in sorted(columns):
+      column = np.ascontiguousarray(columns[name])
+      digest.update(('%s|%s|%r|' % (name, column.dtype.str, column.shape)).encode('utf-8'))
+      digest.update(column.tobytes())
+    columns_root = os.path.join(root, digest.hexdigest())
+    if not os.path.exists(columns_root):
+      tmp_root = '%s.%d.tmp' % (columns_root, os.getpid())
+      if os.path.exists(tmp_root):
+        shutil.rmtree(tmp_root)
+      os.makedirs(tmp_root)
+      for name, column in columns.items():
+        np.save(os.path.join(tmp_root, name + '.npy'), column)
+      try:
+        os.rename(tmp_root, columns_root)
+      except OSError:
+        # written by a concurrent run in the meantime, with the same contents
+        shutil.rmtree(tmp_root)
+
+    entry_image = np.arange(len(roidb), dtype=np.int32)
+    entry_flipped = np.zeros(len(roidb), dtype=bool)
+    if flipped:
+      entry_image = np.concatenate((entry_image, entry_image))
+      entry_flipped = np.concatenate((entry_flipped, ~entry_flipped))
+    return cls(columns_root, entry_image, entry_flipped)
+
+  def __len__(self):
+    return len(self.entry_image)
+
+  def __iter__(self):
+    for i in range(len(self)):
+      yield self[i]
+
+  def __getitem__(self, i):
+    if isinstance(i, slice):
+      return [self[j] for j in range(*i.indices(len(self)))]
+    if i < 0:
+      i += len(self)
+    image = int(self.entry_image[i])
+    start, end = int(self.obj_offsets[image]), int(self.obj_offsets[image + 1])
+    width = int(self.widths[image])
+
+    boxes = np.array(self.boxes[start:end])
+    if self.entry_flipped[i]:
+      oldx1 = boxes[:, 0].copy()
+      oldx2 = boxes[:, 2].copy()
+      boxes[:, 0] = width - oldx2 - 1
+      boxes[:, 2] = width - oldx1 - 1
+    indptr = np.array(self.overlap_indptr[start:end + 1])
+    gt_overlaps = scipy.sparse.csr_matrix(
+      (np.array(self.overlap_data[indptr[0]:indptr[-1]]),
+       np.array(self.overlap_indices[indptr[0]:indptr[-1]]), indptr - indptr[0]),
+      shape=(end - start, self.num_classes))
+
+    return {'boxes': boxes,
+            'gt_classes': np.array(self.gt_classes[start:end]),
+            'gt_overlaps': gt_overlaps,
+            'flipped': bool(self.entry_flipped[i]),
+            'img_id': self.img_ids[image].item(),
+            'image': str(self.images[image]),
+            'width': width,
+            'height': int(self.heights[image]),
+            'max_classes': np.array(self.max_classes[start:end]),
+            'max_overlaps': np.array(self.max_overlaps[start:end]),
+            'need_crop': int(self.need_crop[i])}
+
+  def num_boxes(self):
+    """Number of gt boxes of every entry."""
+    return np.diff(self.obj_offsets)[self.entry_image]
+
+  def entry_sizes(self):
+    """Widths and heights of every entry."""
+    return np.asarray(self.widths)[self.entry_image], np.asarray(self.heights)[self.entry_image]
+
+  def subset(self, entry_inds):
+    """The entries entry_inds, sharing the mapped columns."""
+    return ColumnarRoidb(self.root, self.entry_image[entry_inds], self.entry_flipped[entry_inds],
+                         self.need_crop[entry_inds])
@@ -0,0 +1,105 @@
+"""Disk cache of the frozen backbone prefix output of the training images.
+
+With cfg.RESNET.FIXED_BLOCKS >= 1 and a single training scale, the output
+of conv1, bn1 and the fixed blocks for a given (image, flipped) pair is the
+same in every epoch. FeatureCache keeps it as float16 .npy files that the
+roibatchLoader memory maps instead of decoding and convolving the image.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import hashlib
+import pickle
+import numpy as np
+import torch
+from torch.autograd import Variable
+
+from model.utils.config import cfg
+from roi_data_layer.batch_assembler import BatchAssembler, ring_size
+
+
+# bumped whenever the image preprocessing changes, so that the features of
+# the old one are not reused. 2: resized in uint8 before the mean subtraction
+_PREPROCESSING_VERSION = 2
+
+
+class FeatureCache(object):
+  def __init__(self, cache_dir, fingerprint):
+    self.cache_dir = os.path.join(cache_dir, fingerprint)
+    if not os.path.exists(self.cache_dir):
+      os.makedirs(self.cache_dir)
+    self._index_file = os.path.join(self.cache_dir, 'index.pkl')
+    # key -> (file name, im_info)
+    self._index = {}
+    if os.path.exists(self._index_file):
+      with open(self._index_file, 'rb') as fid:
+        self._index = pickle.load(fid)
+
+  @staticmethod
+  def key(roidb_entry, scale, ratio):
+    return '%s|%d|%d|%.6f' % (roidb_entry['image'], roidb_entry['flipped'], scale, ratio)
+
+  def __contains__(self, key):
+    return key in self._index
+
+  def __len__(self):
+    return len(self._index)
+
+  def get(self, key):
+    """Returns the (C, H, W) float16 memmap and the im_info of key."""
+    file_name, im_info = self._index[key]
+    feat = np.load(os.path.join(self.cache_dir, file_name), mmap_mode='r')
+    return feat, im_info.copy()
+
+  def put(self, key, feat, im_info):
+    file_name = hashlib.sha1(key.encode('utf-8')).hexdigest() + '.npy'
+    path = os.path.join(self.cache_dir, file_name)
+    # write aside and rename, a killed run never leaves a truncated entry
+    with open(path + '.tmp', 'wb') as fid:
+      np.save(fid, np.ascontiguousarray(feat, dtype=np.float16))
+    os.rename(path + '.tmp', path)
+    self._index[key] = (file_name, np.array(im_info, dtype=np.float32))
+
+  def save_index(self):
+    with open(self._index_file + '.tmp', 'wb') as fid:
+      pickle.dump(self._index, fid, pickle.HIGHEST_PROTOCOL)
+    os.rename(self._index_file + '.tmp', self._index_file)
+
+
+def prefix_fingerprint(model):
+  """Names the cache after everything the cached features depend on: the
+  weights of the fixed modules and the input preprocessing."""
+  sha1 = hashlib.sha1()
+  sha1.update(('%d|%d|%s|%s|%d' % (_PREPROCESSING_VERSION, cfg.RESNET.FIXED_BLOCKS, cfg.PIXEL_MEANS.tolist(),
+                                   cfg.TRAIN.SCALES, cfg.TRAIN.MAX_SIZE)).encode('utf-8'))
+  for m in model._fixed_base_modules():
+    for k, v in sorted(m.state_dict().items()):
+      sha1.update(k.encode('utf-8'))
+      sha1.update(v.cpu().numpy().tobytes())
+  return sha1.hexdigest()[:16]
+
+
+def fill_feature_cache(cache, dataset, model, cuda=False, num_workers=0):
+  """Computes the features of every cacheable image of the roibatchLoader
+  dataset that is not in the cache yet."""
+  missing = []
+  for index in range(len(dataset)):
+    key = dataset.feature_cache_key(index)
+    if key is not None and key not in cache:
+      missing.append((index, key))
+  if len(missing) == 0:
+    return
+
+  print('Caching the fixed backbone features of %d images in %s' % (len(missing), cache.cache_dir))
+  # the sampler only decides the order, the dataset still sees its own indices
+  loader = torch.utils.data.DataLoader(dataset, batch_size=1, sampler=[index for index, _ in missing],
+                                       collate_fn=BatchAssembler(ring_size(num_workers)),
+                                       num_workers=num_workers, pin_memory=False)
+  for (index, key), data in zip(missing, loader):
+    im_data = data[0].cuda() if cuda else data[0]
+    feat = model._fixed_base_feat(Variable(im_data, volatile=True))
+    cache.put(key, feat.data[0].cpu().numpy(), data[1][0].numpy())
+  cache.save_index()
@@ -0,0 +1,101 @@
+"""On-disk LRU cache of decoded and resized uint8 images.
+
+Decoding a JPEG and resizing it to the training scale costs more than
+reading the resized pixels back, and the result for a given (image, scale,
+max size, flipped) is the same in every epoch. The cache is a directory of .npz
+files shared by all DataLoader workers; the least recently used files are
+removed when it grows over its size limit.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import hashlib
+import numpy as np
+
+from model.utils.config import cfg
+
+
+class ImageCache(object):
+  def __init__(self, cache_dir, max_gb):
+    self.cache_dir = cache_dir
+    if not os.path.exists(cache_dir):
+      os.makedirs(cache_dir)
+    self.max_bytes = int(max_gb * 1024 ** 3)
+    # bytes this process wrote since the directory was last measured, the
+    # other workers write to it too
+    self._written = 0
+    self._size = None
+
+  def _file(self, path, target_size, flipped):
+    # a new mtime means a new image; the scale of the image also depends on
+    # the max size
+    key = '%s|%r|%d|%d|%d' % (os.path.abspath(path), os.stat(path).st_mtime, target_size,
+                              cfg.TRAIN.MAX_SIZE, flipped)
+    return os.path.join(self.cache_dir, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.npz')
+
+  def get(self, path, target_size, flipped):
+    """(im, im_scale) of a cached image, None on a miss."""
+    cache_file = self._file(path, target_size, flipped)
+    try:
+      with np.load(cache_file) as data:
+        im, im_scale = data['im'], float(data['im_scale'])
+      # mark it as recently used
+      os.utime(cache_file, None)
+    except (IOError, OSError, KeyError, ValueError):
+      # missing, or evicted by another worker while reading
+      return None
+    return im, im_scale
+
+  def put(self, path, target_size, flipped, im, im_scale):
+    cache_file = self._file(path, target_size, flipped)
+    tmp_file = '%s.%d.tmp' % (cache_file, os.getpid())
+    # write aside and rename, the other workers never read a partial file
+    with open(tmp_file, 'wb') as fid:
+      np.savez(fid, im=im, im_scale=np.float64(im_scale))
+    os.rename(tmp_file, cache_file)
+
+    self._written += im.nbytes
+    if self._size is None or self._size + self._written > self.max_bytes \
+            or self._written > self.max_bytes // 16:
+      self._evict()
+
+  def _evict(self):
+    files = []
+    for name in os.listdir(self.cache_dir):
+      if not name.endswith('.npz'):
+        continue
+      try:
+        st = os.stat(os.path.join(self.cache_dir, name))
+      except OSError:
+        continue
+      files.append((st.st_mtime, st.st_size, name))
+    size = sum(f[1] for f in files)
+    if size > self.max_bytes:
+      # oldest first, down to 90% of the limit so that this does not run
+      # on every put
+      for _, file_size, name in sorted(files):
+        try:
+          os.remove(os.path.join(self.cache_dir, name))
+        except OSError:
+          pass
+        size -= file_size
+        if size <= 0.9 * self.max_bytes:
+          break
+    self._size = size
+    self._written = 0
+
+
+_image_cache = None
+
+
+def get_image_cache():
+  """The ImageCache of cfg.IMAGE_CACHE_DIR, None if it is disabled."""
+  global _image_cache
+  if not cfg.IMAGE_CACHE_DIR:
+    return None
+  if _image_cache is None or _image_cache.cache_dir != cfg.IMAGE_CACHE_DIR:
+    _image_cache = ImageCache(cfg.IMAGE_CACHE_DIR, cfg.IMAGE_CACHE_GB)
+  return _image_cache
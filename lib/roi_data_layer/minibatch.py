@@ -12,9 +12,10 @@ from __future__ import print_function
 
 import numpy as np
 # import numpy.random as npr
-from scipy.misc import imread
+import cv2
 from model.utils.config import cfg
-from model.utils.blob import prep_im_for_blob, im_list_to_blob
+from model.utils.blob import resize_im_for_blob, im_list_to_blob
+from roi_data_layer.image_cache import get_image_cache
 import pdb
 def get_minibatch(roidb, num_classes, random_scale_inds):
   """Given a roidb, construct a minibatch sampled from it."""
@@ -34,17 +35,7 @@ def get_minibatch(roidb, num_classes, random_scale_inds):
   assert len(im_scales) == 1, "Single batch only"
   assert len(roidb) == 1, "Single batch only"
   
-  # gt boxes: (x1, y1, x2, y2, cls)
-  if cfg.TRAIN.USE_ALL_GT:
-    # Include all ground truth boxes
-    gt_inds = np.where(roidb[0]['gt_classes'] != 0)[0]
-  else:
-    # For the COCO ground truth boxes, exclude the ones that are ''iscrowd'' 
-    gt_inds = np.where(roidb[0]['gt_classes'] != 0 & np.all(roidb[0]['gt_overlaps'].toarray() > -1.0, axis=1))[0]
-  gt_boxes = np.empty((len(gt_inds), 5), dtype=np.float32)
-  gt_boxes[:, 0:4] = roidb[0]['boxes'][gt_inds, :] * im_scales[0]
-  gt_boxes[:, 4] = roidb[0]['gt_classes'][gt_inds]
-  blobs['gt_boxes'] = gt_boxes
+  blobs['gt_boxes'] = get_gt_boxes(roidb[0], im_scales[0])
   blobs['im_info'] = np.array(
     [[im_blob.shape[1], im_blob.shape[2], im_scales[0]]],
     dtype=np.float32)
@@ -53,34 +44,56 @@ def get_minibatch(roidb, num_classes, random_scale_inds):
 
   return blobs
 
+def get_gt_boxes(roidb_entry, im_scale):
+  """gt boxes (x1, y1, x2, y2, cls) of a roidb entry at the given scale."""
+  if cfg.TRAIN.USE_ALL_GT:
+    # Include all ground truth boxes
+    gt_inds = np.where(roidb_entry['gt_classes'] != 0)[0]
+  else:
+    # For the COCO ground truth boxes, exclude the ones that are ''iscrowd'' 
+    gt_inds = np.where(roidb_entry['gt_classes'] != 0 & np.all(roidb_entry['gt_overlaps'].toarray() > -1.0, axis=1))[0]
+  gt_boxes = np.empty((len(gt_inds), 5), dtype=np.float32)
+  gt_boxes[:, 0:4] = roidb_entry['boxes'][gt_inds, :] * im_scale
+  gt_boxes[:, 4] = roidb_entry['gt_classes'][gt_inds]
+  return gt_boxes
+
 def _get_image_blob(roidb, scale_inds):
   """Builds an input blob from the images in the roidb at the specified
   scales.
   """
   num_images = len(roidb)
+  image_cache = get_image_cache()
 
   processed_ims = []
   im_scales = []
   for i in range(num_images):
-    #im = cv2.imread(roidb[i]['image'])
-    im = imread(roidb[i]['image'])
-
-    if len(im.shape) == 2:
-      im = im[:,:,np.newaxis]
-      im = np.concatenate((im,im,im), axis=2)
-    # flip the channel, since the original one using cv2
-    # rgb -> bgr
-    im = im[:,:,::-1]
-
-    if roidb[i]['flipped']:
-      im = im[:, ::-1, :]
     target_size = cfg.TRAIN.SCALES[scale_inds[i]]
-    im, im_scale = prep_im_for_blob(im, cfg.PIXEL_MEANS, target_size,
-                    cfg.TRAIN.MAX_SIZE)
+    cached = None
+    if image_cache is not None:
+      cached = image_cache.get(roidb[i]['image'], target_size, roidb[i]['flipped'])
+    if cached is None:
+      im, im_scale = _load_image(roidb[i]['image'], roidb[i]['flipped'], target_size)
+      if image_cache is not None:
+        image_cache.put(roidb[i]['image'], target_size, roidb[i]['flipped'], im, im_scale)
+    else:
+      im, im_scale = cached
     im_scales.append(im_scale)
     processed_ims.append(im)
 
-  # Create a blob to hold the input images
-  blob = im_list_to_blob(processed_ims)
+  # Create a blob to hold the input images, the means are subtracted while
+  # the uint8 images are converted into it
+  blob = im_list_to_blob(processed_ims, cfg.PIXEL_MEANS)
 
   return blob, im_scales
+
+def _load_image(path, flipped, target_size):
+  """Decoded BGR uint8 image, flipped and resized to target_size."""
+  # BGR, grayscale images get 3 channels. The boxes are in the stored
+  # orientation, whatever the EXIF data says
+  im = cv2.imread(path, cv2.IMREAD_COLOR | cv2.IMREAD_IGNORE_ORIENTATION)
+  if im is None:
+    raise IOError('Could not read image %s' % path)
+
+  if flipped:
+    im = im[:, ::-1, :]
+  return resize_im_for_blob(im, target_size, cfg.TRAIN.MAX_SIZE)
@@ -0,0 +1,105 @@
+"""Background prefetching of the training streams.
+
+A training step of train.py takes one detection batch and, with
+--meta_train, one support set and one defect-free image, each from its own
+DataLoader. StreamPrefetcher cycles over every loader in a thread of its
+own and keeps up to depth ready items per stream, so that the loaders
+without worker processes no longer load on the main thread between the
+optimizer steps. It records how long the training loop waited for every
+stream.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import sys
+import threading
+import time
+import traceback
+
+try:
+  import queue
+except ImportError:
+  import Queue as queue
+
+
+class _StreamError(object):
+  def __init__(self, name):
+    self.message = 'in the %s stream:\n%s' % (name, ''.join(traceback.format_exception(*sys.exc_info())))
+
+
+class StreamPrefetcher(object):
+  def __init__(self, streams, depth=2):
+    """streams: list of (name, loader), next() returns one item of every
+    loader in this order. A loader is iterated again when it runs out."""
+    self.names = [name for name, _ in streams]
+    self._queues = [queue.Queue(depth) for _ in streams]
+    self._stop = threading.Event()
+    # seconds the consumer waited and items it got, per stream
+    self.wait_time = dict((name, 0.) for name in self.names)
+    self.num_items = dict((name, 0) for name in self.names)
+
+    self._threads = []
+    for (name, loader), items in zip(streams, self._queues):
+      thread = threading.Thread(target=self._fill, args=(name, loader, items))
+      thread.daemon = True
+      thread.start()
+      self._threads.append(thread)
+
+  def _put(self, items, item):
+    while not self._stop.is_set():
+      try:
+        items.put(item, timeout=0.1)
+        return True
+      except queue.Full:
+        pass
+    return False
+
+  def _fill(self, name, loader, items):
+    try:
+      while not self._stop.is_set():
+        for item in loader:
+          if not self._put(items, item):
+            return
+    except Exception:
+      self._put(items, _StreamError(name))
+
+  def __iter__(self):
+    return self
+
+  def __next__(self):
+    batch = []
+    for name, items in zip(self.names, self._queues):
+      tic = time.time()
+      item = items.get()
+      self.wait_time[name] += time.time() - tic
+      self.num_items[name] += 1
+      if isinstance(item, _StreamError):
+        self.close()
+        raise RuntimeError(item.message)
+      batch.append(item)
+    return tuple(batch)
+
+  next = __next__
+
+  def wait_stats(self, reset=True):
+    """Mean wait per item in ms of every stream, since the last reset."""
+    stats = [(name, 1000. * self.wait_time[name] / max(self.num_items[name], 1)) for name in self.names]
+    if reset:
+      for name in self.names:
+        self.wait_time[name] = 0.
+        self.num_items[name] = 0
+    return stats
+
+  def close(self):
+    self._stop.set()
+    for items in self._queues:
+      # unblock a producer waiting for room
+      try:
+        while True:
+          items.get_nowait()
+      except queue.Empty:
+        pass
+    for thread in self._threads:
+      thread.join(1.)
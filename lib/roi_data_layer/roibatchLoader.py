@@ -11,7 +11,9 @@ from PIL import Image
 import torch
 
 from model.utils.config import cfg
-from roi_data_layer.minibatch import get_minibatch, get_minibatch
+from roi_data_layer.minibatch import get_minibatch, get_gt_boxes
+from roi_data_layer.feature_cache import FeatureCache
+from roi_data_layer.columnar_roidb import ColumnarRoidb
 from model.rpn.bbox_transform import bbox_transform_inv, clip_boxes
 
 import numpy as np
@@ -21,7 +23,8 @@ import time
 import pdb
 
 class roibatchLoader(data.Dataset):
-  def __init__(self, roidb, ratio_list, ratio_index, batch_size, num_classes, training=True, normalize=None):
+  def __init__(self, roidb, ratio_list, ratio_index, batch_size, num_classes, training=True, normalize=None,
+               feature_cache=None):
     self._roidb = roidb
     self._num_classes = num_classes
     # we make the height of image consistent to trim_height, trim_width
@@ -34,25 +37,94 @@ class roibatchLoader(data.Dataset):
     self.ratio_index = ratio_index
     self.batch_size = batch_size
     self.data_size = len(self.ratio_list)
+    # roi_data_layer.feature_cache.FeatureCache of the fixed backbone prefix
+    self.feature_cache = feature_cache
+    # training items are left for roi_data_layer.batch_assembler.BatchAssembler
+    # to pad into the batch, see __getitem__
+    self.assemble_batches = False
+
+    if isinstance(roidb, ColumnarRoidb):
+        self.need_crop = roidb.need_crop[ratio_index].astype(bool)
+    else:
+        self.need_crop = np.array([roidb[int(index_ratio)]['need_crop'] for index_ratio in ratio_index],
+                                  dtype=bool)
+
+    # scale of the items, redrawn at the first item of every batch; a worker
+    # can start on any item with a batch sampler that does not serve
+    # contiguous batches
+    self.random_scale_inds = npr.randint(0, high=len(cfg.TRAIN.SCALES), size=1)
 
     # given the ratio_list, we want to make the ratio same for each batch.
-    self.ratio_list_batch = torch.Tensor(self.data_size).zero_()
     num_batch = int(np.ceil(len(ratio_index) / batch_size))
-    for i in range(num_batch):
-        left_idx = i*batch_size
-        right_idx = min((i+1)*batch_size-1, self.data_size-1)
-
-        if ratio_list[right_idx] < 1:
+    self.set_batches([range(i*batch_size, min((i+1)*batch_size, self.data_size)) for i in range(num_batch)])
+
+  def set_batches(self, batches):
+    """Sets the target ratio of every item from the batch it is served in.
+    batches are lists of indices into ratio_list, a batch can also be a
+    bucket of items of the same ratio that is served in several batches.
+    A new random scale is drawn at the first item of each."""
+    ratio_list_batch = np.zeros(self.data_size, dtype=np.float32)
+    # a batch is served from the feature cache only if none of its images is
+    # randomly cropped, so that its items all have the same kind and size
+    self.cacheable = np.ones(self.data_size, dtype=bool)
+    # the items a new scale is drawn at, see __getitem__
+    self.batch_start = np.zeros(self.data_size, dtype=bool)
+    for batch in batches:
+        batch = np.asarray(batch, dtype=np.int64)
+        self.batch_start[batch[0]] = True
+        ratios = self.ratio_list[batch]
+        if ratios.max() < 1:
             # for ratio < 1, we preserve the leftmost in each batch.
-            target_ratio = ratio_list[left_idx]
-        elif ratio_list[left_idx] > 1:
+            target_ratio = ratios.min()
+        elif ratios.min() > 1:
             # for ratio > 1, we preserve the rightmost in each batch.
-            target_ratio = ratio_list[right_idx]
+            target_ratio = ratios.max()
         else:
             # for ratio cross 1, we make it to be 1.
             target_ratio = 1
 
-        self.ratio_list_batch[left_idx:(right_idx+1)] = target_ratio
+        ratio_list_batch[batch] = target_ratio
+        if self.training and self.need_crop[batch].any():
+            self.cacheable[batch] = False
+    self.ratio_list_batch = torch.from_numpy(ratio_list_batch)
+
+  def feature_cache_key(self, index):
+    """Key of the cached features of the index-th item, None if they can
+    not be cached."""
+    if not self.training or len(cfg.TRAIN.SCALES) != 1 \
+            or not self.cacheable[index]:
+        return None
+    index_ratio = int(self.ratio_index[index])
+    return FeatureCache.key(self._roidb[index_ratio], cfg.TRAIN.SCALES[0],
+                            self.ratio_list_batch[index])
+
+  def _pad_gt_boxes(self, gt_boxes):
+    # check the bounding box:
+    not_keep = (gt_boxes[:,0] == gt_boxes[:,2]) | (gt_boxes[:,1] == gt_boxes[:,3])
+    keep = torch.nonzero(not_keep == 0).view(-1)
+
+    gt_boxes_padding = torch.FloatTensor(self.max_num_box, gt_boxes.size(1)).zero_()
+    if keep.numel() != 0:
+        gt_boxes = gt_boxes[keep]
+        num_boxes = min(gt_boxes.size(0), self.max_num_box)
+        gt_boxes_padding[:num_boxes,:] = gt_boxes[:num_boxes]
+    else:
+        num_boxes = 0
+    return gt_boxes_padding, num_boxes
+
+  def _get_cached_item(self, index, key):
+    feat, im_info = self.feature_cache.get(key)
+    index_ratio = int(self.ratio_index[index])
+    gt_boxes = get_gt_boxes(self._roidb[index_ratio], im_info[2])
+    np.random.shuffle(gt_boxes)
+    gt_boxes = torch.from_numpy(gt_boxes)
+    if self.ratio_list_batch[index] == 1:
+        # the image was trimmed to a square, see __getitem__
+        gt_boxes[:, :4].clamp_(0, float(im_info[0]))
+    gt_boxes_padding, num_boxes = self._pad_gt_boxes(gt_boxes)
+
+    data = torch.from_numpy(np.array(feat, dtype=np.float32))
+    return data, torch.from_numpy(im_info), gt_boxes_padding, num_boxes
 
 
   def __getitem__(self, index):
@@ -61,11 +133,16 @@ class roibatchLoader(data.Dataset):
     else:
         index_ratio = index
 
+    if self.feature_cache is not None:
+        key = self.feature_cache_key(index)
+        if key is not None and key in self.feature_cache:
+            return self._get_cached_item(index, key)
+
     # get the anchor index for current sample index
     # here we set the anchor index to the last one
     # sample in this group
     minibatch_db = [self._roidb[index_ratio]]
-    if not index % self.batch_size:
+    if self.batch_start[index]:
         # Sample random scales to use for each image in this batch
         self.random_scale_inds = npr.randint(0, high=len(cfg.TRAIN.SCALES),
                                              size=len(minibatch_db))
@@ -92,7 +169,7 @@ class roibatchLoader(data.Dataset):
         # if the image need to crop, crop to the target size.
         ratio = self.ratio_list_batch[index]
 
-        if self._roidb[index_ratio]['need_crop']:
+        if self.need_crop[index]:
             if ratio < 1:
                 # this means that data_width << data_height, we need to crop the
                 # data_height
@@ -163,46 +240,31 @@ class roibatchLoader(data.Dataset):
         # based on the ratio, padding the image.
         if ratio < 1:
             # this means that data_width < data_height
-            trim_size = int(np.floor(data_width / ratio))
-
-            padding_data = torch.FloatTensor(int(np.ceil(data_width / ratio)), \
-                                             data_width, 3).zero_()
-
-            padding_data[:data_height, :, :] = data[0]
+            padded_size = (int(np.ceil(data_width / ratio)), data_width)
             # update im_info
-            im_info[0, 0] = padding_data.size(0)
-            # print("height %d %d \n" %(index, anchor_idx))
+            im_info[0, 0] = padded_size[0]
         elif ratio > 1:
             # this means that data_width > data_height
-            # if the image need to crop.
-            padding_data = torch.FloatTensor(data_height, \
-                                             int(np.ceil(data_height * ratio)), 3).zero_()
-            padding_data[:, :data_width, :] = data[0]
-            im_info[0, 1] = padding_data.size(1)
+            padded_size = (data_height, int(np.ceil(data_height * ratio)))
+            im_info[0, 1] = padded_size[1]
         else:
             trim_size = min(data_height, data_width)
-            padding_data = torch.FloatTensor(trim_size, trim_size, 3).zero_()
-            padding_data = data[0][:trim_size, :trim_size, :]
+            data = data[:, :trim_size, :trim_size, :]
+            padded_size = (trim_size, trim_size)
             gt_boxes[:, :4].clamp_(0, trim_size)
             im_info[0, 0] = trim_size
             im_info[0, 1] = trim_size
 
+        gt_boxes_padding, num_boxes = self._pad_gt_boxes(gt_boxes)
+        im_info = im_info.view(3)
 
-        # check the bounding box:
-        not_keep = (gt_boxes[:,0] == gt_boxes[:,2]) | (gt_boxes[:,1] == gt_boxes[:,3])
-        keep = torch.nonzero(not_keep == 0).view(-1)
-
-        gt_boxes_padding = torch.FloatTensor(self.max_num_box, gt_boxes.size(1)).zero_()
-        if keep.numel() != 0:
-            gt_boxes = gt_boxes[keep]
-            num_boxes = min(gt_boxes.size(0), self.max_num_box)
-            gt_boxes_padding[:num_boxes,:] = gt_boxes[:num_boxes]
-        else:
-            num_boxes = 0
+        if self.assemble_batches:
+            # BatchAssembler pads and transposes it straight into the batch
+            return data[0].numpy(), padded_size, im_info, gt_boxes_padding, num_boxes
 
-            # permute trim_data to adapt to downstream processing
-        padding_data = padding_data.permute(2, 0, 1).contiguous()
-        im_info = im_info.view(3)
+        # pad and permute to (3, H, W) in one copy
+        padding_data = torch.FloatTensor(3, padded_size[0], padded_size[1]).zero_()
+        padding_data[:, :data.size(1), :data.size(2)] = data[0].permute(2, 0, 1)
 
         return padding_data, im_info, gt_boxes_padding, num_boxes
     else:
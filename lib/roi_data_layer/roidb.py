@@ -3,11 +3,12 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import os
 import datasets
 import numpy as np
 from model.utils.config import cfg
 from datasets.factory import get_imdb
-import PIL
+from roi_data_layer.columnar_roidb import ColumnarRoidb
 import pdb
 import collections
 
@@ -21,8 +22,7 @@ def prepare_roidb(imdb):
 
   roidb = imdb.roidb
   if not (imdb.name.startswith('coco') or imdb.name.startswith('vg')):
-    sizes = [PIL.Image.open(imdb.image_path_at(i)).size
-         for i in range(imdb.num_images)]
+    sizes = imdb.image_sizes()
          
   for i in range(len(imdb.image_index)):
     roidb[i]['img_id'] = imdb.image_id_at(i)
@@ -135,6 +135,14 @@ def rank_roidb_ratio(roidb):
     ratio_large = 2 # largest ratio to preserve.
     ratio_small = 0.5 # smallest ratio to preserve.    
     
+    if isinstance(roidb, ColumnarRoidb):
+      widths, heights = roidb.entry_sizes()
+      ratio_list = widths / heights.astype(np.float64)
+      roidb.need_crop[:] = (ratio_list > ratio_large) | (ratio_list < ratio_small)
+      ratio_list = np.clip(ratio_list, ratio_small, ratio_large)
+      ratio_index = np.argsort(ratio_list)
+      return ratio_list[ratio_index], ratio_index
+
     ratio_list = []
     for i in range(len(roidb)):
       width = roidb[i]['width']
@@ -159,6 +167,11 @@ def rank_roidb_ratio(roidb):
 def filter_roidb(roidb):
     # filter the image without bounding box.
     print('before filtering, there are %d images...' % (len(roidb)))
+    if isinstance(roidb, ColumnarRoidb):
+      roidb = roidb.subset(np.where(roidb.num_boxes() > 0)[0])
+      print('after filtering, there are %d images...' % (len(roidb)))
+      return roidb
+
     i = 0
     while i < len(roidb):
       if len(roidb[i]['boxes']) == 0:
@@ -176,11 +189,6 @@ def combined_roidb(imdb_names, training=True):
 
   def get_training_roidb(imdb):
     """Returns a roidb (Region of Interest database) for use in training."""
-    if cfg.TRAIN.USE_FLIPPED:
-      print('Appending horizontally-flipped training examples...')
-      imdb.append_flipped_images()
-      print('done')
-
     print('Preparing training data...')
 
     prepare_roidb(imdb)
@@ -206,6 +214,13 @@ def combined_roidb(imdb_names, training=True):
   else:
     imdb = get_imdb(imdb_names)
 
+  # the flipped entries are made on the fly from the unflipped ones. Not
+  # under data/cache, whose files are removed at every start
+  print('Writing the columnar roidb...')
+  roidb = ColumnarRoidb.build(os.path.join(cfg.DATA_DIR, 'roidb', imdb_names), roidb,
+                              imdb.num_classes, flipped=cfg.TRAIN.USE_FLIPPED)
+  print('done')
+
   if training:
     roidb = filter_roidb(roidb)
 
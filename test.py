@@ -24,7 +24,7 @@ from roi_data_layer.roidb import combined_roidb
 from roi_data_layer.roibatchLoader import roibatchLoader
 from model.utils.config import cfg, cfg_from_file, cfg_from_list, get_output_dir
 from model.rpn.bbox_transform import clip_boxes
-from model.nms.nms_wrapper import nms
+from model.nms.nms_wrapper import multiclass_nms
 from model.rpn.bbox_transform import bbox_transform_inv
 from model.utils.net_utils import save_net, load_net, vis_detections, vis_detections_label_only
 
@@ -69,6 +69,9 @@ def parse_args():
     parser.add_argument('--shots', dest='shots',
                         help='the number of meta input',
                         default=10, type=int)
+    parser.add_argument('--no_compile_head', dest='compile_head', action='store_false',
+                        help='run the class attentions one class at a time instead of folding '
+                             'their mean into fc1')
     parser.add_argument('--phase', dest='phase',
                         help='the phase of training process',
                         default=2, type=int)
@@ -186,6 +189,9 @@ if __name__ == '__main__':
                          str(args.phase) + '_shots_' + str(args.shots) + '_normal_mean_class_attentions.pkl'),
             'rb'))
 
+    if args.meta_test and args.compile_head:
+        fasterRCNN.compile_meta_test_head(mean_class_attentions, normal_mean_class_attentions)
+
     save_name = '{}_{}'.format(args.save_dir, args.checkepoch)
     num_images = len(imdb.image_index)
     all_boxes = [[[] for _ in range(num_images)] for _ in range(imdb.num_classes)]
@@ -311,35 +317,18 @@ if __name__ == '__main__':
             im = cv2.imread(imdb.image_path_at(int(data[4])))
             im2show = np.copy(im)
         #print(imdb.num_classes)
+        cls_dets_list = multiclass_nms(pred_boxes, scores, thresh, cfg.TEST.NMS,
+                                       max_per_image, args.class_agnostic, mode=cfg.TEST.MODE)
         for j in range(1, imdb.num_classes):
-            inds = torch.nonzero(scores[:, j] > thresh).view(-1)
+            cls_dets = cls_dets_list[j]
             # if there is det
-            if inds.numel() > 0:
-                cls_scores = scores[:, j][inds]
-                _, order = torch.sort(cls_scores, 0, True)
-                if args.class_agnostic:
-                    cls_boxes = pred_boxes[inds, :]
-                else:
-                    cls_boxes = pred_boxes[inds][:, j * 4:(j + 1) * 4]
-                cls_dets = torch.cat((cls_boxes, cls_scores.unsqueeze(1)), 1)
-                cls_dets = cls_dets[order]
-                keep = nms(cls_dets, cfg.TEST.NMS)
-                cls_dets = cls_dets[keep.view(-1).long()]
+            if cls_dets is not None:
                 if vis:
                     im2show = vis_detections_label_only(im2show, imdb.classes[j], cls_dets.cpu().numpy(), 0.3)
                 all_boxes[j][i] = cls_dets.cpu().numpy()
             else:
                 all_boxes[j][i] = empty_array
 
-        # Limit to max_per_image detections *over all classes*
-        if max_per_image > 0:
-            image_scores = np.hstack([all_boxes[j][i][:, -1] for j in range(1, imdb.num_classes)])
-            if len(image_scores) > max_per_image:
-                image_thresh = np.sort(image_scores)[-max_per_image]
-                for j in range(1, imdb.num_classes):
-                    keep = np.where(all_boxes[j][i][:, -1] >= image_thresh)[0]
-                    all_boxes[j][i] = all_boxes[j][i][keep, :]
-
         misc_toc = time.time()
         nms_time = misc_toc - misc_tic
 
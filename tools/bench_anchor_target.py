@@ -0,0 +1,153 @@
+# --------------------------------------------------------
+# Speed of the batched RPN anchor target layer against the image by image
+# numpy subsampling and _unmap it replaced
+# --------------------------------------------------------
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import _init_paths
+import argparse
+import time
+import numpy as np
+import torch
+
+from model.utils.config import cfg
+from model.rpn.anchor_target_layer import _AnchorTargetLayer, _compute_targets_batch
+from model.rpn.bbox_transform import bbox_overlaps_batch
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark the anchor target layer')
+    parser.add_argument('--bs', dest='batch_size', default=8, type=int)
+    parser.add_argument('--feat', dest='feat_size', default=38, type=int)
+    parser.add_argument('--gt', dest='max_gt', default=3, type=int,
+                        help='images have 1 to this many gt boxes')
+    parser.add_argument('--iters', dest='iters', default=20, type=int)
+    parser.add_argument('--cuda', dest='cuda', action='store_true')
+    return parser.parse_args()
+
+
+def _unmap(data, count, inds, batch_size, fill=0):
+    if data.dim() == 2:
+        ret = torch.Tensor(batch_size, count).fill_(fill).type_as(data)
+        ret[:, inds] = data
+    else:
+        ret = torch.Tensor(batch_size, count, data.size(2)).fill_(fill).type_as(data)
+        ret[:, inds, :] = data
+    return ret
+
+
+def anchor_target_loop(layer, input):
+    """The previous forward, subsampling image by image with numpy and
+    unmapping into freshly allocated outputs."""
+    rpn_cls_score, gt_boxes, im_info, num_boxes = input
+    height, width = rpn_cls_score.size(2), rpn_cls_score.size(3)
+    batch_size = gt_boxes.size(0)
+    all_anchors = layer._anchor_grid(height, width, layer._feat_stride, gt_boxes)
+    A = layer._num_anchors
+    total_anchors = all_anchors.size(0)
+    keep = ((all_anchors[:, 0] >= 0) & (all_anchors[:, 1] >= 0) &
+            (all_anchors[:, 2] < int(im_info[0][1])) & (all_anchors[:, 3] < int(im_info[0][0])))
+    inds_inside = torch.nonzero(keep).view(-1)
+    anchors = all_anchors[inds_inside, :]
+
+    labels = gt_boxes.new(batch_size, inds_inside.size(0)).fill_(-1)
+    bbox_inside_weights = gt_boxes.new(batch_size, inds_inside.size(0)).zero_()
+    bbox_outside_weights = gt_boxes.new(batch_size, inds_inside.size(0)).zero_()
+    overlaps = bbox_overlaps_batch(anchors, gt_boxes)
+    max_overlaps, argmax_overlaps = torch.max(overlaps, 2)
+    gt_max_overlaps, _ = torch.max(overlaps, 1)
+    labels[max_overlaps < cfg.TRAIN.RPN_NEGATIVE_OVERLAP] = 0
+    gt_max_overlaps[gt_max_overlaps == 0] = 1e-5
+    keep = torch.sum(overlaps.eq(gt_max_overlaps.view(batch_size, 1, -1).expand_as(overlaps)), 2)
+    if torch.sum(keep) > 0:
+        labels[keep > 0] = 1
+    labels[max_overlaps >= cfg.TRAIN.RPN_POSITIVE_OVERLAP] = 1
+
+    num_fg = int(cfg.TRAIN.RPN_FG_FRACTION * cfg.TRAIN.RPN_BATCHSIZE)
+    sum_fg = torch.sum((labels == 1).int(), 1)
+    sum_bg = torch.sum((labels == 0).int(), 1)
+    for i in range(batch_size):
+        if sum_fg[i] > num_fg:
+            fg_inds = torch.nonzero(labels[i] == 1).view(-1)
+            rand_num = torch.from_numpy(np.random.permutation(fg_inds.size(0))).type_as(gt_boxes).long()
+            labels[i][fg_inds[rand_num[:fg_inds.size(0) - num_fg]]] = -1
+        num_bg = cfg.TRAIN.RPN_BATCHSIZE - sum_fg[i]
+        if sum_bg[i] > num_bg:
+            bg_inds = torch.nonzero(labels[i] == 0).view(-1)
+            rand_num = torch.from_numpy(np.random.permutation(bg_inds.size(0))).type_as(gt_boxes).long()
+            labels[i][bg_inds[rand_num[:bg_inds.size(0) - num_bg]]] = -1
+
+    offset = torch.arange(0, batch_size) * gt_boxes.size(1)
+    argmax_overlaps = argmax_overlaps + offset.view(batch_size, 1).type_as(argmax_overlaps)
+    bbox_targets = _compute_targets_batch(anchors, gt_boxes.view(-1, 5)[argmax_overlaps.view(-1), :].view(batch_size, -1, 5))
+    bbox_inside_weights[labels == 1] = cfg.TRAIN.RPN_BBOX_INSIDE_WEIGHTS[0]
+    num_examples = torch.sum(labels[batch_size - 1] >= 0)
+    bbox_outside_weights[labels == 1] = 1.0 / num_examples
+    bbox_outside_weights[labels == 0] = 1.0 / num_examples
+
+    labels = _unmap(labels, total_anchors, inds_inside, batch_size, fill=-1)
+    bbox_targets = _unmap(bbox_targets, total_anchors, inds_inside, batch_size, fill=0)
+    bbox_inside_weights = _unmap(bbox_inside_weights, total_anchors, inds_inside, batch_size, fill=0)
+    bbox_outside_weights = _unmap(bbox_outside_weights, total_anchors, inds_inside, batch_size, fill=0)
+
+    labels = labels.view(batch_size, height, width, A).permute(0, 3, 1, 2).contiguous()
+    labels = labels.view(batch_size, 1, A * height, width)
+    bbox_targets = bbox_targets.view(batch_size, height, width, A * 4).permute(0, 3, 1, 2).contiguous()
+    bbox_inside_weights = bbox_inside_weights.view(batch_size, -1, 1).expand(batch_size, total_anchors, 4)
+    bbox_inside_weights = bbox_inside_weights.contiguous().view(batch_size, height, width, 4 * A) \
+        .permute(0, 3, 1, 2).contiguous()
+    bbox_outside_weights = bbox_outside_weights.view(batch_size, -1, 1).expand(batch_size, total_anchors, 4)
+    bbox_outside_weights = bbox_outside_weights.contiguous().view(batch_size, height, width, 4 * A) \
+        .permute(0, 3, 1, 2).contiguous()
+    return [labels, bbox_targets, bbox_inside_weights, bbox_outside_weights]
+
+
+def random_input(args, num_anchors, stride):
+    batch_size = args.batch_size
+    im_size = args.feat_size * stride
+    num_boxes = torch.LongTensor(batch_size).random_(1, args.max_gt + 1)
+    gt_boxes = torch.zeros(batch_size, cfg.MAX_NUM_GT_BOXES, 5)
+    for i in range(batch_size):
+        n = int(num_boxes[i])
+        xy = torch.rand(n, 2) * im_size * 0.5
+        gt_boxes[i, :n, :2] = xy
+        gt_boxes[i, :n, 2:4] = xy + torch.rand(n, 2) * im_size * 0.4 + 20
+        gt_boxes[i, :n, 4] = 1
+    rpn_cls_score = torch.zeros(batch_size, num_anchors * 2, args.feat_size, args.feat_size)
+    im_info = torch.Tensor([[im_size, im_size, 1.]]).expand(batch_size, 3).contiguous()
+    if args.cuda:
+        rpn_cls_score, gt_boxes, im_info, num_boxes = \
+            rpn_cls_score.cuda(), gt_boxes.cuda(), im_info.cuda(), num_boxes.cuda()
+    return rpn_cls_score, gt_boxes, im_info, num_boxes
+
+
+def timeit(fn, input, iters, cuda):
+    for i in range(iters + 1):
+        # the first call warms up
+        if i == 1:
+            if cuda:
+                torch.cuda.synchronize()
+            tic = time.time()
+        outputs = fn(input)
+    if cuda:
+        torch.cuda.synchronize()
+    return outputs, (time.time() - tic) / iters
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    torch.manual_seed(3)
+    np.random.seed(3)
+    layer = _AnchorTargetLayer(cfg.FEAT_STRIDE[0], cfg.ANCHOR_SCALES, cfg.ANCHOR_RATIOS)
+    input = random_input(args, layer._num_anchors, cfg.FEAT_STRIDE[0])
+
+    ref, ref_time = timeit(lambda x: anchor_target_loop(layer, x), input, args.iters, args.cuda)
+    out, new_time = timeit(layer, input, args.iters, args.cuda)
+    # the sampled anchors differ, their numbers per image do not
+    same = all(bool(((ref[0] == l).view(args.batch_size, -1).sum(1) == (out[0] == l).view(args.batch_size, -1).sum(1)).all())
+               for l in (0, 1))
+    print('%dx%dx%d anchors, bs %d: loop %.2fms, batched %.2fms, speedup %.1fx, same fg/bg counts: %s'
+          % (args.feat_size, args.feat_size, layer._num_anchors, args.batch_size,
+             ref_time * 1000, new_time * 1000, ref_time / new_time, same))
@@ -0,0 +1,142 @@
+# --------------------------------------------------------
+# Peak memory and latency of the chunked bbox_overlaps_batch against the
+# dense (b, N, K, 4) version it replaced
+# --------------------------------------------------------
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import _init_paths
+import argparse
+import resource
+import subprocess
+import sys
+import time
+import torch
+
+from model.utils.config import cfg
+from model.rpn.bbox_transform import bbox_overlaps_batch
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark bbox_overlaps_batch')
+    parser.add_argument('--bs', dest='batch_size', default=4, type=int)
+    parser.add_argument('--gt', dest='max_gt', default=3, type=int,
+                        help='images have 1 to this many real gt boxes')
+    parser.add_argument('--iters', dest='iters', default=20, type=int)
+    parser.add_argument('--cuda', dest='cuda', action='store_true')
+    # internal, a single run in a fresh process so that the peak memory is its own
+    parser.add_argument('--mode', dest='mode', default=None, choices=['dense', 'chunked'])
+    parser.add_argument('--case', dest='case', default='anchor_target', choices=['anchor_target', 'proposal_target'])
+    return parser.parse_args()
+
+
+def bbox_overlaps_dense(anchors, gt_boxes):
+    """The previous bbox_overlaps_batch, over all K padded gt boxes."""
+    batch_size = gt_boxes.size(0)
+    if anchors.dim() == 2:
+        N = anchors.size(0)
+        anchors = anchors.view(1, N, 4).expand(batch_size, N, 4).contiguous()
+    else:
+        N = anchors.size(1)
+        anchors = anchors[:,:,:4].contiguous() if anchors.size(2) == 4 else anchors[:,:,1:5].contiguous()
+    K = gt_boxes.size(1)
+    gt_boxes = gt_boxes[:,:,:4].contiguous()
+
+    gt_boxes_x = (gt_boxes[:,:,2] - gt_boxes[:,:,0] + 1)
+    gt_boxes_y = (gt_boxes[:,:,3] - gt_boxes[:,:,1] + 1)
+    gt_boxes_area = (gt_boxes_x * gt_boxes_y).view(batch_size, 1, K)
+    anchors_boxes_x = (anchors[:,:,2] - anchors[:,:,0] + 1)
+    anchors_boxes_y = (anchors[:,:,3] - anchors[:,:,1] + 1)
+    anchors_area = (anchors_boxes_x * anchors_boxes_y).view(batch_size, N, 1)
+    gt_area_zero = (gt_boxes_x == 1) & (gt_boxes_y == 1)
+    anchors_area_zero = (anchors_boxes_x == 1) & (anchors_boxes_y == 1)
+
+    boxes = anchors.view(batch_size, N, 1, 4).expand(batch_size, N, K, 4)
+    query_boxes = gt_boxes.view(batch_size, 1, K, 4).expand(batch_size, N, K, 4)
+    iw = (torch.min(boxes[:,:,:,2], query_boxes[:,:,:,2]) -
+        torch.max(boxes[:,:,:,0], query_boxes[:,:,:,0]) + 1)
+    iw[iw < 0] = 0
+    ih = (torch.min(boxes[:,:,:,3], query_boxes[:,:,:,3]) -
+        torch.max(boxes[:,:,:,1], query_boxes[:,:,:,1]) + 1)
+    ih[ih < 0] = 0
+    ua = anchors_area + gt_boxes_area - (iw * ih)
+    overlaps = iw * ih / ua
+    overlaps.masked_fill_(gt_area_zero.view(batch_size, 1, K).expand(batch_size, N, K), 0)
+    overlaps.masked_fill_(anchors_area_zero.view(batch_size, N, 1).expand(batch_size, N, K), -1)
+    return overlaps
+
+
+def random_boxes(size, im_size=600):
+    xy = torch.rand(*(size + (2,))) * im_size * 0.8
+    wh = torch.rand(*(size + (2,))) * im_size * 0.4 + 1
+    return torch.cat((xy, (xy + wh).clamp(max=im_size - 1)), len(size))
+
+
+def make_input(args):
+    """Anchors of a 38x38 map or 2000 proposals plus the appended gt rows,
+    and gt boxes padded to MAX_NUM_GT_BOXES."""
+    batch_size, K = args.batch_size, cfg.MAX_NUM_GT_BOXES
+    num_boxes = torch.LongTensor(batch_size).random_(1, args.max_gt + 1)
+    gt_boxes = torch.zeros(batch_size, K, 5)
+    for i in range(batch_size):
+        gt_boxes[i, :num_boxes[i], :4] = random_boxes((int(num_boxes[i]),))
+        gt_boxes[i, :num_boxes[i], 4] = 1
+    if args.case == 'anchor_target':
+        anchors = random_boxes((38 * 38 * 9,))
+    else:
+        anchors = torch.zeros(batch_size, cfg.TRAIN.RPN_POST_NMS_TOP_N + K, 5)
+        anchors[:, :cfg.TRAIN.RPN_POST_NMS_TOP_N, 1:] = random_boxes((batch_size, cfg.TRAIN.RPN_POST_NMS_TOP_N))
+        anchors[:, cfg.TRAIN.RPN_POST_NMS_TOP_N:, 1:] = gt_boxes[:, :, :4]
+    if args.cuda:
+        anchors, gt_boxes, num_boxes = anchors.cuda(), gt_boxes.cuda(), num_boxes.cuda()
+    return anchors, gt_boxes, num_boxes
+
+
+def run(args):
+    torch.manual_seed(3)
+    anchors, gt_boxes, num_boxes = make_input(args)
+    if args.mode == 'dense':
+        fn = lambda: bbox_overlaps_dense(anchors, gt_boxes)
+    else:
+        fn = lambda: bbox_overlaps_batch(anchors, gt_boxes, num_boxes)
+
+    if args.cuda:
+        torch.cuda.synchronize()
+        base = torch.cuda.memory_allocated()
+        torch.cuda.reset_max_memory_allocated()
+    else:
+        # kilobytes on linux
+        base = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024.
+    overlaps = fn()
+    tic = time.time()
+    for _ in range(args.iters):
+        overlaps = fn()
+    if args.cuda:
+        torch.cuda.synchronize()
+        peak = torch.cuda.max_memory_allocated() - base
+    else:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024. - base
+    print('%.2f %.6f %.6f' % (peak / 1024. ** 2, (time.time() - tic) / args.iters, float(overlaps.sum())))
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args.mode is not None:
+        run(args)
+        sys.exit(0)
+
+    device = 'cuda' if args.cuda else 'cpu'
+    for case in ('anchor_target', 'proposal_target'):
+        results = {}
+        for mode in ('dense', 'chunked'):
+            cmd = [sys.executable, __file__, '--mode', mode, '--case', case, '--bs', str(args.batch_size),
+                   '--gt', str(args.max_gt), '--iters', str(args.iters)]
+            if args.cuda:
+                cmd.append('--cuda')
+            out = subprocess.check_output(cmd).decode().strip().split('\n')[-1]
+            results[mode] = [float(x) for x in out.split()]
+        print('%s, bs %d, 1-%d of %d gt: %s peak memory %.1fMB -> %.1fMB, %.5fs -> %.5fs, same sum: %s'
+              % (case, args.batch_size, args.max_gt, cfg.MAX_NUM_GT_BOXES, device,
+                 results['dense'][0], results['chunked'][0], results['dense'][1], results['chunked'][1],
+                 results['dense'][2] == results['chunked'][2]))
@@ -0,0 +1,86 @@
+# --------------------------------------------------------
+# Peak memory and step time of the backbone with and without running the
+# fixed prefix volatile
+# --------------------------------------------------------
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import _init_paths
+import argparse
+import resource
+import subprocess
+import sys
+import time
+import torch
+from torch.autograd import Variable
+
+from model.utils.config import cfg
+from model.faster_rcnn.resnet import resnet
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark the fixed backbone prefix')
+    parser.add_argument('--bs', dest='batch_sizes', nargs='+', default=[4, 8], type=int)
+    parser.add_argument('--size', dest='im_size', default=600, type=int)
+    parser.add_argument('--iters', dest='iters', default=3, type=int)
+    parser.add_argument('--cuda', dest='cuda', action='store_true')
+    # internal, a single run in a fresh process so that the peak memory is its own
+    parser.add_argument('--mode', dest='mode', default=None, choices=['graph', 'volatile'])
+    return parser.parse_args()
+
+
+def run(args, batch_size):
+    classes = ['__background__'] + ['defect%d' % i for i in range(10)]
+    model = resnet(classes, 101, pretrained=False, meta_train=False)
+    model.create_architecture()
+    model.train()
+    im_data = torch.randn(batch_size, 3, args.im_size, args.im_size)
+    if args.cuda:
+        model.cuda()
+        im_data = im_data.cuda()
+    im_data = Variable(im_data)
+
+    step_time = 0
+    for i in range(args.iters + 1):
+        tic = time.time()
+        if args.mode == 'graph':
+            base_feat = model.RCNN_base(model.rcnn_conv1(im_data))
+        else:
+            base_feat = model._im_to_base_feat(im_data)
+        base_feat.mean().backward()
+        if args.cuda:
+            torch.cuda.synchronize()
+        # the first step warms up
+        if i > 0:
+            step_time += time.time() - tic
+        model.zero_grad()
+
+    if args.cuda:
+        peak = torch.cuda.max_memory_allocated() / 1024. ** 2
+    else:
+        # kilobytes on linux
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+    print('%d %.1f %.4f' % (batch_size, peak, step_time / args.iters))
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    print('FIXED_BLOCKS = %d' % cfg.RESNET.FIXED_BLOCKS)
+    if args.mode is not None:
+        run(args, args.batch_sizes[0])
+        sys.exit(0)
+
+    device = 'cuda' if args.cuda else 'cpu'
+    for batch_size in args.batch_sizes:
+        results = {}
+        for mode in ('graph', 'volatile'):
+            cmd = [sys.executable, __file__, '--mode', mode, '--bs', str(batch_size),
+                   '--size', str(args.im_size), '--iters', str(args.iters)]
+            if args.cuda:
+                cmd.append('--cuda')
+            out = subprocess.check_output(cmd).decode().strip().split('\n')[-1]
+            results[mode] = [float(x) for x in out.split()[1:]]
+        print('bs %d, %s peak memory %.0fMB -> %.0fMB, step time %.3fs -> %.3fs'
+              % (batch_size, device, results['graph'][0], results['volatile'][0],
+                 results['graph'][1], results['volatile'][1]))
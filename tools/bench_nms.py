@@ -0,0 +1,59 @@
+# --------------------------------------------------------
+# Speed of the tiled bitmask CPU NMS against the reference nms_cpu
+# --------------------------------------------------------
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import _init_paths
+import argparse
+import time
+import numpy as np
+import torch
+
+from model.nms.nms_cpu import nms_cpu, nms_cpu_bitmask
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark CPU NMS')
+    parser.add_argument('--boxes', dest='num_boxes', nargs='+', default=[1000, 6000, 12000], type=int)
+    parser.add_argument('--thresh', dest='thresh', default=0.7, type=float)
+    parser.add_argument('--size', dest='im_size', default=600, type=int)
+    parser.add_argument('--iters', dest='iters', default=3, type=int)
+    return parser.parse_args()
+
+
+def random_dets(num_boxes, im_size):
+    """Proposal-like boxes, jittered copies of a few objects so that NMS has
+    work to do."""
+    num_objects = num_boxes // 20 + 1
+    centers = np.random.rand(num_objects, 2) * im_size
+    sizes = np.random.rand(num_objects, 2) * (im_size / 3.) + 16
+    objects = np.random.randint(0, num_objects, num_boxes)
+    wh = sizes[objects] * np.exp(np.random.randn(num_boxes, 2) * 0.2)
+    xy = centers[objects] + np.random.randn(num_boxes, 2) * wh * 0.1
+    dets = np.zeros((num_boxes, 5), dtype=np.float32)
+    dets[:, 0:2] = xy - wh / 2
+    dets[:, 2:4] = xy + wh / 2
+    dets[:, 4] = np.random.rand(num_boxes)
+    return torch.from_numpy(dets)
+
+
+def timeit(fn, dets, thresh, iters):
+    tic = time.time()
+    for _ in range(iters):
+        keep = fn(dets, thresh)
+    return keep, (time.time() - tic) / iters
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    np.random.seed(3)
+
+    for num_boxes in args.num_boxes:
+        dets = random_dets(num_boxes, args.im_size)
+        keep_ref, ref_time = timeit(nms_cpu, dets, args.thresh, args.iters)
+        keep, bitmask_time = timeit(nms_cpu_bitmask, dets, args.thresh, args.iters)
+        same = keep.numel() == keep_ref.numel() and bool((keep == keep_ref).all())
+        print('%6d boxes, %5d kept: nms_cpu %.4fs, bitmask %.4fs, speedup %.1fx, same keep: %s'
+              % (num_boxes, keep_ref.numel(), ref_time, bitmask_time, ref_time / bitmask_time, same))
@@ -0,0 +1,124 @@
+# --------------------------------------------------------
+# Step time and loss curve of second phase meta training with the
+# defect-free attentions computed every step, against the running mean
+# refreshed every few steps
+# --------------------------------------------------------
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import _init_paths
+import argparse
+import copy
+import time
+import numpy as np
+import torch
+from torch.autograd import Variable
+
+from model.utils.config import cfg
+from model.faster_rcnn.resnet import resnet
+from model.faster_rcnn.normal_attention import NormalAttentionBank
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark the defect-free attention bank')
+    parser.add_argument('--bs', dest='batch_size', default=2, type=int)
+    parser.add_argument('--size', dest='im_size', default=600, type=int)
+    parser.add_argument('--prn_size', dest='prn_size', default=224, type=int)
+    parser.add_argument('--steps', dest='steps', default=50, type=int)
+    parser.add_argument('--lr', dest='lr', default=1e-4, type=float)
+    parser.add_argument('--refresh', dest='refresh', default=10, type=int)
+    parser.add_argument('--momentum', dest='momentum', default=0.9, type=float)
+    parser.add_argument('--batch', dest='batch', default=1, type=int,
+                        help='number of the latest defect-free images a refresh runs on')
+    parser.add_argument('--cuda', dest='cuda', action='store_true')
+    return parser.parse_args()
+
+
+def synthetic_data(args, num_classes):
+    rng = np.random.RandomState(0)
+    prn_data = torch.from_numpy(rng.randn(num_classes, 4, args.prn_size, args.prn_size).astype(np.float32))
+    prn_cls = [torch.LongTensor([i]) for i in range(num_classes)]
+    normal_images = [torch.from_numpy(rng.randn(3, args.prn_size, args.prn_size).astype(np.float32))
+                     for _ in range(8)]
+    batches = []
+    for step in range(args.steps):
+        im_data = torch.from_numpy(rng.randn(args.batch_size, 3, args.im_size, args.im_size).astype(np.float32))
+        im_info = torch.FloatTensor([[args.im_size, args.im_size, 1.]] * args.batch_size)
+        gt_boxes = torch.zeros(args.batch_size, 20, 5)
+        for i in range(args.batch_size):
+            for j in range(2):
+                x1, y1 = rng.randint(0, args.im_size // 2, 2)
+                w, h = rng.randint(args.im_size // 8, args.im_size // 2, 2)
+                # half of the boxes are of the novel classes
+                cls = rng.randint(1, num_classes + 1)
+                gt_boxes[i, j] = torch.FloatTensor([x1, y1, x1 + w, y1 + h, cls])
+        num_boxes = torch.LongTensor([2] * args.batch_size)
+        batches.append((im_data, im_info, gt_boxes, num_boxes))
+    return prn_data, prn_cls, normal_images, batches
+
+
+def run(args, model, init_state, data, normal_bank):
+    prn_data, prn_cls, normal_images, batches = data
+    model.load_state_dict(init_state)
+    params = [p for p in model.parameters() if p.requires_grad]
+    optimizer = torch.optim.SGD(params, lr=args.lr, momentum=cfg.TRAIN.MOMENTUM)
+
+    def variable(x):
+        return Variable(x.cuda() if args.cuda else x)
+
+    losses, step_time = [], 0.
+    for step, (im_data, im_info, gt_boxes, num_boxes) in enumerate(batches):
+        # the rois are sampled the same way in both runs
+        np.random.seed(step)
+        torch.manual_seed(step)
+        tic = time.time()
+        normal_image = normal_images[step % len(normal_images)]
+        if normal_bank is None:
+            normal_data_list, normal_attentions = [variable(normal_image)], None
+        else:
+            normal_data_list, normal_attentions = [], normal_bank(model, normal_image, args.cuda)
+        _, rpn_loss_cls, rpn_loss_box, RCNN_loss_cls, RCNN_loss_bbox, _, _, _, meta_loss = \
+            model([variable(prn_data), variable(im_data)], [prn_cls, variable(im_info)],
+                  [None, variable(gt_boxes)], [None, variable(num_boxes)], normal_data_list, [None],
+                  phase2=True, normal_attentions=normal_attentions)
+        loss = rpn_loss_cls.mean() + rpn_loss_box.mean() + RCNN_loss_cls.sum() / args.batch_size \
+               + RCNN_loss_bbox.sum() / args.batch_size
+        optimizer.zero_grad()
+        loss.backward()
+        torch.nn.utils.clip_grad_norm(params, 10.)
+        optimizer.step()
+        if args.cuda:
+            torch.cuda.synchronize()
+        # the first step warms up
+        if step > 0:
+            step_time += time.time() - tic
+        losses.append(float(loss.data.view(-1)[0]))
+    return np.array(losses), step_time / max(args.steps - 1, 1)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    classes = ['__background__'] + ['defect%d' % i for i in range(len(cfg.TRAIN.ALLCLASSES))]
+    model = resnet(classes, 101, pretrained=False, meta_train=True, meta_loss=False)
+    model.create_architecture()
+    if args.cuda:
+        model.cuda()
+    model.train()
+    init_state = copy.deepcopy(model.state_dict())
+    data = synthetic_data(args, len(cfg.TRAIN.ALLCLASSES))
+
+    every_losses, every_time = run(args, model, init_state, data, None)
+    normal_bank = NormalAttentionBank(args.refresh, args.momentum, args.batch)
+    bank_losses, bank_time = run(args, model, init_state, data, normal_bank)
+
+    device = 'cuda' if args.cuda else 'cpu'
+    print('%s, bs %d, %d steps' % (device, args.batch_size, args.steps))
+    print('step loss: every step / refresh every %d' % args.refresh)
+    for step in range(0, args.steps, max(args.steps // 10, 1)):
+        print('  %4d  %.4f  %.4f' % (step, every_losses[step], bank_losses[step]))
+    print('step time %.3fs -> %.3fs (%.1f%% less), defect-free prn on %d of %d steps'
+          % (every_time, bank_time, 100. * (1 - bank_time / every_time), normal_bank.refreshes, normal_bank.steps))
+    drift = np.abs(bank_losses - every_losses)
+    print('loss drift: mean %.4f (%.2f%% of the mean loss), max %.4f, last 10 steps %.4f'
+          % (drift.mean(), 100. * drift.mean() / np.abs(every_losses).mean(), drift.max(), drift[-10:].mean()))
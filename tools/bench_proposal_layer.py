@@ -0,0 +1,101 @@
+# --------------------------------------------------------
+# Speed of the RPN proposal layer, batched top-k and NMS against the
+# image by image sort and NMS it replaced
+# --------------------------------------------------------
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import _init_paths
+import argparse
+import time
+import numpy as np
+import torch
+
+from model.utils.config import cfg
+from model.rpn.proposal_layer import _ProposalLayer
+from model.rpn.bbox_transform import bbox_transform_inv, clip_boxes
+from model.nms.nms_wrapper import nms
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark the proposal layer')
+    parser.add_argument('--bs', dest='batch_sizes', nargs='+', default=[1, 4, 8], type=int)
+    parser.add_argument('--size', dest='im_size', default=600, type=int)
+    parser.add_argument('--iters', dest='iters', default=3, type=int)
+    parser.add_argument('--cuda', dest='cuda', action='store_true')
+    return parser.parse_args()
+
+
+def proposal_loop(layer, input):
+    """The previous forward: a full sort of all anchors, then NMS image by
+    image. With the min size filter, so that both keep the same boxes."""
+    scores = input[0][:, layer._num_anchors:, :, :]
+    bbox_deltas, im_info, cfg_key = input[1:]
+    pre_nms_topN = cfg[cfg_key].RPN_PRE_NMS_TOP_N
+    post_nms_topN = cfg[cfg_key].RPN_POST_NMS_TOP_N
+    batch_size = bbox_deltas.size(0)
+
+    anchors = layer._anchor_grid(scores.size(2), scores.size(3), layer._feat_stride, scores)
+    anchors = anchors.view(1, -1, 4).expand(batch_size, anchors.size(0), 4)
+    bbox_deltas = bbox_deltas.permute(0, 2, 3, 1).contiguous().view(batch_size, -1, 4)
+    scores = scores.permute(0, 2, 3, 1).contiguous().view(batch_size, -1)
+    proposals = clip_boxes(bbox_transform_inv(anchors, bbox_deltas, batch_size), im_info, batch_size)
+    keep = layer._filter_boxes(proposals, cfg[cfg_key].RPN_MIN_SIZE * im_info[:, 2])
+    scores = scores.masked_fill(keep == 0, -1)
+    _, order = torch.sort(scores, 1, True)
+
+    output = scores.new(batch_size, post_nms_topN, 5).zero_()
+    for i in range(batch_size):
+        order_single = order[i][:pre_nms_topN]
+        order_single = order_single[scores[i][order_single] >= 0]
+        proposals_single = proposals[i][order_single, :]
+        scores_single = scores[i][order_single].view(-1, 1)
+        keep_idx_i = nms(torch.cat((proposals_single, scores_single), 1), cfg[cfg_key].RPN_NMS_THRESH)
+        keep_idx_i = keep_idx_i.long().view(-1)[:post_nms_topN]
+        output[i, :, 0] = i
+        output[i, :keep_idx_i.numel(), 1:] = proposals_single[keep_idx_i, :]
+    return output
+
+
+def random_input(batch_size, im_size, num_anchors, stride, cuda):
+    feat_size = int(np.ceil(im_size / stride))
+    fg = torch.rand(batch_size, num_anchors, feat_size, feat_size)
+    rpn_cls_prob = torch.cat((1 - fg, fg), 1)
+    rpn_bbox_pred = torch.randn(batch_size, num_anchors * 4, feat_size, feat_size) * 0.2
+    im_info = torch.Tensor([[im_size, im_size, 1.]]).expand(batch_size, 3).contiguous()
+    if cuda:
+        rpn_cls_prob, rpn_bbox_pred, im_info = rpn_cls_prob.cuda(), rpn_bbox_pred.cuda(), im_info.cuda()
+    return rpn_cls_prob, rpn_bbox_pred, im_info
+
+
+def timeit(fn, input, iters, cuda):
+    for i in range(iters + 1):
+        # the first call warms up
+        if i == 1:
+            if cuda:
+                torch.cuda.synchronize()
+            tic = time.time()
+        output = fn(input)
+    if cuda:
+        torch.cuda.synchronize()
+    return output, (time.time() - tic) / iters
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    torch.manual_seed(3)
+    layer = _ProposalLayer(cfg.FEAT_STRIDE[0], cfg.ANCHOR_SCALES, cfg.ANCHOR_RATIOS)
+
+    for cfg_key in ('TRAIN', 'TEST'):
+        for batch_size in args.batch_sizes:
+            input = random_input(batch_size, args.im_size, layer._num_anchors, cfg.FEAT_STRIDE[0], args.cuda)
+            input = input + (cfg_key,)
+            ref, ref_time = timeit(lambda x: proposal_loop(layer, x), input, args.iters, args.cuda)
+            out, new_time = timeit(layer, input, args.iters, args.cuda)
+            # boxes with tied scores may come out in another order
+            same = all(bool((torch.sort(ref[i].view(-1))[0] == torch.sort(out[i].view(-1))[0]).all())
+                       for i in range(batch_size))
+            print('%s %d/%d, bs %d: loop %.4fs, batched %.4fs, speedup %.1fx, same proposals: %s'
+                  % (cfg_key, cfg[cfg_key].RPN_PRE_NMS_TOP_N, cfg[cfg_key].RPN_POST_NMS_TOP_N, batch_size,
+                     ref_time, new_time, ref_time / new_time, same))
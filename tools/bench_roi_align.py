@@ -0,0 +1,78 @@
+# --------------------------------------------------------
+# Throughput of the CPU RoIAlign and parity with the CUDA kernel
+# --------------------------------------------------------
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import _init_paths
+import argparse
+import time
+import numpy as np
+import torch
+
+from model.roi_align.functions.roi_align import roi_align, \
+    roi_align_forward_pytorch, roi_align_backward_pytorch
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark RoIAlign on CPU')
+    parser.add_argument('--bs', dest='batch_size', default=4, type=int)
+    parser.add_argument('--rois', dest='rois_per_image', default=128, type=int)
+    parser.add_argument('--channels', dest='channels', default=1024, type=int)
+    parser.add_argument('--size', dest='feat_size', default=38, type=int)
+    parser.add_argument('--pool', dest='pooling_size', default=7, type=int)
+    parser.add_argument('--iters', dest='iters', default=10, type=int)
+    return parser.parse_args()
+
+
+def random_rois(batch_size, rois_per_image, im_size):
+    rois = np.zeros((batch_size * rois_per_image, 5), dtype=np.float32)
+    rois[:, 0] = np.repeat(np.arange(batch_size), rois_per_image)
+    xy = np.random.rand(batch_size * rois_per_image, 2) * (im_size - 32)
+    wh = np.random.rand(batch_size * rois_per_image, 2) * (im_size / 2.) + 8
+    rois[:, 1:3] = xy
+    rois[:, 3:5] = np.minimum(xy + wh, im_size - 1)
+    return torch.from_numpy(rois)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    np.random.seed(3)
+    # RoIAlignAvg samples (POOLING_SIZE + 1) points per side
+    aligned = args.pooling_size + 1
+    scale = 1.0 / 16.0
+    features = torch.randn(args.batch_size, args.channels, args.feat_size, args.feat_size)
+    rois = random_rois(args.batch_size, args.rois_per_image, args.feat_size * 16)
+    num_rois = rois.size(0)
+
+    output = roi_align_forward_pytorch(aligned, aligned, scale, features, rois)
+    grad_output = torch.randn(output.size())
+
+    tic = time.time()
+    for _ in range(args.iters):
+        roi_align_forward_pytorch(aligned, aligned, scale, features, rois)
+    forward_time = (time.time() - tic) / args.iters
+
+    tic = time.time()
+    for _ in range(args.iters):
+        roi_align_backward_pytorch(aligned, aligned, scale, grad_output, rois, features.size())
+    backward_time = (time.time() - tic) / args.iters
+
+    print('features %s, %d rois, %dx%d bins' % (tuple(features.size()), num_rois, aligned, aligned))
+    print('cpu forward:  %.4fs (%.0f rois/s)' % (forward_time, num_rois / forward_time))
+    print('cpu backward: %.4fs (%.0f rois/s)' % (backward_time, num_rois / backward_time))
+
+    if roi_align is None or not torch.cuda.is_available():
+        print('CUDA RoIAlign kernel not available, skipping parity check')
+    else:
+        features_cuda = features.cuda()
+        rois_cuda = rois.cuda()
+        output_cuda = features_cuda.new(num_rois, args.channels, aligned, aligned).zero_()
+        roi_align.roi_align_forward_cuda(aligned, aligned, scale, features_cuda, rois_cuda, output_cuda)
+        grad_input_cuda = features_cuda.new(features.size()).zero_()
+        roi_align.roi_align_backward_cuda(aligned, aligned, scale, grad_output.cuda(),
+                                          rois_cuda, grad_input_cuda)
+        grad_input = roi_align_backward_pytorch(aligned, aligned, scale, grad_output, rois, features.size())
+        print('max |cpu - cuda| forward:  %.3e' % (output - output_cuda.cpu()).abs().max())
+        print('max |cpu - cuda| backward: %.3e' % (grad_input - grad_input_cuda.cpu()).abs().max())
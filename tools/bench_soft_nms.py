@@ -0,0 +1,53 @@
+# --------------------------------------------------------
+# Speed of the tensor soft-NMS against the reference soft_nms_cpu
+# --------------------------------------------------------
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import _init_paths
+import argparse
+import time
+import numpy as np
+import torch
+
+from model.nms.nms_cpu import soft_nms_cpu
+from model.nms.soft_nms import soft_nms
+from bench_nms import random_dets
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark soft-NMS')
+    parser.add_argument('--boxes', dest='num_boxes', nargs='+', default=[300, 1000, 6000], type=int)
+    parser.add_argument('--thresh', dest='thresh', default=0.3, type=float)
+    parser.add_argument('--sigma', dest='sigma', default=0.5, type=float)
+    parser.add_argument('--size', dest='im_size', default=600, type=int)
+    parser.add_argument('--max_keep', dest='max_keep', default=0, type=int,
+                        help='stop after this many boxes, 0 keeps all')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    np.random.seed(3)
+
+    for num_boxes in args.num_boxes:
+        dets = random_dets(num_boxes, args.im_size)
+        for method, method_id in (('linear', 1), ('gaussian', 2)):
+            tic = time.time()
+            # soft_nms_cpu reorders the boxes in place
+            num_ref, boxes_ref = soft_nms_cpu(dets.clone(), sigma=args.sigma, Nt=args.thresh, method=method_id)
+            ref_time = time.time() - tic
+
+            tic = time.time()
+            keep, scores = soft_nms(dets, args.thresh, method=method, sigma=args.sigma,
+                                    max_keep=args.max_keep)
+            tensor_time = time.time() - tic
+
+            # soft_nms_cpu leaves the kept boxes in pick order at the front
+            num_ref = len(num_ref) if args.max_keep <= 0 else min(len(num_ref), args.max_keep)
+            same = keep.numel() == num_ref and np.allclose(
+                dets[keep, :4].numpy(), boxes_ref[:num_ref, :4]) and np.allclose(
+                scores.numpy(), boxes_ref[:num_ref, 4], atol=1e-5)
+            print('%5d boxes, %-8s %5d kept: soft_nms_cpu %.4fs, tensor %.4fs, speedup %.1fx, same: %s'
+                  % (num_boxes, method, keep.numel(), ref_time, tensor_time, ref_time / tensor_time, same))
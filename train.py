@@ -23,12 +23,17 @@ from torch.autograd import Variable
 import torch.utils.data as Data
 from roi_data_layer.roidb import combined_roidb, rank_roidb_ratio, filter_class_roidb
 from roi_data_layer.roibatchLoader import roibatchLoader
+from roi_data_layer.feature_cache import FeatureCache, prefix_fingerprint, fill_feature_cache
+from roi_data_layer.batch_sampler import BucketBatchSampler
+from roi_data_layer.batch_assembler import BatchAssembler, ring_size
+from roi_data_layer.prefetcher import StreamPrefetcher
 from model.utils.config import cfg, cfg_from_file, cfg_from_list, get_output_dir
 from model.utils.net_utils import weights_normal_init, save_net, load_net, \
     adjust_learning_rate, save_checkpoint, clip_gradient
 from model.faster_rcnn.resnet import resnet
+from model.faster_rcnn.normal_attention import NormalAttentionBank
 import pickle
-from datasets.metadata import MetaDataset
+from datasets.metadata import MetaDataset, sample_episode_classes
 from collections import OrderedDict
 from torchvision import transforms,datasets
 from lib.model.faster_rcnn import faster_rcnn
@@ -120,6 +125,46 @@ def parse_args():
     parser.add_argument('--log_dir', dest='log_dir',
                         help='directory to save logs', default='logs',
                         type=str)
+    # cache the output of the fixed backbone prefix, e.g. data/feature_cache
+    # (not under data/cache, which is wiped on every launch)
+    parser.add_argument('--feature_cache', dest='feature_cache',
+                        help='directory of the fixed backbone feature cache, empty to disable',
+                        default='', type=str)
+    parser.add_argument('--prefetch', dest='prefetch',
+                        help='number of ready training steps kept per data stream',
+                        default=2, type=int)
+    parser.add_argument('--normal_workers', dest='normal_workers',
+                        help='number of worker processes of the defect-free image loaders, '
+                             '0 loads them in the prefetch thread',
+                        default=0, type=int)
+    parser.add_argument('--bucket_batches', dest='bucket_batches',
+                        help='batch images of the same scaled shape together',
+                        action='store_true')
+    # decoded and resized images, e.g. data/image_cache
+    parser.add_argument('--image_cache', dest='image_cache',
+                        help='directory of the decoded image cache, empty to disable',
+                        default='', type=str)
+    parser.add_argument('--image_cache_gb', dest='image_cache_gb',
+                        help='size limit of the decoded image cache in GB',
+                        default=10., type=float)
+    parser.add_argument('--meta_classes', dest='meta_classes',
+                        help='support classes per step with --meta_train, the classes of the detection batch '
+                             'and random others; 0 for all classes',
+                        default=0, type=int)
+    parser.add_argument('--normal_refresh', dest='normal_refresh',
+                        help='in the second phase, run the defect-free prn every this many steps and use the '
+                             'running mean of its attentions in between; 1 runs it every step',
+                        default=1, type=int)
+    parser.add_argument('--normal_momentum', dest='normal_momentum',
+                        help='momentum of the running mean of the defect-free attentions',
+                        default=0.9, type=float)
+    parser.add_argument('--normal_batch', dest='normal_batch',
+                        help='number of the latest defect-free images a refresh runs on',
+                        default=1, type=int)
+    parser.add_argument('--shot_seed', dest='shot_seed',
+                        help='seed of the support shot selection, repeated runs reuse the chosen shots; '
+                             'a new selection every run if not set',
+                        default=None, type=int)
     args = parser.parse_args()
     return args
 
@@ -177,10 +222,17 @@ if __name__ == '__main__':
         cfg_from_file(args.cfg_file)
     if args.set_cfgs is not None:
         cfg_from_list(args.set_cfgs)
+    if args.image_cache:
+        cfg.IMAGE_CACHE_DIR = args.image_cache
+        cfg.IMAGE_CACHE_GB = args.image_cache_gb
 
     print('Using config:')
     pprint.pprint(cfg)
     np.random.seed(cfg.RNG_SEED)
+    # the proposal target layer samples rois with the torch generators
+    torch.manual_seed(cfg.RNG_SEED)
+    if torch.cuda.is_available():
+        torch.cuda.manual_seed_all(cfg.RNG_SEED)
     if torch.cuda.is_available() and not args.cuda:
         print("WARNING: You have a CUDA device, so you should probably run with --cuda")
     if args.phase == 1:
@@ -228,16 +280,17 @@ if __name__ == '__main__':
         else:
             img_set = [('2007', 'train2')]
         metadataset = MetaDataset('data/VOCdevkit2007',
-                                     img_set, metaclass, img_size, shots=shots, shuffle=True,phase = args.phase) #phase = args.phase
+                                     img_set, metaclass, img_size, shots=shots, shuffle=True,phase = args.phase, #phase = args.phase
+                                     seed=args.shot_seed)
 
         metaloader = torch.utils.data.DataLoader(metadataset, batch_size=1, shuffle=False, num_workers=0,
                                                  pin_memory=True)
 
         normalloader = torch.utils.data.DataLoader(normal_dataset,batch_size=1, shuffle=False,
-                                                   num_workers=0)
+                                                   num_workers=args.normal_workers)
 
         normalloader2 = torch.utils.data.DataLoader(normal_dataset2, batch_size=1, shuffle=False,
-                                                    num_workers=0)
+                                                    num_workers=args.normal_workers)
 
 
     imdb, roidb, ratio_list, ratio_index = combined_roidb(args.imdb_name)
@@ -255,10 +308,20 @@ if __name__ == '__main__':
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
 
-    sampler_batch = sampler(train_size, args.batch_size)
     dataset = roibatchLoader(roidb, ratio_list, ratio_index, args.batch_size, imdb.num_classes, training=True)
-    dataloader = torch.utils.data.DataLoader(dataset, batch_size=args.batch_size,
-                                             sampler=sampler_batch, num_workers=args.num_workers, pin_memory=False)
+    # the images are padded straight into reused shared memory batches
+    dataset.assemble_batches = True
+    # a batch must outlive the ones queued behind it in the loader and the prefetcher
+    assembler = BatchAssembler(ring_size=ring_size(args.num_workers, args.prefetch))
+    if args.bucket_batches:
+        # sets the target ratios of the dataset, before the feature cache is filled
+        sampler_batch = BucketBatchSampler(dataset, args.batch_size)
+        dataloader = torch.utils.data.DataLoader(dataset, batch_sampler=sampler_batch, collate_fn=assembler,
+                                                 num_workers=args.num_workers, pin_memory=False)
+    else:
+        sampler_batch = sampler(train_size, args.batch_size)
+        dataloader = torch.utils.data.DataLoader(dataset, batch_size=args.batch_size, collate_fn=assembler,
+                                                 sampler=sampler_batch, num_workers=args.num_workers, pin_memory=False)
 
     # initilize the network here
     if args.net == 'TDENet':
@@ -323,8 +386,44 @@ if __name__ == '__main__':
             cfg.POOLING_MODE = checkpoint['pooling_mode']
         print("loaded checkpoint %s" % (load_name))
 
+    if args.feature_cache:
+        assert len(cfg.TRAIN.SCALES) == 1, 'the feature cache needs a single training scale'
+        feature_cache = FeatureCache(args.feature_cache, prefix_fingerprint(fasterRCNN))
+        fill_feature_cache(feature_cache, dataset, fasterRCNN, args.cuda, args.num_workers)
+        # the dataloader workers are forked at every epoch and pick it up from there
+        dataset.feature_cache = feature_cache
+
     iters_per_epoch = int(train_size / args.batch_size)
 
+    # the detection batches, the support sets and the defect-free images are
+    # loaded in background threads, each stream cycles over its loader
+    streams = [('detection', dataloader)]
+    if args.meta_train:
+        streams += [('support', metaloader), ('normal', normalloader2 if args.phase == 2 else normalloader)]
+    prefetcher = StreamPrefetcher(streams, depth=args.prefetch)
+
+    # only the novel classes of the second phase use the defect-free attentions
+    normal_bank = None
+    if args.meta_train and args.phase == 2 and args.normal_refresh > 1:
+        normal_bank = NormalAttentionBank(args.normal_refresh, args.normal_momentum, args.normal_batch)
+
+    # initilize the tensor holder here, the batches are copied into them on the gpu
+    im_data = torch.FloatTensor(1)
+    im_info = torch.FloatTensor(1)
+    num_boxes = torch.LongTensor(1)
+    gt_boxes = torch.FloatTensor(1)
+    # ship to cuda
+    if args.cuda:
+        im_data = im_data.cuda()
+        im_info = im_info.cuda()
+        num_boxes = num_boxes.cuda()
+        gt_boxes = gt_boxes.cuda()
+    # make variable
+    im_data = Variable(im_data)
+    im_info = Variable(im_info)
+    num_boxes = Variable(num_boxes)
+    gt_boxes = Variable(gt_boxes)
+
     for epoch in range(args.start_epoch, args.max_epochs):
         fasterRCNN.train()
         loss_temp = 0
@@ -336,16 +435,17 @@ if __name__ == '__main__':
 
         #dataloader本质上是一个可迭代对象，可以使用iter()进行访问，采用iter(dataloader)返回的是一个迭代器，然后可以使用next()访问
         #已经访问完最后⼀个数据之后，再次调⽤next()函数会抛出 StopIteration的异常
-        data_iter = iter(dataloader)
-        meta_iter = iter(metaloader)
-        normal_iter = iter(normalloader)
-        normal_iter2 = iter(normalloader2)
+        if args.bucket_batches:
+            # of the pass the first step of this epoch comes from, the stream
+            # runs ahead of the steps in its own thread
+            stats = sampler_batch.pass_stats[(epoch - args.start_epoch) * iters_per_epoch // len(sampler_batch)]
+            print('[epoch %2d] padding %.2f%% of the batch pixels, cropping %.2f%% of the image pixels'
+                  % (epoch, stats['padded'] * 100, stats['cropped'] * 100))
         for step in range(iters_per_epoch):
-            try:
-                data = next(data_iter)
-            except:
-                data_iter = iter(dataloader)
-                data = next(data_iter)
+            if args.meta_train:
+                data, (prndata, prncls), (normaldata, normalcls) = next(prefetcher)
+            else:
+                data, = next(prefetcher)
 
             im_data_list = []
             im_info_list = []
@@ -355,55 +455,36 @@ if __name__ == '__main__':
             normal_data_list = []
             normal_info_list = []
 
-            # initilize the tensor holder here.
-            im_data = torch.FloatTensor(1)
-            im_info = torch.FloatTensor(1)
-            num_boxes = torch.LongTensor(1)
-            gt_boxes = torch.FloatTensor(1)
-            # ship to cuda
             if args.cuda:
-                im_data = im_data.cuda()
-                im_info = im_info.cuda()
-                num_boxes = num_boxes.cuda()
-                gt_boxes = gt_boxes.cuda()
-            # make variable
-            im_data = Variable(im_data)
-            im_info = Variable(im_info)
-            num_boxes = Variable(num_boxes)
-            gt_boxes = Variable(gt_boxes)
-
+                im_data.data.resize_(data[0].size()).copy_(data[0])
+                im_info.data.resize_(data[1].size()).copy_(data[1])
+                gt_boxes.data.resize_(data[2].size()).copy_(data[2])
+                num_boxes.data.resize_(data[3].size()).copy_(data[3])
+            else:
+                # the assembled batch is used as it is, it stays valid for this step
+                im_data, im_info, gt_boxes, num_boxes = [Variable(d) for d in data[:4]]
+
+            meta_weights = None
+            if args.meta_train and 0 < args.meta_classes < len(prncls):
+                # class subsampled episode, the prn cost scales with the classes kept
+                gt_classes, batch_boxes = data[2].numpy(), data[3].numpy()
+                present = set(int(gt_classes[i, j, 4]) - 1 for i in range(len(batch_boxes))
+                              for j in range(batch_boxes[i]))
+                rows, weights = sample_episode_classes([int(cls[0]) for cls in prncls], present, args.meta_classes)
+                prndata = prndata.index_select(1, torch.LongTensor(rows))
+                prncls = [prncls[i] for i in rows]
+                meta_weights = Variable(torch.FloatTensor(weights).cuda())
+
+            normal_attentions = None
             if args.meta_train:
-                # get prn network input data
-                try:
-                    prndata,prncls = next(meta_iter)
-                except:
-                    meta_iter = iter(metaloader)
-                    prndata, prncls = next(meta_iter)
-                #prepare normal data
-                if args.phase == 2:
-                    try:
-                        normaldata, normalcls = next(normal_iter2)
-
-                    except:
-                        normal_iter2 = iter(normalloader2)
-                        normaldata, normalcls = next(normal_iter2)
+                if normal_bank is not None:
+                    normal_attentions = normal_bank(fasterRCNN, torch.cat(normaldata, dim=0), args.cuda)
                 else:
-                    try:
-                        normaldata, normalcls = next(normal_iter)
-
-                    except:
-                        normal_iter = iter(normalloader)
-                        normaldata, normalcls = next(normal_iter)
-
-                normal_data_list.append(Variable(torch.cat(normaldata, dim=0).cuda()))
-                normal_info_list.append(normalcls)
+                    normal_data_list.append(Variable(torch.cat(normaldata, dim=0).cuda()))
+                    normal_info_list.append(normalcls)
 
                 im_data_list.append(Variable(torch.cat(prndata,dim=0).cuda()))
                 im_info_list.append(prncls)
-                im_data.data.resize_(data[0].size()).copy_(data[0])
-                im_info.data.resize_(data[1].size()).copy_(data[1])
-                gt_boxes.data.resize_(data[2].size()).copy_(data[2])
-                num_boxes.data.resize_(data[3].size()).copy_(data[3])
                 im_data_list.append(im_data)
                 im_info_list.append(im_info)
                 gt_boxes_list.append(gt_boxes)
@@ -411,10 +492,6 @@ if __name__ == '__main__':
 
             else:
 
-                im_data.data.resize_(data[0].size()).copy_(data[0])
-                im_info.data.resize_(data[1].size()).copy_(data[1])
-                gt_boxes.data.resize_(data[2].size()).copy_(data[2])
-                num_boxes.data.resize_(data[3].size()).copy_(data[3])
                 im_data_list.append(im_data)
                 im_info_list.append(im_info)
                 gt_boxes_list.append(gt_boxes)
@@ -424,10 +501,14 @@ if __name__ == '__main__':
 
             rois, rpn_loss_cls, rpn_loss_box, \
             RCNN_loss_cls, RCNN_loss_bbox, \
-            rois_label, cls_prob, bbox_pred, meta_loss = fasterRCNN(im_data_list, im_info_list, gt_boxes_list,num_boxes_list,normal_data_list,normal_info_list)
+            rois_label, cls_prob, bbox_pred, meta_loss = fasterRCNN(im_data_list, im_info_list, gt_boxes_list,num_boxes_list,normal_data_list,normal_info_list,
+                                                                      phase2=args.phase == 2, meta_weights=meta_weights,
+                                                                      normal_attentions=normal_attentions)
 
             if args.meta_train:
-                loss = rpn_loss_cls.mean() + rpn_loss_box.mean() + sum(RCNN_loss_cls) / args.batch_size + sum(RCNN_loss_bbox) / args.batch_size + meta_loss / len(metaclass)
+                # the rcnn losses of the classes left out of an episode are zero anyway, and the
+                # weighted meta loss estimates the mean over all classes, so the scales are unchanged
+                loss = rpn_loss_cls.mean() + rpn_loss_box.mean() + RCNN_loss_cls.sum() / args.batch_size + RCNN_loss_bbox.sum() / args.batch_size + meta_loss / len(metaclass)
             else:
                 loss = rpn_loss_cls.mean() + rpn_loss_box.mean() \
                        + RCNN_loss_cls.mean() + RCNN_loss_bbox.mean()
@@ -454,8 +535,8 @@ if __name__ == '__main__':
                     loss_rcnn_cls = RCNN_loss_cls.data[0]
                     loss_rcnn_box = RCNN_loss_bbox.data[0]
                 else:
-                    loss_rcnn_cls = sum(RCNN_loss_cls) / args.batch_size
-                    loss_rcnn_box = sum(RCNN_loss_bbox) / args.batch_size
+                    loss_rcnn_cls = RCNN_loss_cls.data.sum() / args.batch_size
+                    loss_rcnn_box = RCNN_loss_bbox.data.sum() / args.batch_size
                     loss_tdenet = meta_loss / len(metaclass)
 
                 fg_cnt = torch.sum(rois_label.data.ne(0))
@@ -464,6 +545,9 @@ if __name__ == '__main__':
                 print("[session %d][epoch %2d][iter %4d] loss: %.4f, lr: %.2e" \
                       % (args.session, epoch, step, loss_temp, lr))
                 print("\t\t\tfg/bg=(%d/%d), time cost: %f" % (fg_cnt, bg_cnt, end - start))
+                print("\t\t\tdata wait per step: " + ", ".join("%s %.1fms" % stat for stat in prefetcher.wait_stats()))
+                if normal_bank is not None:
+                    print("\t\t\tdefect-free attentions refreshed on %d of %d steps" % (normal_bank.refreshes, normal_bank.steps))
                 if args.meta_train:
                     print("\t\t\trpn_cls: %.4f, rpn_box: %.4f, rcnn_cls: %.4f, rcnn_box %.4f, meta_loss %.4f" \
                           % (loss_rpn_cls, loss_rpn_box, loss_rcnn_cls, loss_rcnn_box, loss_tdenet ))
@@ -504,6 +588,7 @@ if __name__ == '__main__':
             'class_agnostic': args.class_agnostic,
         }, save_name)
     print('save model: {}'.format(save_name))
+    prefetcher.close()
     end = time.time()
     # print(end - start)
 
@@ -513,6 +598,8 @@ if __name__ == '__main__':
         class_attentions = collections.defaultdict(list)
         normal_class_attentions = collections.defaultdict(list)
         meta_iter = iter(metaloader)
+        normal_iter = iter(normalloader)
+        normal_iter2 = iter(normalloader2)
         for i in range(shots):
             prndata, prncls = next(meta_iter)
             im_data_list = []